@@ -69,6 +69,14 @@ TEMPLATES[0]['OPTIONS']['loaders'] = [
 # Raises ImproperlyConfigured exception if DATABASE_URL not in os.environ
 DATABASES['default'] = env.db('DATABASE_URL')
 
+# CACHING
+# ------------------------------------------------------------------------------
+# Statistics and stashed uploads of the survey app are shared by all worker
+# processes, the default table is created with ``manage.py createcachetable``
+CACHES = {
+    'default': env.cache('DJANGO_CACHE_URL', default='dbcache://django_cache'),
+}
+
 
 # Sentry Configuration
 SENTRY_DSN = env('DJANGO_SENTRY_DSN')
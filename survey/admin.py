@@ -1,20 +1,30 @@
-import csv
-from itertools import groupby
+from datetime import timedelta
 
 from django.contrib import admin, messages
 from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
-from django.shortcuts import redirect, render
+from django.http import FileResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect, render
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import ugettext_lazy as _
 from django_object_actions import DjangoObjectActions
 from import_export.admin import ImportExportMixin
 from reversion.admin import VersionAdmin
 
-from .models import (Answer, Category, Hospital, NationalHealtFund,
-                     Participant, Question, Subquestion, Survey)
+from .analytics import iter_summary_csv
+from .artifacts import get_artifact
+from .comparisons import build_comparison, get_hospital_changes
+from .counters import (counter_batch, reconcile_answer_count,
+                       reconcile_subquestion_count)
+from .exports import FORMATS, get_changes, iter_csv, iter_jsonl
+from .models import (Answer, Category, Comparison, ComparisonRow, Hospital,
+                     NationalHealtFund, Notification, Participant,
+                     QualityIssue, QualityRule, Question, Subquestion, Survey)
+from .quality import check_quality, get_changed_participant_ids
 from .resources import (HospitalResource, NationalHealthFundResource,
                         ParticipantResource)
+from .stats import get_completion_matrix, get_survey_progress
 
 
 class ParticipantInline(admin.TabularInline):
@@ -53,7 +63,8 @@ class NationalHealtFundAdmin(ImportExportMixin, VersionAdmin):
         ParticipantInline,
     ]
     resource_class = NationalHealthFundResource
-    list_display = ('name',)
+    list_display = ('name', 'hospital_count')
+    readonly_fields = ('hospital_count',)
     search_fields = ('name',)
     inlines = [
         HospitalInline,
@@ -75,7 +86,8 @@ class SurveyAdmin(DjangoObjectActions, VersionAdmin):
     '''
         Admin View for Survey
     '''
-    change_actions = ['validate', 'export', 'overview', 'stats']
+    change_actions = ['validate', 'export', 'export_changes', 'overview', 'stats', 'heatmap', 'analytics', 'quality',
+                      'comparison']
     list_display = ('title', 'created', 'modified', 'is_valid', 'get_style_display')
     inlines = [
         CategoryInline,
@@ -118,38 +130,50 @@ class SurveyAdmin(DjangoObjectActions, VersionAdmin):
     overview.label = _("Overview")
 
     def export(self, request, obj):
-        response = HttpResponse(content_type='text/csv')
-        filename = "export-%s.csv" % (str(obj), )
+        # ?format=jsonl for JSON Lines, ?subquestion=<pk> and ?category=<pk> project columns
+        fmt = request.GET.get('format', 'csv')
+        if fmt not in FORMATS:
+            fmt = 'csv'
+        try:
+            subquestions = [int(x) for x in request.GET.getlist('subquestion')] or None
+            categories = [int(x) for x in request.GET.getlist('category')] or None
+        except ValueError:
+            return HttpResponseBadRequest("Subquestion and category must be given as integers.")
+        path = None
+        if fmt == 'csv' and subquestions is None and categories is None:
+            path = get_artifact(obj)
+        if path is not None:
+            response = FileResponse(open(path, 'rb'), content_type='text/csv')
+            if path.endswith('.gz'):
+                response['Content-Encoding'] = 'gzip'
+        elif fmt == 'jsonl':
+            response = StreamingHttpResponse(iter_jsonl(obj,
+                                                        subquestions=subquestions,
+                                                        categories=categories),
+                                             content_type=FORMATS[fmt])
+        else:
+            response = StreamingHttpResponse(iter_csv(obj,
+                                                      subquestions=subquestions,
+                                                      categories=categories),
+                                             content_type=FORMATS[fmt])
+        filename = "export-%s.%s" % (str(obj), fmt)
         response['Content-Disposition'] = 'attachment; filename="%s"' % (filename, )
+        return response
 
-        def get_key(subquestion):
-            return "{title}:{pk}".format(title=subquestion.name, pk=subquestion.pk)
-
-        fieldnames = ['Health fund', 'Hospital', 'Identifier', 'Voivodeship', 'City', 'Accept on']
-        fieldnames += [get_key(subquestion) for subquestion in Subquestion.objects.
-                       filter(question__category__survey=obj).all()]
-        answer_qs = (Answer.objects.filter(participant__survey=obj).
-                     select_related('participant__health_fund').
-                     select_related('subquestion').
-                     select_related('hospital').
-                     order_by('hospital_id',).
-                     all())
-        writer = csv.DictWriter(response, fieldnames=fieldnames)
-        writer.writeheader()
-
-        def key(x):
-            return (x.participant.health_fund, x.hospital, x.participant)
-
-        for (health_fund, hospital, participant), g in groupby(answer_qs, key):
-            row = {'Health fund': health_fund,
-                   'Hospital': hospital,
-                   'Identifier': hospital.identifier,
-                   'Accept on': str(participant.accept_on)}
-            row.update({get_key(answer.subquestion): answer.answer
-                        for answer in g
-                        if get_key(answer.subquestion) in fieldnames})
-            writer.writerow(row)
+    def export_changes(self, request, obj):
+        since = parse_datetime(request.GET.get('since', ''))
+        if since is None:
+            since = timezone.now() - timedelta(days=1)
+        elif timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        groups, cursor = get_changes(obj, since)
+        response = StreamingHttpResponse(iter_csv(obj, groups=groups), content_type='text/csv')
+        filename = "export-%s-%s.csv" % (str(obj), since.strftime('%Y%m%d%H%M%S'))
+        response['Content-Disposition'] = 'attachment; filename="%s"' % (filename, )
+        response['X-Export-Cursor'] = cursor.isoformat()
         return response
+    export_changes.short_description = _("Export answers changed since given time, by default a day")
+    export_changes.label = _("Export changes")
 
     def stats(self, request, obj):
         context = {}
@@ -159,30 +183,98 @@ class SurveyAdmin(DjangoObjectActions, VersionAdmin):
         context['object'] = obj
         context['has_change_permission'] = request.user.has_perm('survey.change_survey')
         context['survey'] = obj
-        qs = (Participant.objects.filter(survey=obj).
-              with_progress_stats().
-              select_related('health_fund').all())
-        context['participant_list'] = qs
-        context['sum_fill_count'] = sum(x.get_answer_count() for x in qs)
-        context['sum_required_count'] = sum(x.get_required_count() for x in qs)
-        context['sum_progress'] = context['sum_fill_count'] / context['sum_required_count'] * 100
+        progress = get_survey_progress(obj)
+        context['participant_list'] = progress.participants
+        context['sum_fill_count'] = progress.answer_count
+        context['sum_required_count'] = progress.required_count
+        context['sum_progress'] = progress.progress
         return render(request, 'survey/survey_admin_stats.html', context=context)
     stats.short_description = _("Statistics of progress of analysis")
     stats.label = _("Statistics")
 
+    def heatmap(self, request, obj):
+        context = {}
+        context['opts'] = self.opts
+        context['original'] = obj
+        context['title'] = self.heatmap.short_description
+        context['object'] = obj
+        context['has_change_permission'] = request.user.has_perm('survey.change_survey')
+        matrix = get_completion_matrix(obj)
+        context['health_funds'] = matrix.health_funds
+        context['row_list'] = matrix.rows
+        category = request.GET.get('category')
+        if category:
+            context['category'] = next((x for x in matrix.rows if str(x.obj.pk) == category), None)
+            context['row_list'] = context['category'].children if context['category'] else []
+        return render(request, 'survey/survey_admin_heatmap.html', context=context)
+    heatmap.short_description = _("Completion of categories and questions per health fund")
+    heatmap.label = _("Heatmap")
+
+    def analytics(self, request, obj):
+        response = StreamingHttpResponse(iter_summary_csv(obj), content_type='text/csv')
+        filename = "analytics-%s.csv" % (str(obj), )
+        response['Content-Disposition'] = 'attachment; filename="%s"' % (filename, )
+        return response
+    analytics.short_description = _("Summary of numeric answers per health fund and country")
+    analytics.label = _("Analytics")
+
+    def quality(self, request, obj):
+        # GET asks for confirmation, POST replaces quality issues of changed participants
+        participant_ids = get_changed_participant_ids(obj)
+        if request.method == 'POST':
+            count = check_quality(obj, participant_ids)
+            messages.success(request, '{0} quality issues were found in changed answers.'.format(count))
+            return redirect('{0}?participant__survey__id__exact={1}'.format(
+                reverse('admin:survey_qualityissue_changelist'), obj.pk))
+        context = {}
+        context['opts'] = self.opts
+        context['original'] = obj
+        context['title'] = self.quality.short_description
+        context['object'] = obj
+        context['has_change_permission'] = request.user.has_perm('survey.change_survey')
+        context['participant_count'] = len(participant_ids)
+        return render(request, 'survey/survey_admin_quality.html', context=context)
+    quality.short_description = _("Check quality of answers changed since the last check")
+    quality.label = _("Check quality")
+
+    def comparison(self, request, obj):
+        # POST of previous=<pk> (re)builds the comparison with the previous survey
+        if request.method == 'POST':
+            try:
+                previous_id = int(request.POST.get('previous', ''))
+            except ValueError:
+                return HttpResponseBadRequest("Previous survey must be given as an integer.")
+            previous = get_object_or_404(Survey.objects.exclude(pk=obj.pk), pk=previous_id)
+            comparison = build_comparison(obj, previous)
+            messages.success(request, '{0} answers were compared.'.format(comparison.row_count))
+            return redirect(request.path)
+        comparison = Comparison.objects.filter(survey=obj).order_by('-built_at').first()
+        context = {}
+        context['opts'] = self.opts
+        context['original'] = obj
+        context['title'] = self.comparison.short_description
+        context['object'] = obj
+        context['has_change_permission'] = request.user.has_perm('survey.change_survey')
+        context['comparison'] = comparison
+        context['survey_list'] = Survey.objects.exclude(pk=obj.pk)
+        context['hospital_list'] = get_hospital_changes(comparison) if comparison else []
+        return render(request, 'survey/survey_admin_comparison.html', context=context)
+    comparison.short_description = _("Hospitals which changed most since a previous survey")
+    comparison.label = _("Compare")
+
+    def save_related(self, request, form, formsets, change):
+        with counter_batch():
+            super(SurveyAdmin, self).save_related(request, form, formsets, change)
+
     def update_subquestion_count(modeladmin, request, queryset):
-        count = 0
-        for survey in queryset.with_db_subquestion_count().all():
-            survey.subquestion_count = survey.db_subquestion_count
-            survey.save(update_fields=['subquestion_count'])
-            count = count + 1
+        count = reconcile_subquestion_count(queryset.values_list('pk', flat=True))
         messages.success(request, 'Subquestion count of {0} surveys was updated.'.format(count))
 
 
 admin.site.register(Survey, SurveyAdmin)
 
 
-class ParticipantAdmin(ImportExportMixin, VersionAdmin):
+class ParticipantAdmin(ImportExportMixin, DjangoObjectActions, VersionAdmin):
     '''
         Admin View for Participant
     '''
@@ -199,6 +291,7 @@ class ParticipantAdmin(ImportExportMixin, VersionAdmin):
     readonly_fields = ('answer_count',)
     resource_class = ParticipantResource
     actions = ['update_answer_count', ]
+    change_actions = ['upload_answers']
 
     def get_queryset(self, *args, **kwargs):
         qs = super(ParticipantAdmin, self).get_queryset(*args, **kwargs)
@@ -210,13 +303,15 @@ class ParticipantAdmin(ImportExportMixin, VersionAdmin):
     get_progress_display.short_description = _('Progress')
 
     def update_answer_count(modeladmin, request, queryset):
-        count = 0
-        for participant in queryset.with_db_answer_count().all():
-            participant.answer_count = participant.db_answer_count
-            participant.save(update_fields=['answer_count'])
-            count = count + 1
+        count = reconcile_answer_count(queryset.values_list('pk', flat=True))
         messages.success(request, 'Answer count of {0} participants was updated.'.format(count))
 
+    def upload_answers(self, request, obj):
+        return redirect(reverse('survey:upload', kwargs={'participant': str(obj.pk),
+                                                         'password': obj.password}))
+    upload_answers.short_description = _("Upload answers from a file in the layout of the export")
+    upload_answers.label = _("Upload answers")
+
 
 admin.site.register(Participant, ParticipantAdmin)
 
@@ -240,6 +335,10 @@ class CategoryAdmin(DjangoObjectActions, VersionAdmin):
     ]
     change_actions = ['parent_edit']
 
+    def save_related(self, request, form, formsets, change):
+        with counter_batch():
+            super(CategoryAdmin, self).save_related(request, form, formsets, change)
+
     def parent_edit(self, request, obj):
         return redirect(reverse('admin:survey_survey_change', args=[str(obj.survey_id)]))
     parent_edit.short_description = _("Edit survey")
@@ -269,6 +368,10 @@ class QuestionAdmin(DjangoObjectActions, VersionAdmin):
 
     change_actions = ['parent_edit']
 
+    def save_related(self, request, form, formsets, change):
+        with counter_batch():
+            super(QuestionAdmin, self).save_related(request, form, formsets, change)
+
     def parent_edit(self, request, obj):
         return redirect(reverse('admin:survey_category_change', args=[str(obj.category_id)]))
     parent_edit.short_description = _("Edit category")
@@ -289,7 +392,7 @@ class SubquestionAdmin(DjangoObjectActions, VersionAdmin):
     '''
         Admin View for Subquestion
     '''
-    list_display = ('name', 'question', 'kind', 'ordering')
+    list_display = ('name', 'question', 'kind', 'key', 'ordering')
     list_filter = ('question__category__survey',)
     inlines = [
         AnswerInline,
@@ -309,8 +412,93 @@ class AnswerAdmin(VersionAdmin):
     '''
         Admin View for Answer
     '''
-    list_display = ('answer', 'participant', 'subquestion', 'hospital')
-    list_filter = ('participant', 'subquestion__question', 'subquestion', 'hospital',)
+    list_display = ('answer', 'value', 'participant', 'subquestion', 'hospital')
+    list_filter = ('participant', 'subquestion__question', 'subquestion', 'hospital', 'missing_data')
 
 
 admin.site.register(Answer, AnswerAdmin)
+
+
+class NotificationAdmin(admin.ModelAdmin):
+    '''
+        Admin View for Notification
+    '''
+    list_display = ('participant', 'kind', 'hospital', 'question', 'status', 'attempts',
+                    'next_attempt_at', 'sent_at', 'created')
+    list_filter = ('status', 'kind')
+    readonly_fields = ('attempts', 'sent_at', 'last_error')
+    actions = ['retry', ]
+
+    def retry(modeladmin, request, queryset):
+        count = queryset.exclude(status=Notification.STATUS.sent).update(status=Notification.STATUS.pending,
+                                                                         attempts=0,
+                                                                         next_attempt_at=timezone.now())
+        messages.success(request, '{0} notifications were scheduled for delivery.'.format(count))
+    retry.short_description = _("Retry delivery")
+
+
+admin.site.register(Notification, NotificationAdmin)
+
+
+class QualityRuleAdmin(admin.ModelAdmin):
+    '''
+        Admin View for QualityRule
+    '''
+    list_display = ('name', 'survey', 'left', 'operator', 'factor', 'right', 'active')
+    list_filter = ('survey', 'active')
+    search_fields = ('name', )
+
+
+admin.site.register(QualityRule, QualityRuleAdmin)
+
+
+class QualityIssueAdmin(admin.ModelAdmin):
+    '''
+        Admin View for QualityIssue
+    '''
+    list_display = ('hospital', 'participant', 'subquestion', 'kind', 'value', 'score', 'message')
+    list_filter = ('kind', 'participant__survey', 'participant__health_fund', 'rule')
+    list_select_related = ('hospital', 'participant', 'subquestion')
+    search_fields = ('hospital__name', 'subquestion__name', 'message')
+    readonly_fields = ('participant', 'hospital', 'subquestion', 'rule', 'kind', 'value', 'score', 'message')
+
+    def has_add_permission(self, request):
+        return False
+
+
+admin.site.register(QualityIssue, QualityIssueAdmin)
+
+
+class ComparisonAdmin(admin.ModelAdmin):
+    '''
+        Admin View for Comparison
+    '''
+    list_display = ('survey', 'previous', 'row_count', 'built_at')
+    list_filter = ('survey', )
+    actions = ['rebuild', ]
+
+    def rebuild(modeladmin, request, queryset):
+        for comparison in queryset.select_related('survey', 'previous'):
+            build_comparison(comparison.survey, comparison.previous)
+        messages.success(request, '{0} comparisons were rebuilt.'.format(len(queryset)))
+    rebuild.short_description = _("Rebuild comparisons")
+
+
+admin.site.register(Comparison, ComparisonAdmin)
+
+
+class ComparisonRowAdmin(admin.ModelAdmin):
+    '''
+        Admin View for ComparisonRow
+    '''
+    list_display = ('hospital', 'subquestion', 'previous_value', 'value', 'delta', 'change')
+    list_filter = ('comparison', )
+    list_select_related = ('hospital', 'subquestion')
+    search_fields = ('hospital__name', 'hospital__identifier', 'subquestion__name')
+    readonly_fields = ('comparison', 'hospital', 'subquestion', 'previous_value', 'value', 'delta', 'change')
+
+    def has_add_permission(self, request):
+        return False
+
+
+admin.site.register(ComparisonRow, ComparisonRowAdmin)
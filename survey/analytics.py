@@ -0,0 +1,139 @@
+"""
+Summaries of numeric answers computed with NumPy.
+
+Answers of ``KIND_INT`` and ``KIND_VINT`` subquestions of a survey are loaded
+with one query into a matrix of rows (hospital of a participant) and columns
+(subquestions). Missing answers are NaN, missing data (``Subquestion.MISSING_DATA``)
+is NaN marked in a separate mask. Statistics are computed column-wise for every
+health fund and for the whole country.
+"""
+import csv
+import warnings
+from collections import namedtuple
+
+import numpy as np
+
+from .exports import Echo, get_columns, is_numeric
+from .models import Answer, NationalHealtFund, Subquestion
+
+PERCENTILES = [25, 75, 90]
+
+STATS = ['count', 'sum', 'mean', 'median'] + ['p{0}'.format(x) for x in PERCENTILES] + ['missing_ratio']
+
+NumericData = namedtuple('NumericData', ['columns', 'health_funds', 'row_health_funds', 'row_participants',
+                                         'row_hospitals', 'values', 'missing'])
+Summary = namedtuple('Summary', ['scope', 'columns', 'stats'])
+
+
+def to_int64(answer):
+    if not answer.lstrip('-').isdecimal():
+        return np.nan
+    value = int(answer)
+    return value if -2 ** 63 <= value < 2 ** 63 else np.nan
+
+
+def to_numbers(answers):
+    """
+    Converts an array of answers to floats and a mask of missing data.
+
+    Answers which are not integers or do not fit 64 bits become NaN, as in ``models.parse_number``.
+    """
+    answers = np.char.strip(answers.astype(np.str_))
+    missing = np.isin(answers, Subquestion.MISSING_DATA)
+    digits = np.char.lstrip(answers, '-')
+    valid = np.char.isdigit(digits) & (np.char.str_len(answers) - np.char.str_len(digits) <= 1)
+    numbers = np.full(len(answers), np.nan)
+    try:
+        numbers[valid] = answers[valid].astype(np.int64)
+    except (ValueError, OverflowError):  # digits outside of ASCII or of int64
+        numbers[valid] = [to_int64(x) for x in answers[valid]]
+    return numbers, missing
+
+
+def load_numeric(survey):
+    """
+    Returns ``NumericData`` of the survey.
+    """
+    columns = [column for column in get_columns(survey) if is_numeric(column)]
+    column_ids = np.array([column.pk for column in columns], dtype=np.int64)
+    rows = list(Answer.objects.filter(participant__survey=survey, subquestion__in=column_ids.tolist()).
+                order_by().
+                values_list('participant__health_fund_id', 'participant_id', 'hospital_id',
+                            'subquestion_id', 'answer'))
+    if not rows:
+        empty = np.empty((0, len(columns)))
+        ids = np.empty(0, dtype=np.int64)
+        return NumericData(columns, [], ids, ids, ids, empty, empty.astype(bool))
+    health_fund_ids, participant_ids, hospital_ids, subquestion_ids, answers = zip(*rows)
+    participant_ids = np.array(participant_ids, dtype=np.int64)
+    hospital_ids = np.array(hospital_ids, dtype=np.int64)
+    keys = hospital_ids * (participant_ids.max() + 1) + participant_ids
+    unique_keys, row_index, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(column_ids)
+    column_index = order[np.searchsorted(column_ids, np.array(subquestion_ids, dtype=np.int64),
+                                         sorter=order)]
+    numbers, missing_data = to_numbers(np.array(answers, dtype=object))
+    values = np.full((len(unique_keys), len(columns)), np.nan)
+    missing = np.zeros((len(unique_keys), len(columns)), dtype=bool)
+    values[inverse, column_index] = numbers
+    missing[inverse, column_index] = missing_data
+    row_health_funds = np.array(health_fund_ids, dtype=np.int64)[row_index]
+    health_funds = list(NationalHealtFund.objects.
+                        filter(pk__in=set(row_health_funds.tolist())).
+                        order_by('name').
+                        values_list('pk', 'name'))
+    return NumericData(columns, health_funds, row_health_funds, participant_ids[row_index],
+                       hospital_ids[row_index], values, missing)
+
+
+def summarize(values, missing):
+    """
+    Returns a dict of ``STATS`` arrays computed for every column of the matrix.
+    """
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        count = np.sum(~np.isnan(values), axis=0)
+        stats = {'count': count,
+                 'sum': np.nansum(values, axis=0),
+                 'mean': np.nanmean(values, axis=0),
+                 'median': np.nanmedian(values, axis=0)}
+        if len(values):
+            percentiles = np.nanpercentile(values, PERCENTILES, axis=0)
+        else:
+            percentiles = np.full((len(PERCENTILES), values.shape[1]), np.nan)
+        for percentile, result in zip(PERCENTILES, percentiles):
+            stats['p{0}'.format(percentile)] = result
+        missing_count = np.sum(missing, axis=0)
+        stats['missing_ratio'] = missing_count / (count + missing_count)
+    return stats
+
+
+def get_summaries(survey, data=None):
+    """
+    Returns a list of ``Summary`` for every health fund and for the country.
+    """
+    data = load_numeric(survey) if data is None else data
+    summaries = []
+    for pk, name in data.health_funds:
+        mask = data.row_health_funds == pk
+        summaries.append(Summary(name, data.columns, summarize(data.values[mask], data.missing[mask])))
+    summaries.append(Summary('', data.columns, summarize(data.values, data.missing)))
+    return summaries
+
+
+def format_value(value):
+    if np.isnan(value):
+        return ''
+    return '{0:.4g}'.format(value) if value != int(value) else str(int(value))
+
+
+def iter_summary_csv(survey):
+    """
+    Yields lines of a CSV with a row per scope and subquestion, empty scope for the country.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(['Health fund', 'Subquestion'] + STATS)
+    for summary in get_summaries(survey):
+        for i, column in enumerate(summary.columns):
+            yield writer.writerow([summary.scope, column.name] +
+                                  [format_value(summary.stats[stat][i]) for stat in STATS])
@@ -0,0 +1,252 @@
+"""
+Batched write paths for answers.
+
+All functions take rows of ``(hospital_id, subquestion_id, answer)`` of a single
+participant and issue a constant number of queries per batch instead of one
+query (and transaction) per answer. Answers to numeric subquestions are stored
+with ``Answer.value`` and ``Answer.missing_data`` filled, ``fill_values``
+recomputes them for existing answers.
+"""
+from collections import namedtuple
+
+import reversion
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Case, Value, When
+from django.utils import timezone
+from django.utils.encoding import force_text
+
+from .completion import refresh_completion
+from .counters import reconcile_answer_count
+from .models import Answer, Subquestion, parse_number
+from .stats import invalidate
+
+BATCH_SIZE = 500
+# CASE expressions need up to seven parameters per row, SQLite allows 999 per statement
+UPDATE_BATCH_SIZE = 100
+
+Change = namedtuple('Change', ['pk', 'hospital_id', 'subquestion_id', 'old', 'new'])
+
+
+class UpsertResult(namedtuple('UpsertResult', ['created', 'changed', 'unchanged'])):
+    __slots__ = ()
+
+    @property
+    def modified(self):
+        return self.created + self.changed
+
+    def as_dict(self):
+        """
+        Returns a mapping of ``(hospital_id, subquestion_id)`` to the saved answer.
+        """
+        return {(change.hospital_id, change.subquestion_id): change.new
+                for change in self.created + self.changed + self.unchanged}
+
+
+def chunks(items, size=BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def get_numeric_ids(subquestion_ids):
+    return set(Subquestion.objects.filter(pk__in=set(subquestion_ids),
+                                          kind__in=Subquestion.NUMERIC_KINDS).
+               values_list('pk', flat=True))
+
+
+def get_typed(answer, numeric):
+    return parse_number(answer) if numeric else (None, False)
+
+
+def get_value_cases(rows):
+    """
+    Returns CASE expressions of ``value`` and ``missing_data`` for rows of ``(pk, value, missing_data)``.
+    """
+    values = [When(pk=pk, then=Value(value)) for pk, value, _ in rows if value is not None]
+    missing = [When(pk=pk, then=Value(True)) for pk, _, missing_data in rows if missing_data]
+    return {'value': Case(*values, default=Value(None), output_field=models.BigIntegerField()),
+            'missing_data': Case(*missing, default=Value(False), output_field=models.BooleanField())}
+
+
+def get_existing(participant, rows):
+    """
+    Returns a mapping of ``(hospital_id, subquestion_id)`` to ``(pk, answer)``.
+    """
+    hospitals = {hospital_id for hospital_id, _, _ in rows}
+    return Answer.objects.filter(participant=participant, hospital_id__in=hospitals).as_existing()
+
+
+def classify(rows, existing):
+    result = UpsertResult([], [], [])
+    for hospital_id, subquestion_id, answer in rows:
+        pk, old = existing.get((hospital_id, subquestion_id), (None, None))
+        change = Change(pk, hospital_id, subquestion_id, old, answer)
+        if pk is None:
+            result.created.append(change)
+        elif old != answer:
+            result.changed.append(change)
+        else:
+            result.unchanged.append(change)
+    return result
+
+
+def _upsert_mysql(participant, rows, now, numeric_ids):
+    qn = connection.ops.quote_name
+    now = connection.ops.adapt_datetimefield_value(now)
+    sql = ('INSERT INTO {table} ({created}, {modified}, {participant}, {hospital}, {subquestion}, {answer}, '
+           '{value}, {missing_data}) '
+           'VALUES {values} '
+           'ON DUPLICATE KEY UPDATE '
+           '{modified} = IF(BINARY {answer} = VALUES({answer}), {modified}, VALUES({modified})), '
+           '{answer} = VALUES({answer}), '
+           '{value} = VALUES({value}), '
+           '{missing_data} = VALUES({missing_data})')
+    with connection.cursor() as cursor:
+        for chunk in chunks(rows):
+            params = []
+            for change in chunk:
+                value, missing_data = get_typed(change.new, change.subquestion_id in numeric_ids)
+                params += [now, now, participant.pk, change.hospital_id, change.subquestion_id, change.new,
+                           value, missing_data]
+            cursor.execute(sql.format(table=qn(Answer._meta.db_table),
+                                      created=qn('created'),
+                                      modified=qn('modified'),
+                                      participant=qn('participant_id'),
+                                      hospital=qn('hospital_id'),
+                                      subquestion=qn('subquestion_id'),
+                                      answer=qn('answer'),
+                                      value=qn('value'),
+                                      missing_data=qn('missing_data'),
+                                      values=', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s)'] * len(chunk))),
+                           params)
+
+
+def update_answers(changes, now=None, numeric_ids=None):
+    """
+    Writes changed answers with one CASE based UPDATE per chunk of rows.
+
+    ``numeric_ids`` may pass ids of numeric subquestions to save a query.
+    Raises ``ValueError`` for changes without ``pk``, which must be created instead.
+    """
+    now = now or timezone.now()
+    changes = list(changes)
+    if not changes:
+        return
+    if any(change.pk is None for change in changes):
+        raise ValueError("Only changes of saved answers can be updated.")
+    if numeric_ids is None:
+        numeric_ids = get_numeric_ids(change.subquestion_id for change in changes)
+    for chunk in chunks(changes, UPDATE_BATCH_SIZE):
+        answer = Case(*[When(pk=change.pk, then=Value(change.new)) for change in chunk],
+                      output_field=models.TextField())
+        cases = get_value_cases([(change.pk, ) + get_typed(change.new, change.subquestion_id in numeric_ids)
+                                 for change in chunk])
+        Answer.objects.filter(pk__in=[change.pk for change in chunk]).update(answer=answer,
+                                                                             modified=now,
+                                                                             **cases)
+
+
+def fill_values(answers, batch_size=BATCH_SIZE):
+    """
+    Recomputes ``value`` and ``missing_data`` of the queryset of answers.
+
+    Answers are read in batches ordered by primary key and only those with
+    stale values are written, ``modified`` is kept. Returns the number of
+    updated answers.
+    """
+    qs = (answers.order_by('pk').
+          values_list('pk', 'subquestion__kind', 'answer', 'value', 'missing_data'))
+    last_pk = 0
+    updated = 0
+    while True:
+        batch = list(qs.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return updated
+        last_pk = batch[-1][0]
+        stale = []
+        for pk, kind, answer, value, missing_data in batch:
+            typed = get_typed(answer, kind in Subquestion.NUMERIC_KINDS)
+            if typed != (value, missing_data):
+                stale.append((pk, ) + typed)
+        for chunk in chunks(stale, UPDATE_BATCH_SIZE):
+            Answer.objects.filter(pk__in=[pk for pk, _, _ in chunk]).update(**get_value_cases(chunk))
+        updated += len(stale)
+
+
+def _upsert_portable(participant, result, now, numeric_ids):
+    objs = []
+    for change in result.created:
+        value, missing_data = get_typed(change.new, change.subquestion_id in numeric_ids)
+        objs.append(Answer(participant=participant,
+                           hospital_id=change.hospital_id,
+                           subquestion_id=change.subquestion_id,
+                           answer=change.new,
+                           value=value,
+                           missing_data=missing_data,
+                           created=now,
+                           modified=now))
+    try:
+        with transaction.atomic():
+            Answer.objects.bulk_create(objs)
+    except IntegrityError:  # rows inserted meanwhile by a concurrent request
+        rows = [(x.hospital_id, x.subquestion_id, x.new) for x in result.created]
+        existing = get_existing(participant, rows)
+        update_answers([change._replace(pk=existing[(change.hospital_id, change.subquestion_id)][0])
+                        for change in result.created
+                        if (change.hospital_id, change.subquestion_id) in existing], now, numeric_ids)
+        Answer.objects.bulk_create([obj for obj in objs
+                                    if (obj.hospital_id, obj.subquestion_id) not in existing])
+    update_answers(result.changed, now, numeric_ids)
+
+
+def add_to_revision(participant, changes):
+    """
+    Adds answers of the changes to the active revision, as ``Model.save()`` does for registered models.
+
+    Bulk writes bypass ``save()``, so without it ``RevisionMixin`` views would
+    record no history of answers. Costs one query while a revision is active.
+    """
+    if not changes or not reversion.is_active() or not reversion.is_registered(Answer):
+        return
+    keys = {(change.hospital_id, change.subquestion_id) for change in changes}
+    for answer in Answer.objects.filter(participant=participant,
+                                        hospital_id__in={hospital_id for hospital_id, _ in keys},
+                                        subquestion_id__in={subquestion_id for _, subquestion_id in keys}):
+        if (answer.hospital_id, answer.subquestion_id) in keys:
+            reversion.add_to_revision(answer)
+
+
+def upsert_answers(participant, rows, existing=None):
+    """
+    Creates or updates answers of the participant in bulk.
+
+    ``existing`` may pass answers already loaded by the caller in the format of
+    ``get_existing`` to save a query. Returns ``UpsertResult`` with lists of
+    ``Change`` for created, changed and unchanged rows. Modified answers are
+    added to the active revision of django-reversion, see ``add_to_revision``.
+    """
+    rows = [(hospital_id, subquestion_id, force_text(answer))
+            for hospital_id, subquestion_id, answer in rows]
+    if not rows:
+        return UpsertResult([], [], [])
+    if existing is None:
+        existing = get_existing(participant, rows)
+    result = classify(rows, existing)
+    now = timezone.now()
+    numeric_ids = set()
+    if result.modified:
+        numeric_ids = get_numeric_ids(change.subquestion_id for change in result.modified)
+    with transaction.atomic():
+        if connection.vendor == 'mysql':
+            _upsert_mysql(participant, result.created, now, numeric_ids)
+            update_answers(result.changed, now, numeric_ids)
+        else:
+            _upsert_portable(participant, result, now, numeric_ids)
+        add_to_revision(participant, result.modified)
+        if result.created:
+            reconcile_answer_count([participant.pk])
+            refresh_completion(participant,
+                               hospital_ids={change.hospital_id for change in result.created},
+                               subquestion_ids={change.subquestion_id for change in result.created})
+    if result.modified:
+        invalidate(participant.survey_id)
+    return result
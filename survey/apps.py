@@ -5,3 +5,6 @@ from django.utils.translation import ugettext_lazy as _
 class SurveyConfig(AppConfig):
     name = 'survey'
     verbose_name = _("Survey")
+
+    def ready(self):
+        from . import mail  # noqa, registers invalidation of cached recipients
@@ -0,0 +1,90 @@
+"""
+Pre-built CSV exports stored on disk.
+
+An artifact is tagged with a content version of the survey, which is derived
+from the answers, the participants, the hospitals and health funds of the
+participants and ``Survey.structure_version`` with four aggregate queries.
+Artifacts are built by the ``build_exports`` management command, the admin only
+serves an artifact matching the current version.
+"""
+import gzip
+import hashlib
+import os
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .exports import iter_csv
+from .models import Answer, Hospital, NationalHealtFund, Participant
+
+EXPORT_ROOT = getattr(settings, 'SURVEY_EXPORT_ROOT', os.path.join(settings.MEDIA_ROOT, 'exports'))
+COMPRESS = getattr(settings, 'SURVEY_EXPORT_COMPRESS', True)
+
+
+def get_content_version(survey):
+    answers = (Answer.objects.filter(participant__survey=survey).
+               aggregate(count=Count('pk'), modified=Max('modified')))
+    participants = (Participant.objects.filter(survey=survey).
+                    aggregate(count=Count('pk'), modified=Max('modified'), accept_on=Max('accept_on')))
+    hospitals = (Hospital.objects.filter(health_fund__participant__survey=survey).
+                 aggregate(count=Count('pk', distinct=True), modified=Max('modified')))
+    health_funds = (NationalHealtFund.objects.filter(participant__survey=survey).
+                    aggregate(modified=Max('modified')))
+    key = ('{structure}|{a[count]}|{a[modified]}|{p[count]}|{p[modified]}|{p[accept_on]}|'
+           '{h[count]}|{h[modified]}|{f[modified]}').format(
+        structure=survey.structure_version, a=answers, p=participants, h=hospitals, f=health_funds)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def get_prefix(survey):
+    return 'survey-{0}-'.format(survey.pk)
+
+
+def get_path(survey, version, compress=COMPRESS):
+    filename = '{prefix}{version}.csv{ext}'.format(prefix=get_prefix(survey),
+                                                   version=version,
+                                                   ext='.gz' if compress else '')
+    return os.path.join(EXPORT_ROOT, filename)
+
+
+def get_artifact(survey):
+    """
+    Returns the path of an up-to-date artifact of the survey or ``None``.
+    """
+    version = get_content_version(survey)
+    for compress in (True, False):
+        path = get_path(survey, version, compress)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def remove_artifacts(survey, keep=None):
+    if not os.path.isdir(EXPORT_ROOT):
+        return
+    for filename in os.listdir(EXPORT_ROOT):
+        path = os.path.join(EXPORT_ROOT, filename)
+        if filename.startswith(get_prefix(survey)) and path != keep:
+            os.remove(path)
+
+
+def build_artifact(survey, force=False, compress=COMPRESS):
+    """
+    Writes the export of the survey unless it is up to date.
+
+    Returns the path of the artifact and whether it was built.
+    """
+    version = get_content_version(survey)
+    path = get_path(survey, version, compress)
+    if not force and os.path.exists(path):
+        return path, False
+    if not os.path.isdir(EXPORT_ROOT):
+        os.makedirs(EXPORT_ROOT)
+    tmp_path = '{0}.tmp-{1}'.format(path, os.getpid())
+    opener = gzip.open if compress else open
+    with opener(tmp_path, 'wt', encoding='utf-8', newline='') as fp:
+        for line in iter_csv(survey):
+            fp.write(line)
+    os.replace(tmp_path, path)
+    remove_artifacts(survey, keep=path)
+    return path, True
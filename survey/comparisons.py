@@ -0,0 +1,125 @@
+"""
+Year-over-year comparison of numeric answers of two editions of a survey.
+
+Hospitals are matched by ``Hospital.identifier`` and subquestions by
+``get_subquestion_key``. Deltas of all matched answers are materialized in bulk
+as ``ComparisonRow`` of a ``Comparison``, so hospitals which changed most are
+read with one grouped query, see ``get_hospital_changes``.
+"""
+from django.db import models, transaction
+from django.db.models import Case, Count, Max, Sum, Value, When
+from django.utils import timezone
+
+from .models import Answer, Comparison, ComparisonRow, Subquestion
+
+BATCH_SIZE = 500
+
+
+def get_subquestion_key(key, category, question, name):
+    if key:
+        return key
+    return '/'.join(x.strip().lower() for x in (category, question, name))
+
+
+def unique_mapping(pairs):
+    """
+    Returns a mapping of pairs, keys with more than one distinct value are skipped.
+    """
+    mapping = {}
+    ambiguous = set()
+    for key, value in pairs:
+        if mapping.get(key, value) != value:
+            ambiguous.add(key)
+        mapping[key] = value
+    for key in ambiguous:
+        del mapping[key]
+    return mapping
+
+
+def get_subquestion_ids(survey):
+    """
+    Returns a mapping of keys to pks of numeric subquestions of the survey.
+    """
+    rows = (Subquestion.objects.filter(question__category__survey=survey,
+                                       kind__in=Subquestion.NUMERIC_KINDS).
+            values_list('key', 'question__category__name', 'question__name', 'name', 'pk'))
+    return unique_mapping((get_subquestion_key(*row[:4]), row[4]) for row in rows)
+
+
+def get_hospital_ids(survey):
+    """
+    Returns a mapping of identifiers to pks of hospitals answered in the survey.
+    """
+    return unique_mapping(Answer.objects.filter(participant__survey=survey).
+                          exclude(hospital__identifier='').
+                          order_by().
+                          values_list('hospital__identifier', 'hospital_id').
+                          distinct())
+
+
+def get_values(survey):
+    return {(hospital_id, subquestion_id): value
+            for hospital_id, subquestion_id, value in (Answer.objects.
+                                                       filter(participant__survey=survey, value__isnull=False).
+                                                       order_by().
+                                                       values_list('hospital_id', 'subquestion_id', 'value'))}
+
+
+def match(current, previous):
+    """
+    Returns a mapping of current pks to previous pks with the same key.
+    """
+    return {pk: previous[key] for key, pk in current.items() if key in previous}
+
+
+def get_rows(survey, previous):
+    """
+    Returns unsaved ``ComparisonRow`` of answers given in both surveys.
+    """
+    subquestions = match(get_subquestion_ids(survey), get_subquestion_ids(previous))
+    hospitals = match(get_hospital_ids(survey), get_hospital_ids(previous))
+    previous_values = get_values(previous)
+    rows = []
+    for (hospital_id, subquestion_id), value in get_values(survey).items():
+        previous_value = previous_values.get((hospitals.get(hospital_id), subquestions.get(subquestion_id)))
+        if previous_value is None:
+            continue
+        delta = value - previous_value
+        rows.append(ComparisonRow(hospital_id=hospital_id,
+                                  subquestion_id=subquestion_id,
+                                  previous_value=previous_value,
+                                  value=value,
+                                  delta=delta,
+                                  change=abs(delta) / max(abs(previous_value), 1)))
+    return rows
+
+
+def build_comparison(survey, previous):
+    """
+    Replaces rows of the comparison of the survey with the previous one and returns it.
+    """
+    comparison, _ = Comparison.objects.get_or_create(survey=survey, previous=previous)
+    rows = get_rows(survey, previous)
+    for row in rows:
+        row.comparison = comparison
+    with transaction.atomic():
+        ComparisonRow.objects.filter(comparison=comparison).delete()
+        ComparisonRow.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+        comparison.row_count = len(rows)
+        comparison.built_at = timezone.now()
+        comparison.save(update_fields=['row_count', 'built_at', 'modified'])
+    return comparison
+
+
+def get_hospital_changes(comparison, limit=50):
+    """
+    Returns hospitals of the comparison ordered by their greatest change.
+    """
+    changed = Case(When(delta=0, then=Value(0)), default=Value(1), output_field=models.IntegerField())
+    return list(ComparisonRow.objects.filter(comparison=comparison).
+                order_by().
+                values('hospital_id', 'hospital__name', 'hospital__identifier').
+                annotate(max_change=Max('change'),
+                         row_count=Count('pk'),
+                         changed_count=Sum(changed)).
+                order_by('-max_change', 'hospital__name')[:limit])
@@ -0,0 +1,152 @@
+"""
+Denormalized completion of answers per participant and hospital and per
+participant and question.
+
+Rows are recounted with grouped aggregates for the touched hospitals and
+questions only, so list views and e-mails read a handful of small rows instead
+of every answer of the participant. Writes of ``upsert_answers`` recount rows
+at once, answers created by ``Answer.save()``, deleted answers and moved
+subquestions through ``schedule_refresh`` once their transaction commits. Acceptance does not trust the rows and counts
+answers again, see ``is_complete``.
+"""
+import threading
+
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+
+from .counters import reconcile_answer_count
+from .models import (Answer, CompletionStatus, HospitalCompletion,
+                     Participant, QuestionCompletion, Subquestion)
+
+_state = threading.local()
+
+
+def refresh_completion(participant, hospital_ids=None, subquestion_ids=None):
+    """
+    Recounts completion rows of the participant.
+
+    ``hospital_ids`` and ``subquestion_ids`` narrow recounting to the hospitals
+    and questions containing the given subquestions, by default everything is
+    recounted.
+    """
+    answers = Answer.objects.filter(participant=participant).order_by()
+    hospital_answers = answers
+    hospital_qs = HospitalCompletion.objects.filter(participant=participant)
+    if hospital_ids is not None:
+        hospital_answers = hospital_answers.filter(hospital__in=hospital_ids)
+        hospital_qs = hospital_qs.filter(hospital__in=hospital_ids)
+    question_answers = answers
+    question_qs = QuestionCompletion.objects.filter(participant=participant)
+    if subquestion_ids is not None:
+        question_ids = set(Subquestion.objects.filter(pk__in=subquestion_ids).
+                           values_list('question_id', flat=True))
+        question_answers = question_answers.filter(subquestion__question__in=question_ids)
+        question_qs = question_qs.filter(question__in=question_ids)
+
+    with transaction.atomic():
+        # Serializes refreshes of the participant, which delete and recreate the same unique rows
+        list(Participant.objects.select_for_update().filter(pk=participant.pk).values_list('pk', flat=True))
+        hospital_qs.delete()
+        HospitalCompletion.objects.bulk_create(
+            HospitalCompletion(participant=participant,
+                               hospital_id=row['hospital_id'],
+                               answer_count=row['count'])
+            for row in hospital_answers.values('hospital_id').annotate(count=Count('pk')))
+        question_qs.delete()
+        QuestionCompletion.objects.bulk_create(
+            QuestionCompletion(participant=participant,
+                               question_id=row['subquestion__question_id'],
+                               answer_count=row['count'])
+            for row in question_answers.values('subquestion__question_id').annotate(count=Count('pk')))
+
+
+def _refresh_pending():
+    pending, _state.pending = getattr(_state, 'pending', None) or {}, None
+    for participant in Participant.objects.filter(pk__in=list(pending)):
+        refresh_completion(participant, hospital_ids=pending[participant.pk])
+    reconcile_answer_count(list(pending))
+
+
+def _is_scheduled():
+    return any(func is _refresh_pending for _, func in connection.run_on_commit)
+
+
+def schedule_refresh(participant_id, hospital_ids=()):
+    """
+    Recounts completion of the participant once the current transaction commits.
+
+    Completion of the given hospitals and of all questions is recounted, once
+    per participant however many answers a transaction deletes.
+    """
+    if not connection.in_atomic_block:
+        _state.pending = {participant_id: set(hospital_ids)}
+        _refresh_pending()
+        return
+    if not _is_scheduled():
+        _state.pending = {}
+        transaction.on_commit(_refresh_pending)
+    _state.pending.setdefault(participant_id, set()).update(hospital_ids)
+
+
+def get_question_completion(participant, structure):
+    """
+    Returns a mapping of question pk to ``CompletionStatus`` of the participant.
+    """
+    hospital_count = participant.get_hospital_count()
+    counts = dict(QuestionCompletion.objects.filter(participant=participant).
+                  values_list('question_id', 'answer_count'))
+    return {question.pk: CompletionStatus(counts.get(question.pk, 0),
+                                          len(question.subquestions) * hospital_count)
+            for question in structure.iter_questions()}
+
+
+def get_section_completion(participant, sections):
+    """
+    Returns ``CompletionStatus`` of sections of a form of the participant with one grouped query.
+
+    Every section has ``questions`` and ``hospitals``.
+    """
+    counts = {(row['subquestion__question_id'], row['hospital_id']): row['count']
+              for row in (Answer.objects.filter(participant=participant).
+                          order_by().
+                          values('subquestion__question_id', 'hospital_id').
+                          annotate(count=Count('pk')))}
+    return [CompletionStatus(sum(counts.get((question.pk, hospital.pk), 0)
+                                 for question in section.questions
+                                 for hospital in section.hospitals),
+                             sum(len(question.subquestions) for question in section.questions) *
+                             len(section.hospitals))
+            for section in sections]
+
+
+def get_cell_completion(participant, structure, hospital_ids, question_ids):
+    """
+    Returns mappings of hospital and question pks to ``CompletionStatus`` of the participant.
+    """
+    hospital_counts = dict(HospitalCompletion.objects.filter(participant=participant,
+                                                             hospital__in=hospital_ids).
+                           values_list('hospital_id', 'answer_count'))
+    question_counts = dict(QuestionCompletion.objects.filter(participant=participant,
+                                                             question__in=question_ids).
+                           values_list('question_id', 'answer_count'))
+    hospital_count = participant.get_hospital_count()
+    return ({pk: CompletionStatus(hospital_counts.get(pk, 0), len(structure)) for pk in hospital_ids},
+            {pk: CompletionStatus(question_counts.get(pk, 0),
+                                  len(structure.questions[pk].subquestions) * hospital_count)
+             for pk in question_ids})
+
+
+def get_answer_count(participant):
+    return (HospitalCompletion.objects.filter(participant=participant,
+                                              hospital__health_fund=participant.health_fund_id).
+            aggregate(count=Sum('answer_count'))['count'] or 0)
+
+
+def is_complete(participant):
+    """
+    Counts answers of current hospitals of the participant to subquestions of the survey.
+    """
+    count = Answer.objects.filter(participant=participant,
+                                  hospital__health_fund=participant.health_fund_id,
+                                  subquestion__question__category__survey=participant.survey_id).count()
+    return count >= participant.get_required_count()
@@ -0,0 +1,228 @@
+"""
+Maintenance of denormalized counters of the survey structure.
+
+``Survey.subquestion_count`` is kept in sync with atomic ``F()`` deltas applied by
+the signal handlers in ``survey.models`` instead of recounting the whole survey
+after every change of a subquestion. Every change also bumps
+``Survey.structure_version``, which invalidates cached snapshots of the survey.
+Bulk edits can group deltas with ``counter_batch`` or skip the per-row
+bookkeeping altogether with ``suspend_counters``. Any drift is fixed by
+``reconcile_subquestion_count``.
+
+``NationalHealtFund.hospital_count`` is maintained the same way by
+``move_hospital`` and fixed by ``reconcile_hospital_count``.
+"""
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from django.db import connection
+from django.db.models import F
+
+_state = threading.local()
+
+
+def _get_pending():
+    return getattr(_state, 'pending', None)
+
+
+def _is_suspended():
+    return getattr(_state, 'suspended', None) is not None
+
+
+def _get_survey_cache():
+    return getattr(_state, 'survey_cache', None)
+
+
+def _apply(deltas):
+    from .models import Survey
+    for survey_id, delta in deltas.items():
+        Survey.objects.filter(pk=survey_id).update(subquestion_count=F('subquestion_count') + delta,
+                                                   structure_version=F('structure_version') + 1)
+
+
+def apply_delta(survey_id, delta=0):
+    """
+    Records a change of the survey structure with ``delta`` subquestions added.
+    """
+    if survey_id is None or _is_suspended():
+        return
+    pending = _get_pending()
+    if pending is not None:
+        pending[survey_id] += delta
+        return
+    _apply({survey_id: delta})
+
+
+def resolve_question_surveys(question_ids):
+    """
+    Returns a mapping of question pk to survey pk, memoized within ``counter_batch``.
+    """
+    from .models import Question
+    cache = _get_survey_cache()
+    cache = cache if cache is not None else {}
+    missing = [x for x in set(question_ids) if x is not None and x not in cache]
+    if missing:
+        cache.update(Question.objects.filter(pk__in=missing).values_list('pk', 'category__survey_id'))
+    return {x: cache.get(x) for x in question_ids}
+
+
+def resolve_category_surveys(category_ids):
+    from .models import Category
+    return dict(Category.objects.filter(pk__in=[x for x in category_ids if x is not None]).
+                values_list('pk', 'survey_id'))
+
+
+def move(old_survey_id, new_survey_id, count):
+    if old_survey_id is None or new_survey_id is None or old_survey_id == new_survey_id:
+        apply_delta(new_survey_id if new_survey_id is not None else old_survey_id)
+        return
+    apply_delta(old_survey_id, -count)
+    apply_delta(new_survey_id, count)
+
+
+def is_tracking():
+    return not _is_suspended()
+
+
+@contextmanager
+def counter_batch():
+    """
+    Collects counter deltas and writes them as one UPDATE per survey on exit.
+
+    Deltas of a block which raised an exception are discarded, use
+    ``reconcile_subquestion_count`` when the writes were not rolled back.
+    """
+    if _get_pending() is not None:
+        yield
+        return
+    _state.pending = Counter()
+    _state.survey_cache = {}
+    try:
+        yield
+        pending = _state.pending
+    finally:
+        _state.pending = None
+        _state.survey_cache = None
+    _apply(pending)
+
+
+@contextmanager
+def suspend_counters(survey_ids=None):
+    """
+    Disables per-row counter bookkeeping and reconciles counters on exit.
+
+    Intended for imports and mass edits where any per-row work is wasted.
+    ``survey_ids`` narrows the reconciliation, by default every survey is recounted.
+    """
+    if _is_suspended():
+        yield
+        return
+    _state.suspended = True
+    try:
+        yield
+    finally:
+        _state.suspended = None
+    reconcile_subquestion_count(survey_ids)
+
+
+def _in_clause(column, ids):
+    if ids is None:
+        return '', []
+    ids = list(ids)
+    if not ids:
+        return ' WHERE 1 = 0', []
+    params = ', '.join(['%s'] * len(ids))
+    return ' WHERE {column} IN ({params})'.format(column=column, params=params), ids
+
+
+def reconcile_subquestion_count(survey_ids=None):
+    """
+    Recounts ``Survey.subquestion_count`` with one set-based UPDATE.
+
+    The structure version is bumped as well, because reconciliation follows
+    changes made without bookkeeping. Returns the number of updated surveys.
+    """
+    from .models import Category, Question, Subquestion, Survey
+    qn = connection.ops.quote_name
+    survey = qn(Survey._meta.db_table)
+    where, params = _in_clause('{}.{}'.format(survey, qn('id')), survey_ids)
+    sql = ('UPDATE {survey} SET {version} = {version} + 1, {count} = ('
+           'SELECT COUNT(*) FROM {subquestion} '
+           'INNER JOIN {question} ON {subquestion}.{question_id} = {question}.{id} '
+           'INNER JOIN {category} ON {question}.{category_id} = {category}.{id} '
+           'WHERE {category}.{survey_id} = {survey}.{id})').format(
+        survey=survey,
+        version=qn('structure_version'),
+        subquestion=qn(Subquestion._meta.db_table),
+        question=qn(Question._meta.db_table),
+        category=qn(Category._meta.db_table),
+        count=qn('subquestion_count'),
+        id=qn('id'),
+        question_id=qn('question_id'),
+        category_id=qn('category_id'),
+        survey_id=qn('survey_id')) + where
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def reconcile_answer_count(participant_ids=None):
+    """
+    Recounts ``Participant.answer_count`` with one set-based UPDATE.
+
+    Returns the number of updated participants.
+    """
+    from .models import Answer, Participant
+    qn = connection.ops.quote_name
+    participant = qn(Participant._meta.db_table)
+    where, params = _in_clause('{}.{}'.format(participant, qn('id')), participant_ids)
+    sql = ('UPDATE {participant} SET {count} = ('
+           'SELECT COUNT(*) FROM {answer} '
+           'WHERE {answer}.{participant_id} = {participant}.{id})').format(
+        participant=participant,
+        answer=qn(Answer._meta.db_table),
+        count=qn('answer_count'),
+        id=qn('id'),
+        participant_id=qn('participant_id')) + where
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def move_hospital(old_health_fund_id, new_health_fund_id):
+    """
+    Records a hospital added to, moved between or removed from health funds.
+    """
+    from .models import NationalHealtFund
+    if old_health_fund_id == new_health_fund_id:
+        return
+    if old_health_fund_id is not None:
+        (NationalHealtFund.objects.filter(pk=old_health_fund_id).
+         update(hospital_count=F('hospital_count') - 1))
+    if new_health_fund_id is not None:
+        (NationalHealtFund.objects.filter(pk=new_health_fund_id).
+         update(hospital_count=F('hospital_count') + 1))
+
+
+def reconcile_hospital_count(health_fund_ids=None):
+    """
+    Recounts ``NationalHealtFund.hospital_count`` with one set-based UPDATE.
+
+    Returns the number of updated health funds.
+    """
+    from .models import Hospital, NationalHealtFund
+    qn = connection.ops.quote_name
+    health_fund = qn(NationalHealtFund._meta.db_table)
+    where, params = _in_clause('{}.{}'.format(health_fund, qn('id')), health_fund_ids)
+    sql = ('UPDATE {health_fund} SET {count} = ('
+           'SELECT COUNT(*) FROM {hospital} '
+           'WHERE {hospital}.{health_fund_id} = {health_fund}.{id})').format(
+        health_fund=health_fund,
+        hospital=qn(Hospital._meta.db_table),
+        count=qn('hospital_count'),
+        id=qn('id'),
+        health_fund_id=qn('health_fund_id')) + where
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
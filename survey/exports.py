@@ -0,0 +1,329 @@
+"""
+Export of survey answers to CSV with one row per participant and hospital.
+
+Answers are read in batches of hospitals, so memory use does not grow with the
+number of answers of the survey. Two engines produce identical output:
+``python`` reads answers as plain tuples and pivots them while iterating,
+``sql`` pivots them in the database with conditional aggregation, in batches of
+columns for wide surveys.
+
+Both engines can be limited to rows with answers changed since a moment, see
+``get_changes``. Besides CSV of plain answers, rows can be written with typed
+values as JSON Lines or as a Parquet file.
+"""
+import csv
+import json
+from datetime import timedelta
+from collections import OrderedDict, namedtuple
+from itertools import groupby, islice
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Case, F, Max, When
+
+from .models import Answer, Hospital, Participant, Subquestion
+
+HOSPITAL_BATCH_SIZE = 100
+# SQLite returns at most 2000 columns per row by default
+COLUMN_BATCH_SIZE = 200
+PARQUET_BATCH_SIZE = 10000
+# Seconds before the cursor searched again for answers committed after a previous call
+CHANGES_OVERLAP = getattr(settings, 'SURVEY_EXPORT_CHANGES_OVERLAP', 60)
+
+Column = namedtuple('Column', ['pk', 'name', 'kind'])
+
+HEADER = ['Health fund', 'Hospital', 'Identifier', 'Voivodeship', 'City', 'Accept on']
+ACCEPT_ON = HEADER.index('Accept on')
+
+
+class Echo(object):
+    """
+    File-like object returning written values, to stream ``csv.writer`` output.
+    """
+
+    def write(self, value):
+        return value
+
+
+def get_key(subquestion_pk, name):
+    return "{title}:{pk}".format(title=name, pk=subquestion_pk)
+
+
+def get_columns(survey, subquestions=None, categories=None):
+    """
+    Returns a list of ``Column`` in order of the export.
+
+    ``subquestions`` and ``categories`` project the export to the given pks.
+    """
+    qs = Subquestion.objects.filter(question__category__survey=survey)
+    if subquestions is not None:
+        qs = qs.filter(pk__in=subquestions)
+    if categories is not None:
+        qs = qs.filter(question__category__in=categories)
+    return [Column(pk, get_key(pk, name), kind) for pk, name, kind in qs.values_list('pk', 'name', 'kind')]
+
+
+def get_fieldnames(columns):
+    return HEADER + [column.name for column in columns]
+
+
+def get_answers(survey, health_fund=None):
+    qs = Answer.objects.filter(participant__survey=survey)
+    if health_fund is not None:
+        qs = qs.filter(participant__health_fund=health_fund)
+    return qs
+
+
+def get_hospital_ids(survey, groups=None, health_fund=None):
+    if groups is not None:
+        return sorted({hospital_id for hospital_id, _ in groups})
+    return sorted(get_answers(survey, health_fund).
+                  order_by().
+                  values_list('hospital_id', flat=True).
+                  distinct())
+
+
+def get_changes(survey, since):
+    """
+    Returns rows with answers created or modified after ``since``.
+
+    The result is a set of ``(hospital_id, participant_id)`` and a cursor, the
+    latest modification time of the answers, to pass as ``since`` next time.
+
+    An answer is stamped before its transaction commits, so a row committed
+    after a previous call may be older than its cursor. Answers are searched
+    from ``CHANGES_OVERLAP`` seconds before ``since`` and rows of that window
+    are exported again. Deleted answers leave no trace and are not reported,
+    their rows are fixed by the next full export.
+    """
+    participant_ids = list(Participant.objects.filter(survey=survey).values_list('pk', flat=True))
+    start = since - timedelta(seconds=CHANGES_OVERLAP)
+    qs = Answer.objects.filter(participant__in=participant_ids, modified__gt=start).order_by()
+    groups = set(qs.values_list('hospital_id', 'participant_id').distinct())
+    cursor = qs.aggregate(cursor=Max('modified'))['cursor'] if groups else since
+    return groups, cursor
+
+
+def filter_answers(survey, hospital_ids, groups=None, health_fund=None):
+    qs = get_answers(survey, health_fund).filter(hospital_id__in=hospital_ids)
+    if groups is not None:
+        qs = qs.filter(participant_id__in={participant_id for _, participant_id in groups})
+    return qs
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def get_participants(survey, health_fund=None):
+    qs = Participant.objects.filter(survey=survey)
+    if health_fund is not None:
+        qs = qs.filter(health_fund=health_fund)
+    return {pk: (name, accept_on)
+            for pk, name, accept_on in qs.values_list('pk', 'health_fund__name', 'accept_on')}
+
+
+def get_hospitals(hospital_ids):
+    return {pk: (name, identifier)
+            for pk, name, identifier in (Hospital.objects.
+                                         filter(pk__in=hospital_ids).
+                                         values_list('pk', 'name', 'identifier'))}
+
+
+def get_row(width, participant, hospital):
+    health_fund, accept_on = participant
+    name, identifier = hospital
+    row = [''] * width
+    row[0:len(HEADER)] = [health_fund, name, identifier, '', '', accept_on]
+    return row
+
+
+def iter_rows(survey, columns=None, groups=None, health_fund=None):
+    """
+    Yields rows of the export without the header, pivoted in Python.
+
+    ``groups`` limits rows to the given ``(hospital_id, participant_id)``,
+    ``health_fund`` to participants of the health fund.
+    """
+    columns = get_columns(survey) if columns is None else columns
+    index = {column.pk: len(HEADER) + i for i, column in enumerate(columns)}
+    width = len(HEADER) + len(columns)
+    participants = get_participants(survey, health_fund)
+    for hospital_ids in chunks(get_hospital_ids(survey, groups, health_fund), HOSPITAL_BATCH_SIZE):
+        hospitals = get_hospitals(hospital_ids)
+        answers = (filter_answers(survey, hospital_ids, groups, health_fund).
+                   order_by('hospital_id', 'participant_id').
+                   values_list('hospital_id', 'participant_id', 'subquestion_id', 'answer').
+                   iterator())
+        for (hospital_id, participant_id), group in groupby(answers, lambda x: x[:2]):
+            if groups is not None and (hospital_id, participant_id) not in groups:
+                continue
+            row = get_row(width, participants[participant_id], hospitals[hospital_id])
+            for _, _, subquestion_id, answer in group:
+                column = index.get(subquestion_id)
+                if column is not None:
+                    row[column] = answer
+            yield row
+
+
+def iter_rows_sql(survey, columns=None, groups=None, health_fund=None):
+    """
+    Yields rows of the export without the header, pivoted in the database.
+
+    Every batch of hospitals is read with one grouped query per batch of
+    columns, each column is a ``MAX(CASE WHEN subquestion = pk THEN answer END)``.
+    """
+    columns = get_columns(survey) if columns is None else columns
+    width = len(HEADER) + len(columns)
+    participants = get_participants(survey, health_fund)
+    for hospital_ids in chunks(get_hospital_ids(survey, groups, health_fund), HOSPITAL_BATCH_SIZE):
+        hospitals = get_hospitals(hospital_ids)
+        qs = (filter_answers(survey, hospital_ids, groups, health_fund).
+              values('hospital_id', 'participant_id').
+              order_by('hospital_id', 'participant_id'))
+        rows = OrderedDict()
+        for offset in range(0, max(len(columns), 1), COLUMN_BATCH_SIZE):
+            batch = columns[offset:offset + COLUMN_BATCH_SIZE]
+            aggregates = {'c{0}'.format(i): Max(Case(When(subquestion_id=column.pk, then=F('answer'))))
+                          for i, column in enumerate(batch)}
+            for group in qs.annotate(**aggregates):
+                key = (group['hospital_id'], group['participant_id'])
+                if groups is not None and key not in groups:
+                    continue
+                if key not in rows:
+                    rows[key] = get_row(width, participants[key[1]], hospitals[key[0]])
+                row = rows[key]
+                for i in range(len(batch)):
+                    value = group['c{0}'.format(i)]
+                    if value is not None:
+                        row[len(HEADER) + offset + i] = value
+        for row in rows.values():
+            yield row
+
+
+ENGINES = {'python': iter_rows,
+           'sql': iter_rows_sql}
+
+
+def get_engine(engine=None):
+    return ENGINES[engine or getattr(settings, 'SURVEY_EXPORT_ENGINE', 'sql')]
+
+
+def iter_csv(survey, engine=None, groups=None, health_fund=None, subquestions=None, categories=None):
+    """
+    Yields lines of the CSV export of the survey.
+
+    ``engine`` is a key of ``ENGINES``, by default ``SURVEY_EXPORT_ENGINE``.
+    ``groups`` limits rows as returned by ``get_changes``, ``health_fund`` to
+    participants of the health fund. ``subquestions`` and ``categories``
+    project columns, see ``get_columns``.
+    """
+    writer = csv.writer(Echo())
+    columns = get_columns(survey, subquestions, categories)
+    yield writer.writerow(get_fieldnames(columns))
+    for row in get_engine(engine)(survey, columns, groups, health_fund):
+        # Participants not accepted yet keep "None" of the original layout
+        row[ACCEPT_ON] = str(row[ACCEPT_ON])
+        yield writer.writerow(row)
+
+
+def get_flag_name(column):
+    return '{0}:missing'.format(column.name)
+
+
+def is_numeric(column):
+    return column.kind in (Subquestion.KIND_INT, Subquestion.KIND_VINT)
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def get_typed_fieldnames(columns):
+    """
+    Returns names of typed fields, numbers with missing data get a flag field.
+    """
+    fieldnames = list(HEADER)
+    for column in columns:
+        fieldnames.append(column.name)
+        if column.kind == Subquestion.KIND_VINT:
+            fieldnames.append(get_flag_name(column))
+    return fieldnames
+
+
+def get_typed_values(row, columns):
+    """
+    Converts answers of a row to values of ``get_typed_fieldnames``.
+
+    Numbers become ``int``, missing answers and missing data of ``KIND_VINT``
+    become ``None`` with the flag set for missing data.
+    """
+    values = [value or None for value in row[:len(HEADER)]]
+    accept_on = row[ACCEPT_ON]
+    values[ACCEPT_ON] = None if accept_on is None else str(accept_on)
+    for column, value in zip(columns, row[len(HEADER):]):
+        if is_numeric(column):
+            values.append(to_int(value) if value else None)
+        else:
+            values.append(value if value else None)
+        if column.kind == Subquestion.KIND_VINT:
+            values.append(value in Subquestion.MISSING_DATA)
+    return values
+
+
+def iter_typed_rows(survey, engine=None, health_fund=None, subquestions=None, categories=None):
+    """
+    Yields fieldnames and then rows of typed values of the survey.
+    """
+    columns = get_columns(survey, subquestions, categories)
+    yield get_typed_fieldnames(columns)
+    for row in get_engine(engine)(survey, columns, None, health_fund):
+        yield get_typed_values(row, columns)
+
+
+def iter_jsonl(survey, **kwargs):
+    """
+    Yields JSON Lines of the survey with an object of typed values per row.
+
+    Takes the arguments of ``iter_typed_rows``.
+    """
+    rows = iter_typed_rows(survey, **kwargs)
+    fieldnames = next(rows)
+    for values in rows:
+        yield json.dumps(OrderedDict(zip(fieldnames, values)), ensure_ascii=False) + '\n'
+
+
+def write_parquet(survey, path, batch_size=PARQUET_BATCH_SIZE, **kwargs):
+    """
+    Writes typed values of the survey to a Parquet file in row groups of ``batch_size``.
+
+    Requires ``pyarrow``. Takes the arguments of ``iter_typed_rows``.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImproperlyConfigured("Parquet export requires pyarrow to be installed.")
+    columns = get_columns(survey, kwargs.get('subquestions'), kwargs.get('categories'))
+    types = [pyarrow.string()] * len(HEADER)
+    for column in columns:
+        types.append(pyarrow.int64() if is_numeric(column) else pyarrow.string())
+        if column.kind == Subquestion.KIND_VINT:
+            types.append(pyarrow.bool_())
+    rows = iter_typed_rows(survey, **kwargs)
+    schema = pyarrow.schema([pyarrow.field(name, type) for name, type in zip(next(rows), types)])
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            arrays = [pyarrow.array(values, type=type) for values, type in zip(zip(*batch), types)]
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+
+FORMATS = {'csv': 'text/csv',
+           'jsonl': 'application/x-ndjson'}
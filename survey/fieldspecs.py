@@ -0,0 +1,91 @@
+"""
+Compiled fields of survey forms.
+
+Forms of a participant have a field per hospital and subquestion, so building
+every field with its own widget and validators costs tens of thousands of
+objects per request. ``compile_fields`` builds a table of ``FieldSpec`` once
+per structure version of the survey and roster of hospitals, ``build_fields``
+instantiates fields from it as shallow clones of a prototype field per kind of
+subquestion. Clones share the widget, validators and error messages of their
+prototype, which must not be modified in place.
+"""
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+CACHE_SIZE = getattr(settings, 'SURVEY_FIELD_CACHE_SIZE', 256)
+
+FieldSpec = namedtuple('FieldSpec', ['key', 'label', 'kind', 'hospital_id', 'subquestion_id'])
+
+_local_cache = {}
+
+
+def get_field_key(hospital_id, subquestion_id):
+    if hospital_id is None:
+        return 'sq-{subquestion}'.format(subquestion=subquestion_id)
+    return 'h-{hospital}-sq-{subquestion}'.format(hospital=hospital_id, subquestion=subquestion_id)
+
+
+def parse_field_key(key):
+    """
+    Returns ``(hospital_id, subquestion_id)`` of a key of ``get_field_key``.
+    """
+    parts = key.split('-')
+    if len(parts) == 2:
+        return None, int(parts[1])
+    return int(parts[1]), int(parts[3])
+
+
+def get_subquestions(structure, question_id=None, category_id=None):
+    if question_id is not None:
+        return structure.questions[question_id].subquestions
+    return [subquestion
+            for question in structure.iter_questions()
+            if category_id is None or question.category_id == category_id
+            for subquestion in question.subquestions]
+
+
+def compile_fields(structure, hospital_ids=None, question_id=None, category_id=None):
+    """
+    Returns a tuple of ``FieldSpec`` for subquestions of the structure and hospitals.
+
+    Without ``hospital_ids`` fields are keyed by subquestion only, as in a form
+    of a single hospital. ``question_id`` or ``category_id`` limit fields to
+    subquestions of one question or category.
+    """
+    hospital_ids = None if hospital_ids is None else tuple(hospital_ids)
+    key = (structure.survey_id, structure.version, hospital_ids, question_id, category_id)
+    specs = _local_cache.get(key)
+    if specs is not None:
+        return specs
+    subquestions = get_subquestions(structure, question_id, category_id)
+    specs = tuple(FieldSpec(get_field_key(hospital_id, subquestion.pk), subquestion.name, subquestion.kind,
+                            hospital_id, subquestion.pk)
+                  for subquestion in subquestions
+                  for hospital_id in ((None, ) if hospital_ids is None else hospital_ids))
+    if len(_local_cache) >= CACHE_SIZE:
+        _local_cache.clear()
+    _local_cache[key] = specs
+    return specs
+
+
+def clone_field(prototype, label, initial):
+    field = prototype.__class__.__new__(prototype.__class__)
+    field.__dict__.update(prototype.__dict__)
+    field.label = label
+    field.initial = initial
+    return field
+
+
+def build_fields(specs, prototypes, initial):
+    """
+    Returns an ordered mapping of keys to fields of the specs.
+
+    ``prototypes`` maps kinds of subquestions to fields, ``initial`` maps
+    ``(hospital_id, subquestion_id)`` to answers.
+    """
+    fields = OrderedDict()
+    for spec in specs:
+        fields[spec.key] = clone_field(prototypes[spec.kind], spec.label,
+                                       initial.get((spec.hospital_id, spec.subquestion_id), ''))
+    return fields
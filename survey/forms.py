@@ -1,16 +1,20 @@
-from collections import namedtuple
+from collections import OrderedDict
 
-from ankieta_nfz.users.models import User
 from django import forms
-from django.conf import settings
-from django.core.mail import send_mail
-from django.db.models import F
-from django.template.loader import render_to_string
+from django.utils.encoding import force_text
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext as _
+from django.utils.translation import ugettext_lazy
 from django.core.exceptions import ValidationError
-from .models import Answer, Hospital, Participant, Subquestion
-
-Group = namedtuple('Group', ['obj', 'set'])
+from .answers import upsert_answers
+from .fieldspecs import (build_fields, compile_fields, get_field_key,
+                         parse_field_key)
+from .mail import get_staff_recipients
+from .models import Answer, Group, Notification, Subquestion
+from .notifications import enqueue
+from .structure import get_structure
+from .uploads import (check_rows, drop_stashed_rows, get_diff,
+                      get_stashed_rows, read_upload, stash_rows)
 
 
 class values_or_integer_validator(object):
@@ -41,66 +45,122 @@ class values_or_integer_validator(object):
             raise ValidationError(self.get_message(value), code=self.code)
 
 
+# Fields of forms are cloned from these, see survey.fieldspecs
+PROTOTYPES = {
+    Subquestion.KIND_INT: forms.IntegerField(),
+    Subquestion.KIND_TEXT: forms.CharField(),
+    Subquestion.KIND_LTEXT: forms.CharField(widget=forms.widgets.Textarea()),
+    Subquestion.KIND_VINT: forms.CharField(validators=[values_or_integer_validator(Subquestion.MISSING_DATA)]),
+}
+
+
 class FieldMixin(object):
 
-    def get_field(self, subquestion, *args, **kwargs):
-        if subquestion.kind == Subquestion.KIND_INT:
-            return forms.IntegerField(label=subquestion.name,
-                                      initial=self.get_initial(subquestion, *args, **kwargs))
-        if subquestion.kind == Subquestion.KIND_TEXT:
-            return forms.CharField(label=subquestion.name,
-                                   initial=self.get_initial(subquestion, *args, **kwargs))
-        if subquestion.kind == Subquestion.KIND_LTEXT:
-            return forms.CharField(label=subquestion.name,
-                                   initial=self.get_initial(subquestion, *args, **kwargs),
-                                   widget=forms.widgets.Textarea())
-        if subquestion.kind == Subquestion.KIND_VINT:
-            return forms.CharField(label=subquestion.name,
-                                   initial=self.get_initial(subquestion, *args, **kwargs),
-                                   validators=[values_or_integer_validator(['b/d', 'brak danych'])])
+    def get_category_id(self):
+        return self.category.pk if self.category else None
 
     def get_recipient(self):
-        recipients = [x.email for x in User.objects.filter(is_staff=True, notification=True).all()
-                      if x.email]
+        recipients = list(get_staff_recipients())
         if not self.user.is_staff and self.participant.health_fund.email:
             recipients += [self.participant.health_fund.email, ]
         return recipients
 
 
-class SurveyForm(FieldMixin, forms.Form):
+class ChangedFieldsMixin(object):
+    """
+    Cleans and saves only fields whose submitted value differs from the initial answer.
+
+    A POST may list comma-separated keys of edited fields in ``manifest_field``.
+    Listed fields are compared as answers, the others only as raw strings, so
+    an edit missed by the client is still saved and saving costs time mostly
+    proportional to the edit instead of the size of the grid. Required fields
+    without an answer are validated even if untouched.
+    """
+    manifest_field = 'changed'
+
+    def get_value(self, name):
+        return self.fields[name].widget.value_from_datadict(self.data, self.files, self.add_prefix(name))
+
+    def field_has_changed(self, name):
+        field = self.fields[name]
+        try:
+            return field.to_python(field.initial) != field.to_python(self.get_value(name))
+        except ValidationError:
+            return True
+
+    def field_differs(self, name):
+        value, initial = self.get_value(name), self.fields[name].initial
+        return force_text('' if value is None else value) != force_text('' if initial is None else initial)
+
+    @cached_property
+    def changed_data(self):
+        if not self.is_bound:
+            return []
+        manifest = self.data.get(self.manifest_field)
+        listed = set(self.fields) if manifest is None else set(manifest.split(','))
+        return [name for name in self.fields
+                if (name in listed or self.field_differs(name)) and self.field_has_changed(name)]
+
+    def get_unanswered_required(self):
+        changed = set(self.changed_data)
+        return [name for name, field in self.fields.items()
+                if field.required and name not in changed and field.initial in field.empty_values]
+
+    def _clean_fields(self):
+        for name in self.changed_data + self.get_unanswered_required():
+            try:
+                self.cleaned_data[name] = self.fields[name].clean(self.get_value(name))
+            except ValidationError as e:
+                self.add_error(name, e)
+
+    def get_changed_rows(self, hospital_id=None):
+        """
+        Returns ``(hospital_id, subquestion_id, answer)`` of changed fields.
+
+        ``hospital_id`` is used for keys of a single hospital.
+        """
+        rows = []
+        for name in self.changed_data:
+            key_hospital_id, subquestion_id = parse_field_key(name)
+            rows.append((hospital_id if key_hospital_id is None else key_hospital_id,
+                         subquestion_id,
+                         self.cleaned_data[name]))
+        return rows
+
+
+class SurveyForm(FieldMixin, ChangedFieldsMixin, forms.Form):
 
     def __init__(self, *args, **kwargs):
         self.participant = kwargs.pop('participant')
         self.hospital = kwargs.pop('hospital')
         self.user = kwargs.pop('user', None)
+        self.category = kwargs.pop('category', None)
 
         self.survey = self.participant.survey
+        self.structure = get_structure(self.survey)
+        self.categories = [self.category] if self.category else self.structure.categories
 
-        answer_qs = Answer.objects.filter(participant=self.participant,
-                                          hospital=self.hospital).all()
-        self.initial_sq = {x.subquestion_id: x.answer for x in answer_qs}
+        answers = Answer.objects.filter(participant=self.participant, hospital=self.hospital)
+        if self.category:
+            answers = answers.filter(subquestion__question__category=self.category.pk)
+        self.existing = answers.as_existing()
+        self.initial_sq = {subquestion_id: answer for (_, subquestion_id), (_, answer) in self.existing.items()}
 
         super(SurveyForm, self).__init__(*args, **kwargs)
-        for category in self.survey.category_set.all():
-            for question in category.question_set.all():
-                for subquestion in question.subquestion_set.all():
-                    key = self.get_key(subquestion)
-                    field = self.get_field(subquestion)
-                    self.fields[key] = field
-
-    def get_initial(self, subquestion):
-        return self.initial_sq.get(subquestion.pk, '')
+        self.fields.update(build_fields(compile_fields(self.structure, category_id=self.get_category_id()),
+                                        PROTOTYPES,
+                                        {(None, pk): answer for pk, answer in self.initial_sq.items()}))
 
     def get_key(self, subquestion):
-        return 'sq-{subquestion}'.format(subquestion=subquestion.pk)
+        return get_field_key(None, subquestion.pk)
 
     def grouped_fields(self):
         output = []
-        for category in self.survey.category_set.all():
+        for category in self.categories:
             question_set = []
-            for question in category.question_set.all():
+            for question in category.questions:
                 subquestion_set = []
-                for subquestion in question.subquestion_set.all():
+                for subquestion in question.subquestions:
                     field = self[self.get_key(subquestion)]
                     subquestion_set.append((subquestion, field))
                 question_set.append(Group(question, subquestion_set))
@@ -108,104 +168,59 @@ class SurveyForm(FieldMixin, forms.Form):
         return output
 
     def save_model(self):
-        self.objs = []
-        self.createds = []
-        for category in self.survey.category_set.all():
-            for question in category.question_set.all():
-                for subquestion in question.subquestion_set.all():
-                    obj, created = Answer.objects.update_or_create(
-                        participant=self.participant,
-                        subquestion=subquestion,
-                        hospital=self.hospital,
-                        defaults={'answer': self.cleaned_data[self.get_key(subquestion)]},
-                    )
-                    self.objs.append(obj)
-                    self.createds.append(created)
+        self.result = upsert_answers(self.participant, self.get_changed_rows(self.hospital.pk),
+                                     existing=self.existing)
 
     def send_notification(self):
-        recipients = self.get_recipient()
-        if not recipients:
-            return
-
-        output = []
-        index = 0
-        for category in self.survey.category_set.all():
-            question_set = []
-            for question in category.question_set.all():
-                subquestion_set = []
-                for subquestion in question.subquestion_set.all():
-                    field = [self.objs[index], self.createds[index]]
-                    subquestion_set.append(Group(subquestion, field))
-                    index += 1
-                question_set.append(Group(question, subquestion_set))
-            output.append(Group(category, question_set))
-        linked_list = (Hospital.objects.
-                       answer_fetch(self.participant).
-                       linked(participant=self.participant.pk,
-                              password=self.participant.password))
-        linked_list_left = [x for x in linked_list if x.status is not True]
-        linked_done = len(linked_list_left)
-        linked_total = len(linked_list)
-        linked_left = linked_total - linked_done
-        context = {'object_list': output,
-                   'linked_list': linked_list,
-                   'linked_list_left': linked_list_left,
-                   'linked_done': linked_done,
-                   'linked_total': linked_total,
-                   'linked_left': linked_left,
-                   'hospital': self.hospital,
-                   'participant': self.participant}
-        content = render_to_string('survey/survey_email.html', context)
-
-        return send_mail(
-            _('Answer confirmation'),
-            content,
-            settings.DEFAULT_FROM_EMAIL,
-            recipients,
-            fail_silently=False,
-        )
+        return enqueue(self.participant,
+                       Notification.KIND.hospital,
+                       self.get_recipient(),
+                       hospital=self.hospital,
+                       changes=self.result.modified)
 
     def save(self):
         self.save_model()
         self.send_notification()
-        return self.objs
+        return self.result
 
 
-class ParticipantForm(FieldMixin, forms.Form):
+class ParticipantForm(FieldMixin, ChangedFieldsMixin, forms.Form):
 
     def __init__(self, *args, **kwargs):
         self.participant = kwargs.pop('participant')
         self.user = kwargs.pop('user', None)
+        self.category = kwargs.pop('category', None)
+        hospitals = kwargs.pop('hospitals', None)
 
         self.survey = self.participant.survey
-        self.hospitals = self.participant.health_fund.hospital_set.all()
-        self.answer_qs = Answer.objects.filter(participant=self.participant).all()
-        self.initial_sq = {(x.hospital_id, x.subquestion_id): x.answer
-                           for x in self.answer_qs}
+        self.structure = get_structure(self.survey)
+        self.categories = [self.category] if self.category else self.structure.categories
+        answers = Answer.objects.filter(participant=self.participant)
+        if hospitals is None:
+            self.hospitals = list(self.participant.health_fund.hospital_set.all())
+        else:
+            self.hospitals = list(hospitals)
+            answers = answers.filter(hospital__in=[x.pk for x in self.hospitals])
+        if self.category:
+            answers = answers.filter(subquestion__question__category=self.category.pk)
+        self.existing = answers.as_existing()
+        self.initial_sq = {key: answer for key, (_, answer) in self.existing.items()}
 
         super(ParticipantForm, self).__init__(*args, **kwargs)
-        for category in self.survey.category_set.all():
-            for question in category.question_set.all():
-                for subquestion in question.subquestion_set.all():
-                    for hospital in self.hospitals:
-                        key = self.get_key(hospital, subquestion)
-                        field = self.get_field(subquestion=subquestion,
-                                               hospital=hospital)
-                        self.fields[key] = field
+        self.fields.update(build_fields(compile_fields(self.structure, [x.pk for x in self.hospitals],
+                                                       category_id=self.get_category_id()),
+                                        PROTOTYPES,
+                                        self.initial_sq))
 
     def get_key(self, hospital, subquestion):
-        return 'h-{hospital}-sq-{subquestion}'.format(hospital=hospital.pk,
-                                                      subquestion=subquestion.pk)
-
-    def get_initial(self, subquestion, hospital):
-        return self.initial_sq.get((hospital.id, subquestion.id), '')
+        return get_field_key(hospital.pk, subquestion.pk)
 
     def grouped_fields(self):
         output = []
-        for category in self.survey.category_set.all():
+        for category in self.categories:
             question_set = []
-            for question in category.question_set.all():
-                subquestion_set = [x for x in question.subquestion_set.all()]
+            for question in category.questions:
+                subquestion_set = question.subquestions
                 hospital_set = []
                 for hospital in self.hospitals:
                     hospitalsubquestion_set = []
@@ -220,104 +235,52 @@ class ParticipantForm(FieldMixin, forms.Form):
         return output
 
     def send_notification(self):
-        recipients = self.get_recipient()
-        if not recipients:
-            return
-
-        output = []
-        answers = {(x.hospital_id, x.subquestion_id): x
-                   for x in Answer.objects.filter(participant=self.participant).all()}
-
-        for category in self.survey.category_set.all():
-            question_set = []
-            for question in category.question_set.all():
-                subquestions = [x for x in question.subquestion_set.all()]
-
-                subquestion_set = []
-                for subquestion in subquestions:
-                    answer_set = []
-                    for hospital in self.hospitals:
-                        data = answers[(hospital.pk, subquestion.pk)].answer
-                        answer_set.append((hospital, data))
-                    subquestion_set.append(Group(subquestion, answer_set))
-
-                question_set.append((question, subquestion_set))
-            output.append(Group(category, question_set))
-        context = {'object_list': output,
-                   'participant': self.participant}
-        content = render_to_string('survey/participant_email.html', context)
-        return send_mail(
-            _('Answer confirmation'),
-            content,
-            settings.DEFAULT_FROM_EMAIL,
-            recipients,
-            fail_silently=False,
-        )
+        return enqueue(self.participant,
+                       Notification.KIND.participant,
+                       self.get_recipient(),
+                       changes=self.result.modified)
 
     def save_model(self):
-        self.objs = []
-        self.createds = []
-        to_bulk_create = []
-
-        answers = {(x.hospital_id, x.subquestion_id): x
-                   for x in Answer.objects.filter(participant=self.participant).all()}
-        for category in self.survey.category_set.all():
-            for question in category.question_set.all():
-                for subquestion in question.subquestion_set.all():
-                    for hospital in self.participant.health_fund.hospital_set.all():
-                        data = self.cleaned_data[self.get_key(hospital, subquestion)]
-                        try:
-                            a = answers[(hospital.pk, subquestion.pk)]
-                            if a.answer != str(data):  # if any changes
-                                a.answer = data
-                                a.save()
-                        except KeyError:
-                            to_bulk_create.append(Answer(participant=self.participant,
-                                                         subquestion=subquestion,
-                                                         hospital=hospital,
-                                                         answer=data))
-        Participant.objects.filter(pk=self.participant.pk).update(answer_count=F('answer_count') +
-                                                                  len(to_bulk_create))
-        Answer.objects.bulk_create(to_bulk_create)
+        self.result = upsert_answers(self.participant, self.get_changed_rows(), existing=self.existing)
 
     def save(self):
         self.save_model()
         self.send_notification()
+        return self.result
 
 
-class QuestionForm(FieldMixin, forms.Form):
+class QuestionForm(FieldMixin, ChangedFieldsMixin, forms.Form):
 
     def __init__(self, *args, **kwargs):
         self.participant = kwargs.pop('participant')
         self.user = kwargs.pop('user', None)
-        self.question = kwargs.pop('question')
+        question = kwargs.pop('question')
+        hospitals = kwargs.pop('hospitals', None)
 
         self.survey = self.participant.survey
-        self.hospitals = self.participant.health_fund.hospital_set.all()
-        self.answer_qs = Answer.objects.filter(participant=self.participant,
-                                               subquestion__question=self.question).all()
-        self.initial_sq = {(x.hospital_id, x.subquestion_id): x
-                           for x in self.answer_qs}
+        self.structure = get_structure(self.survey)
+        self.question = self.structure.questions[question.pk]
+        answers = Answer.objects.filter(participant=self.participant,
+                                        subquestion__question=self.question.pk)
+        if hospitals is None:
+            self.hospitals = list(self.participant.health_fund.hospital_set.all())
+        else:
+            self.hospitals = list(hospitals)
+            answers = answers.filter(hospital__in=[x.pk for x in self.hospitals])
+        self.existing = answers.as_existing()
+        self.initial_sq = {key: answer for key, (_, answer) in self.existing.items()}
 
         super(QuestionForm, self).__init__(*args, **kwargs)
-        for subquestion in self.question.subquestion_set.all():
-            for hospital in self.hospitals:
-                key = self.get_key(hospital, subquestion)
-                field = self.get_field(subquestion=subquestion,
-                                       hospital=hospital)
-                self.fields[key] = field
+        self.fields.update(build_fields(compile_fields(self.structure, [x.pk for x in self.hospitals],
+                                                       question_id=self.question.pk),
+                                        PROTOTYPES,
+                                        self.initial_sq))
 
     def get_key(self, hospital, subquestion):
-        return 'h-{hospital}-sq-{subquestion}'.format(hospital=hospital.pk,
-                                                      subquestion=subquestion.pk)
-
-    def get_initial(self, subquestion, hospital):
-        if (hospital.id, subquestion.id) in self.initial_sq:
-            return self.initial_sq[(hospital.id, subquestion.id)].answer
-        return ''
+        return get_field_key(hospital.pk, subquestion.pk)
 
     def grouped_fields(self):
-        subquestion_set = [x for x in self.question.subquestion_set.all()]
+        subquestion_set = self.question.subquestions
         hospital_set = []
         for hospital in self.hospitals:
             hospitalsubquestion_set = []
@@ -328,57 +291,121 @@ class QuestionForm(FieldMixin, forms.Form):
         return hospital_set
 
     def send_notification(self):
-        recipients = self.get_recipient()
-        if not recipients:
-            return
-        answers = {(x.hospital_id, x.subquestion_id): x
-                   for x in Answer.objects.filter(participant=self.participant).all()}
-        subquestions = [x for x in self.question.subquestion_set.all()]
-
-        subquestion_set = []
-        for subquestion in subquestions:
-            answer_set = []
-            for hospital in self.hospitals:
-                data = answers[(hospital.pk, subquestion.pk)].answer
-                answer_set.append((hospital, data))
-            subquestion_set.append(Group(subquestion, answer_set))
-
-        context = {'participant': self.participant,
-                   'category': self.question.category,
-                   'survey': self.survey,
-                   'question': self.question,
-                   'subquestion_set': subquestion_set}
-        content = render_to_string('survey/question_email.html', context)
-
-        return send_mail(
-            _('Answer confirmation'),
-            content,
-            settings.DEFAULT_FROM_EMAIL,
-            recipients,
-            fail_silently=False,
-        )
+        return enqueue(self.participant,
+                       Notification.KIND.question,
+                       self.get_recipient(),
+                       question=self.question,
+                       changes=self.result.modified)
 
     def save_model(self):
-        to_bulk_create = []
-        answers = {(x.hospital_id, x.subquestion_id): x for x in self.answer_qs}
-
-        for subquestion in self.question.subquestion_set.all():
-            for hospital in self.hospitals:
-                data = self.cleaned_data[self.get_key(hospital, subquestion)]
-                try:
-                    a = answers[(hospital.pk, subquestion.pk)]
-                    if a.answer != str(data):  # if any changes
-                        a.answer = data
-                        a.save()
-                except KeyError:
-                    to_bulk_create.append(Answer(participant=self.participant,
-                                                 subquestion=subquestion,
-                                                 hospital=hospital,
-                                                 answer=data))
-        Participant.objects.filter(pk=self.participant.pk).update(answer_count=F('answer_count') +
-                                                                  len(to_bulk_create))
-        Answer.objects.bulk_create(to_bulk_create)
+        self.result = upsert_answers(self.participant, self.get_changed_rows(), existing=self.existing)
 
     def save(self):
         self.save_model()
         self.send_notification()
+        return self.result
+
+
+class AutosaveForm(FieldMixin):
+    """
+    Validates a batch of cells ``{"hospital": pk, "subquestion": pk, "value": answer}``
+    of the participant with the fields of ``PROTOTYPES`` and saves the valid ones.
+
+    Malformed batches raise ``ValidationError`` in ``is_valid``, errors of
+    single cells are collected in ``errors`` as ``(hospital, subquestion, messages)``.
+    """
+    max_cells = 1000
+
+    def __init__(self, cells, participant, user=None):
+        self.cells = cells
+        self.participant = participant
+        self.user = user
+        self.structure = get_structure(self.participant.survey)
+        self.rows = OrderedDict()
+        self.errors = []
+
+    def is_valid(self):
+        if not isinstance(self.cells, list) or len(self.cells) > self.max_cells:
+            raise ValidationError(_("Expected a list of at most {count} cells.").format(count=self.max_cells))
+        hospital_ids = set(self.participant.health_fund.hospital_set.values_list('pk', flat=True))
+        for cell in self.cells:
+            try:
+                hospital_id, subquestion_id, value = int(cell['hospital']), int(cell['subquestion']), cell['value']
+            except (KeyError, TypeError, ValueError):
+                raise ValidationError(_("Every cell requires a hospital, a subquestion and a value."))
+            subquestion = self.structure.subquestions.get(subquestion_id)
+            if hospital_id not in hospital_ids or subquestion is None or subquestion.kind not in PROTOTYPES:
+                self.errors.append((hospital_id, subquestion_id, [_("Unknown hospital or subquestion.")]))
+                continue
+            try:
+                self.rows[(hospital_id, subquestion_id)] = PROTOTYPES[subquestion.kind].clean(value)
+            except ValidationError as e:
+                self.errors.append((hospital_id, subquestion_id, e.messages))
+        return not self.errors
+
+    def send_notification(self):
+        return enqueue(self.participant,
+                       Notification.KIND.participant,
+                       self.get_recipient(),
+                       changes=self.result.modified)
+
+    def save(self):
+        self.result = upsert_answers(self.participant,
+                                     [(hospital_id, subquestion_id, value)
+                                      for (hospital_id, subquestion_id), value in self.rows.items()])
+        if self.result.modified:
+            self.send_notification()
+        return self.result
+
+
+class UploadForm(FieldMixin, forms.Form):
+    """
+    Reads a file of answers in the layout of the export for a dry run, which
+    stashes the valid rows under a ``token``. Submitting the token saves them.
+    """
+    file = forms.FileField(label=ugettext_lazy("File"),
+                           help_text=ugettext_lazy("CSV or XLSX file in the layout of the export."),
+                           required=False)
+    token = forms.CharField(widget=forms.HiddenInput(), required=False)
+
+    def __init__(self, *args, **kwargs):
+        self.participant = kwargs.pop('participant')
+        self.user = kwargs.pop('user', None)
+        self.structure = get_structure(self.participant.survey)
+        self.upload = None
+        self.rows = []
+        super(UploadForm, self).__init__(*args, **kwargs)
+
+    def clean(self):
+        cleaned_data = super(UploadForm, self).clean()
+        token = cleaned_data.get('token')
+        upload = cleaned_data.get('file')
+        if token:
+            self.rows = get_stashed_rows(self.participant, token)
+            if self.rows is None:
+                raise ValidationError(_("The upload has expired, send the file again."))
+            check_rows(self.participant, self.structure, self.rows)
+        elif upload:
+            self.upload = read_upload(upload, upload.name, self.participant, self.structure)
+            self.rows = self.upload.rows
+            self.diff = get_diff(self.participant, self.rows)
+            cleaned_data['token'] = stash_rows(self.participant, self.rows)
+        else:
+            raise ValidationError(_("Choose a file to upload."))
+        return cleaned_data
+
+    def is_dry_run(self):
+        return self.upload is not None
+
+    def send_notification(self):
+        return enqueue(self.participant,
+                       Notification.KIND.participant,
+                       self.get_recipient(),
+                       changes=self.result.modified)
+
+    def save(self):
+        self.result = upsert_answers(self.participant, self.rows)
+        drop_stashed_rows(self.participant, self.cleaned_data['token'])
+        if self.result.modified:
+            self.send_notification()
+        return self.result
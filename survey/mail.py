@@ -0,0 +1,131 @@
+"""
+Sending of survey e-mails over a persistent connection.
+
+Every thread keeps one open connection of the e-mail backend and reuses it for
+all messages, so a burst of notifications pays the connection and TLS
+handshake once. The list of staff recipients is cached and invalidated whenever
+a user changes. Counts and latencies of sending are collected in ``stats``.
+"""
+import logging
+import threading
+import time
+from smtplib import SMTPServerDisconnected
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import get_connection
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+RECIPIENTS_CACHE_KEY = 'survey-staff-recipients'
+RECIPIENTS_CACHE_TIMEOUT = getattr(settings, 'SURVEY_RECIPIENTS_CACHE_TIMEOUT', 60 * 60)
+
+_state = threading.local()
+
+
+class MailStats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.sent = 0
+            self.failed = 0
+            self.connections = 0
+            self.total_time = 0.0
+            self.max_time = 0.0
+
+    def record(self, seconds, failed=False):
+        with self.lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.sent += 1
+            self.total_time += seconds
+            self.max_time = max(self.max_time, seconds)
+
+    def record_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def as_dict(self):
+        with self.lock:
+            count = self.sent + self.failed
+            return {'sent': self.sent,
+                    'failed': self.failed,
+                    'connections': self.connections,
+                    'avg_time': self.total_time / count if count else 0.0,
+                    'max_time': self.max_time}
+
+
+stats = MailStats()
+
+
+def get_staff_recipients():
+    """
+    Returns e-mails of staff users subscribed to notifications.
+    """
+    recipients = cache.get(RECIPIENTS_CACHE_KEY)
+    if recipients is None:
+        from ankieta_nfz.users.models import User
+        recipients = list(User.objects.filter(is_staff=True, notification=True).
+                          exclude(email='').
+                          values_list('email', flat=True))
+        cache.set(RECIPIENTS_CACHE_KEY, recipients, RECIPIENTS_CACHE_TIMEOUT)
+    return recipients
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_staff_recipients(**kwargs):
+    cache.delete(RECIPIENTS_CACHE_KEY)
+
+
+def get_mail_connection(backend=None):
+    """
+    Returns the open connection of the current thread, opening it when needed.
+    """
+    connection = getattr(_state, 'connection', None)
+    if connection is None or getattr(_state, 'backend', None) != backend:
+        close_mail_connection()
+        connection = get_connection(backend, fail_silently=False)
+        connection.open()
+        stats.record_connection()
+        _state.connection = connection
+        _state.backend = backend
+    return connection
+
+
+def close_mail_connection():
+    connection = getattr(_state, 'connection', None)
+    _state.connection = None
+    if connection is not None:
+        try:
+            connection.close()
+        except Exception as e:
+            logger.debug("Closing of mail connection failed: %s", e)
+
+
+def send_message(message, backend=None):
+    """
+    Sends ``EmailMessage`` over the connection of the current thread.
+
+    A connection dropped by the server is reopened once, any other error is
+    raised after the connection is closed.
+    """
+    start = time.time()
+    try:
+        try:
+            get_mail_connection(backend).send_messages([message])
+        except SMTPServerDisconnected:
+            close_mail_connection()
+            get_mail_connection(backend).send_messages([message])
+    except Exception:
+        close_mail_connection()
+        stats.record(time.time() - start, failed=True)
+        raise
+    stats.record(time.time() - start)
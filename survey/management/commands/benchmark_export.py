@@ -0,0 +1,77 @@
+import hashlib
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from survey.answers import BATCH_SIZE
+from survey.counters import suspend_counters
+from survey.exports import ENGINES, iter_csv
+from survey.models import (Answer, Category, Hospital, NationalHealtFund,
+                           Participant, Question, Subquestion, Survey)
+
+
+class Command(BaseCommand):
+    help = ("Compares export engines on a synthetic survey. "
+            "The data are created in a transaction which is rolled back afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--funds', type=int, default=16,
+                            help="Number of health funds")
+        parser.add_argument('--hospitals', type=int, default=2000,
+                            help="Number of hospitals, split evenly between funds")
+        parser.add_argument('--subquestions', type=int, default=500,
+                            help="Number of subquestions")
+        parser.add_argument('--engine', action='append', dest='engines', choices=sorted(ENGINES),
+                            help="Engine to benchmark (may be repeated), by default all")
+
+    def create_survey(self, funds, hospitals, subquestions):
+        survey = Survey.objects.create(title='Benchmark')
+        with suspend_counters([survey.pk]):
+            category = Category.objects.create(survey=survey, name='Benchmark')
+            question = Question.objects.create(category=category, name='Benchmark')
+            Subquestion.objects.bulk_create(Subquestion(question=question, name='SQ-{0}'.format(i))
+                                            for i in range(subquestions))
+        subquestion_ids = list(Subquestion.objects.filter(question=question).values_list('pk', flat=True))
+        for i in range(funds):
+            fund = NationalHealtFund.objects.create(name='NFZ-{0}'.format(i),
+                                                    email='nfz-{0}@example.com'.format(i))
+            Hospital.objects.bulk_create(Hospital(health_fund=fund,
+                                                  name='Hospital-{0}-{1}'.format(i, j),
+                                                  email='hospital@example.com',
+                                                  identifier=str(j))
+                                         for j in range(hospitals // funds))
+            participant = Participant.objects.create(survey=survey, health_fund=fund)
+            answers = []
+            for hospital_id in fund.hospital_set.values_list('pk', flat=True):
+                answers += [Answer(participant=participant,
+                                   hospital_id=hospital_id,
+                                   subquestion_id=subquestion_id,
+                                   answer=str(hospital_id * subquestion_id % 97))
+                            for subquestion_id in subquestion_ids]
+                if len(answers) >= BATCH_SIZE:
+                    Answer.objects.bulk_create(answers)
+                    answers = []
+            Answer.objects.bulk_create(answers)
+        return survey
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            start = time.time()
+            survey = self.create_survey(options['funds'], options['hospitals'], options['subquestions'])
+            self.stdout.write("Created synthetic data in {0:.1f}s.".format(time.time() - start))
+            digests = {}
+            for engine in options['engines'] or sorted(ENGINES):
+                start = time.time()
+                digest = hashlib.sha1()
+                size = 0
+                for line in iter_csv(survey, engine=engine):
+                    data = line.encode('utf-8')
+                    digest.update(data)
+                    size += len(data)
+                digests[engine] = digest.hexdigest()
+                self.stdout.write("{engine}: {time:.2f}s, {size} bytes, sha1 {digest}".format(
+                    engine=engine, time=time.time() - start, size=size, digest=digests[engine]))
+            if len(set(digests.values())) > 1:
+                self.stderr.write("Outputs of engines differ!")
+            transaction.set_rollback(True)
@@ -0,0 +1,60 @@
+import copy
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from survey import fieldspecs
+from survey.forms import PROTOTYPES, ParticipantForm
+from survey.models import Participant
+
+from .benchmark_export import Command as ExportBenchmark
+
+
+def build_copied_fields(form):
+    # Baseline of a field instantiated with its own widget and validators
+    return {spec.key: copy.deepcopy(PROTOTYPES[spec.kind])
+            for spec in fieldspecs.compile_fields(form.structure, [x.pk for x in form.hospitals])}
+
+
+class Command(BaseCommand):
+    help = ("Measures construction time and memory of the participant form on a synthetic survey. "
+            "The data are created in a transaction which is rolled back afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hospitals', type=int, default=150,
+                            help="Number of hospitals of the participant")
+        parser.add_argument('--subquestions', type=int, default=400,
+                            help="Number of subquestions")
+        parser.add_argument('--repeat', type=int, default=5,
+                            help="Number of measured constructions")
+
+    def measure(self, label, func, repeat):
+        times = []
+        for _ in range(repeat):
+            tracemalloc.start()
+            start = time.time()
+            result = func()
+            times.append(time.time() - start)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        self.stdout.write("{label}: best {best:.3f}s, worst {worst:.3f}s, peak {peak:.1f} MiB".format(
+            label=label, best=min(times), worst=max(times), peak=peak / 2 ** 20))
+        return result
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            start = time.time()
+            survey = ExportBenchmark().create_survey(1, options['hospitals'], options['subquestions'])
+            participant = Participant.objects.select_related('survey', 'health_fund').get(survey=survey)
+            self.stdout.write("Created synthetic data in {0:.1f}s.".format(time.time() - start))
+            fieldspecs._local_cache.clear()
+            form = self.measure("cold form", lambda: ParticipantForm(participant=participant), 1)
+            self.stdout.write("{0} fields".format(len(form.fields)))
+            self.measure("warm form", lambda: ParticipantForm(participant=participant), options['repeat'])
+            self.measure("fields only", lambda: fieldspecs.build_fields(
+                fieldspecs.compile_fields(form.structure, [x.pk for x in form.hospitals]),
+                PROTOTYPES, form.initial_sq), options['repeat'])
+            self.measure("fields copied with widgets", lambda: build_copied_fields(form), options['repeat'])
+            transaction.set_rollback(True)
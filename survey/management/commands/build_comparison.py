@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from survey.comparisons import build_comparison, get_hospital_changes
+from survey.models import Survey
+
+
+class Command(BaseCommand):
+    help = "Compares numeric answers of a survey with a previous edition, matching hospitals by identifier."
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey', type=int, help="Current survey")
+        parser.add_argument('previous', type=int, help="Previous survey")
+        parser.add_argument('--top', type=int, default=10,
+                            help="Number of hospitals which changed most to print")
+
+    def handle(self, *args, **options):
+        surveys = Survey.objects.in_bulk([options['survey'], options['previous']])
+        for key in ('survey', 'previous'):
+            if options[key] not in surveys:
+                raise CommandError("Survey {0} does not exist".format(options[key]))
+        start = time.time()
+        comparison = build_comparison(surveys[options['survey']], surveys[options['previous']])
+        self.stdout.write("{count} answers of {comparison} were compared in {time:.1f}s.".format(
+            count=comparison.row_count, comparison=comparison, time=time.time() - start))
+        for hospital in get_hospital_changes(comparison, limit=options['top']):
+            self.stdout.write("{name} ({identifier}): {change:.0%}, {changed} of {count} answers changed".format(
+                name=hospital['hospital__name'], identifier=hospital['hospital__identifier'],
+                change=hospital['max_change'], changed=hospital['changed_count'], count=hospital['row_count']))
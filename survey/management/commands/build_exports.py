@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from survey.artifacts import build_artifact
+from survey.models import Survey
+
+
+class Command(BaseCommand):
+    help = "Builds stored CSV exports of surveys whose answers changed since the last build."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--survey', type=int, action='append', dest='surveys',
+                            help="Limit building to given survey (may be repeated)")
+        parser.add_argument('--force', action='store_true', default=False,
+                            help="Build exports even if they are up to date")
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help="Keep checking surveys instead of exiting after one pass")
+        parser.add_argument('--interval', type=float, default=60,
+                            help="Seconds to wait between passes in loop mode")
+
+    def handle(self, *args, **options):
+        while True:
+            surveys = Survey.objects.all()
+            if options['surveys']:
+                surveys = surveys.filter(pk__in=options['surveys'])
+            for survey in surveys:
+                start = time.time()
+                path, built = build_artifact(survey, force=options['force'])
+                if built:
+                    self.stdout.write("Export of {survey} was written to {path} in {time:.1f}s.".format(
+                        survey=survey, path=path, time=time.time() - start))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from survey.models import Survey
+from survey.quality import check_quality, get_changed_participant_ids
+
+
+class Command(BaseCommand):
+    help = "Detects outliers and broken quality rules in answers changed since the last check."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--survey', type=int, action='append', dest='surveys',
+                            help="Limit checking to given survey (may be repeated)")
+        parser.add_argument('--full', action='store_true', default=False,
+                            help="Check all participants, not only those with changed answers")
+
+    def handle(self, *args, **options):
+        surveys = Survey.objects.all()
+        if options['surveys']:
+            surveys = surveys.filter(pk__in=options['surveys'])
+        for survey in surveys:
+            start = time.time()
+            participant_ids = None if options['full'] else get_changed_participant_ids(survey)
+            if participant_ids == []:
+                continue
+            count = check_quality(survey, participant_ids)
+            self.stdout.write("{survey}: {count} quality issues found in {time:.1f}s.".format(
+                survey=survey, count=count, time=time.time() - start))
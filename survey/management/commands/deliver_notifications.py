@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import translation
+
+from survey.mail import close_mail_connection, stats as mail_stats
+from survey.models import Notification
+from survey.notifications import deliver_pending
+
+
+class Command(BaseCommand):
+    help = "Delivers pending answer confirmations from the notification outbox."
+    leave_locale_alone = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help="Keep polling the outbox instead of exiting after one batch")
+        parser.add_argument('--interval', type=float, default=5,
+                            help="Seconds to wait between polls in loop mode")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Number of threads sending e-mails concurrently")
+        parser.add_argument('--limit', type=int, default=100,
+                            help="Maximum number of notifications per batch")
+        parser.add_argument('--backend', default=None,
+                            help="E-mail backend, by default settings.EMAIL_BACKEND")
+
+    def handle(self, *args, **options):
+        translation.activate(settings.LANGUAGE_CODE)
+        try:
+            while True:
+                stats = deliver_pending(limit=options['limit'],
+                                        workers=options['workers'],
+                                        backend=options['backend'])
+                if stats:
+                    self.stdout.write("Delivered {sent} notifications, {failed} failed, "
+                                      "{pending} scheduled for retry.".format(
+                                          sent=stats[Notification.STATUS.sent],
+                                          failed=stats[Notification.STATUS.failed],
+                                          pending=stats[Notification.STATUS.pending]))
+                    self.stdout.write("Mail: {sent} sent, {failed} failed over {connections} connections, "
+                                      "{avg_time:.3f}s average and {max_time:.3f}s max per message.".format(
+                                          **mail_stats.as_dict()))
+                if not options['loop']:
+                    break
+                if sum(stats.values()) < options['limit']:
+                    time.sleep(options['interval'])
+        finally:
+            close_mail_connection()
@@ -0,0 +1,55 @@
+import os
+import sys
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from survey.exports import get_changes, iter_csv
+from survey.models import Survey
+
+
+def parse_since(value):
+    since = parse_datetime(value)
+    if since is None:
+        raise CommandError("Invalid date and time: {0}".format(value))
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+class Command(BaseCommand):
+    help = ("Exports rows of a survey with answers created or modified after a moment. "
+            "With --cursor-file the moment is read from the file and the new cursor written back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey', type=int, help="Survey to export")
+        parser.add_argument('--since', help="ISO 8601 date and time")
+        parser.add_argument('--cursor-file', dest='cursor_file',
+                            help="File keeping the cursor between runs")
+        parser.add_argument('--output', help="Output file, by default standard output")
+
+    def handle(self, *args, **options):
+        try:
+            survey = Survey.objects.get(pk=options['survey'])
+        except Survey.DoesNotExist:
+            raise CommandError("Survey {0} does not exist".format(options['survey']))
+        since = options['since']
+        if since is None and options['cursor_file'] and os.path.exists(options['cursor_file']):
+            with open(options['cursor_file']) as fp:
+                since = fp.read().strip()
+        since = parse_since(since) if since else datetime(1970, 1, 1, tzinfo=timezone.utc)
+        groups, cursor = get_changes(survey, since)
+        output = open(options['output'], 'w', newline='') if options['output'] else sys.stdout
+        try:
+            for line in iter_csv(survey, groups=groups):
+                output.write(line)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        if options['cursor_file']:
+            with open(options['cursor_file'], 'w') as fp:
+                fp.write(cursor.isoformat())
+        self.stderr.write("Exported {0} rows changed since {1}, cursor {2}.".format(
+            len(groups), since.isoformat(), cursor.isoformat()))
@@ -0,0 +1,110 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from survey.exports import ENGINES, iter_csv, iter_jsonl, write_parquet
+from survey.models import NationalHealtFund, Participant, Survey
+
+
+def init_worker():
+    django.setup()
+
+
+def export_shard(shard):
+    """
+    Writes one shard of the export, runs in a worker process.
+    """
+    survey_id, health_fund_id, name, directory, options = shard
+    start = time.time()
+    survey = Survey.objects.get(pk=survey_id)
+    kwargs = {'engine': options['engine'],
+              'health_fund': NationalHealtFund.objects.get(pk=health_fund_id) if health_fund_id else None,
+              'subquestions': options['subquestions'],
+              'categories': options['categories']}
+    path = os.path.join(directory, name)
+    if options['format'] == 'parquet':
+        write_parquet(survey, path, **kwargs)
+    else:
+        lines = iter_jsonl(survey, **kwargs) if options['format'] == 'jsonl' else iter_csv(survey, **kwargs)
+        with open(path, 'w', encoding='utf-8', newline='') as fp:
+            for line in lines:
+                fp.write(line)
+    size = os.path.getsize(path)
+    connections.close_all()
+    return name, path, size, time.time() - start
+
+
+class Command(BaseCommand):
+    help = "Exports surveys to a zip archive of CSV, JSON Lines or Parquet files, in parallel worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Path of the zip archive")
+        parser.add_argument('--survey', type=int, action='append', dest='surveys',
+                            help="Survey to export (may be repeated), by default all")
+        parser.add_argument('--split-funds', action='store_true', dest='split_funds', default=False,
+                            help="Write a separate file per health fund of a survey")
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help="Number of worker processes")
+        parser.add_argument('--engine', choices=sorted(ENGINES), default=None,
+                            help="Export engine, by default settings.SURVEY_EXPORT_ENGINE")
+        parser.add_argument('--format', choices=['csv', 'jsonl', 'parquet'], default='csv',
+                            help="Format of files, parquet requires pyarrow")
+        parser.add_argument('--subquestion', type=int, action='append', dest='subquestions',
+                            help="Limit columns to given subquestion (may be repeated)")
+        parser.add_argument('--category', type=int, action='append', dest='categories',
+                            help="Limit columns to subquestions of given category (may be repeated)")
+
+    def get_shards(self, surveys, split_funds, directory, options):
+        shards = []
+        for survey in surveys:
+            if not split_funds:
+                shards.append((survey.pk, None, '{0}.{1}'.format(survey.slug, options['format']),
+                               directory, options))
+                continue
+            health_funds = (Participant.objects.filter(survey=survey).
+                            order_by('health_fund_id').
+                            values_list('health_fund_id', flat=True).
+                            distinct())
+            for health_fund_id in health_funds:
+                shards.append((survey.pk, health_fund_id,
+                               '{0}-{1}.{2}'.format(survey.slug, health_fund_id, options['format']),
+                               directory, options))
+        return shards
+
+    def handle(self, *args, **options):
+        surveys = Survey.objects.all()
+        if options['surveys']:
+            surveys = surveys.filter(pk__in=options['surveys'])
+        if not surveys:
+            raise CommandError("No survey to export.")
+        directory = tempfile.mkdtemp()
+        try:
+            shard_options = {key: options[key] for key in ('engine', 'format', 'subquestions', 'categories')}
+            shards = self.get_shards(surveys, options['split_funds'], directory, shard_options)
+            # Workers must not share connections inherited from the parent process
+            connections.close_all()
+            start = time.time()
+            pool = multiprocessing.Pool(processes=max(options['processes'], 1), initializer=init_worker)
+            try:
+                results = []
+                for name, path, size, duration in pool.imap_unordered(export_shard, shards):
+                    self.stdout.write("{name}: {size} bytes in {time:.2f}s".format(
+                        name=name, size=size, time=duration))
+                    results.append((name, path))
+            finally:
+                pool.close()
+                pool.join()
+            with zipfile.ZipFile(options['output'], 'w', zipfile.ZIP_DEFLATED) as archive:
+                for name, path in sorted(results):
+                    archive.write(path, name)
+            self.stdout.write("Exported {count} files to {output} in {time:.2f}s.".format(
+                count=len(results), output=options['output'], time=time.time() - start))
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from survey.answers import BATCH_SIZE, fill_values
+from survey.models import Answer
+
+
+class Command(BaseCommand):
+    help = "Fills numeric values of answers to numeric subquestions, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--survey', type=int, action='append', dest='surveys',
+                            help="Limit filling to answers of given survey (may be repeated)")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, dest='batch_size',
+                            help="Number of answers read per query")
+
+    def handle(self, *args, **options):
+        answers = Answer.objects.all()
+        if options['surveys']:
+            answers = answers.filter(participant__survey__in=options['surveys'])
+        start = time.time()
+        count = fill_values(answers, batch_size=options['batch_size'])
+        self.stdout.write("{count} answers were updated in {time:.1f}s.".format(
+            count=count, time=time.time() - start))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from survey.completion import refresh_completion
+from survey.counters import (reconcile_answer_count, reconcile_hospital_count,
+                             reconcile_subquestion_count)
+from survey.models import Participant
+
+
+class Command(BaseCommand):
+    help = "Recalculates denormalized counters and completion of surveys and participants."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--survey', type=int, action='append', dest='surveys',
+                            help="Limit reconciliation to given survey (may be repeated)")
+
+    def handle(self, *args, **options):
+        surveys = options['surveys']
+        participants = Participant.objects.all()
+        if surveys:
+            participants = participants.filter(survey__in=surveys)
+        count = reconcile_hospital_count()
+        self.stdout.write("Hospital count of {0} health funds was updated.".format(count))
+        count = reconcile_subquestion_count(surveys)
+        self.stdout.write("Subquestion count of {0} surveys was updated.".format(count))
+        count = reconcile_answer_count(participants.values_list('pk', flat=True) if surveys else None)
+        self.stdout.write("Answer count of {0} participants was updated.".format(count))
+        for participant in participants:
+            refresh_completion(participant)
+        self.stdout.write("Completion of {0} participants was updated.".format(len(participants)))
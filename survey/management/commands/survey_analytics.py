@@ -0,0 +1,30 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from survey.analytics import iter_summary_csv
+from survey.models import Survey
+
+
+class Command(BaseCommand):
+    help = "Writes a CSV summary of numeric answers of a survey per health fund and for the country."
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey', type=int, help="Survey to summarize")
+        parser.add_argument('--output', help="Output file, by default standard output")
+
+    def handle(self, *args, **options):
+        try:
+            survey = Survey.objects.get(pk=options['survey'])
+        except Survey.DoesNotExist:
+            raise CommandError("Survey {0} does not exist".format(options['survey']))
+        start = time.time()
+        output = open(options['output'], 'w', newline='') if options['output'] else sys.stdout
+        try:
+            for line in iter_summary_csv(survey):
+                output.write(line)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        self.stderr.write("Summary was computed in {0:.2f}s.".format(time.time() - start))
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0024_auto_20161202_0146'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='survey',
+            name='structure_version',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Structure version'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 10:02
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, F, Max
+
+
+def remove_duplicated_answers(apps, schema_editor):
+    Answer = apps.get_model('survey', 'Answer')
+    Participant = apps.get_model('survey', 'Participant')
+    duplicates = (Answer.objects.values('participant', 'hospital', 'subquestion').
+                  annotate(count=Count('pk'), last=Max('pk')).
+                  filter(count__gt=1))
+    for row in duplicates:
+        (Answer.objects.filter(participant=row['participant'],
+                               hospital=row['hospital'],
+                               subquestion=row['subquestion']).
+         exclude(pk=row['last']).
+         delete())
+        (Participant.objects.filter(pk=row['participant']).
+         update(answer_count=F('answer_count') - (row['count'] - 1)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0025_survey_structure_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicated_answers, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='answer',
+            unique_together=set([('participant', 'hospital', 'subquestion')]),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 11:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+def fill_completion(apps, schema_editor):
+    Answer = apps.get_model("survey", "Answer")
+    HospitalCompletion = apps.get_model("survey", "HospitalCompletion")
+    QuestionCompletion = apps.get_model("survey", "QuestionCompletion")
+    answers = Answer.objects.order_by()
+    HospitalCompletion.objects.bulk_create(
+        HospitalCompletion(participant_id=row['participant_id'],
+                           hospital_id=row['hospital_id'],
+                           answer_count=row['count'])
+        for row in answers.values('participant_id', 'hospital_id').annotate(count=models.Count('pk')))
+    QuestionCompletion.objects.bulk_create(
+        QuestionCompletion(participant_id=row['participant_id'],
+                           question_id=row['subquestion__question_id'],
+                           answer_count=row['count'])
+        for row in (answers.values('participant_id', 'subquestion__question_id').
+                    annotate(count=models.Count('pk'))))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0026_answer_unique_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HospitalCompletion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('answer_count', models.IntegerField(default=0, verbose_name='Answer count')),
+                ('hospital', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Hospital', verbose_name='Hospital')),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Participant', verbose_name='Participant')),
+            ],
+            options={
+                'verbose_name': 'Hospital completion',
+                'verbose_name_plural': 'Hospital completions',
+            },
+        ),
+        migrations.CreateModel(
+            name='QuestionCompletion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('answer_count', models.IntegerField(default=0, verbose_name='Answer count')),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Participant', verbose_name='Participant')),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Question', verbose_name='Question')),
+            ],
+            options={
+                'verbose_name': 'Question completion',
+                'verbose_name_plural': 'Question completions',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='questioncompletion',
+            unique_together=set([('participant', 'question')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='hospitalcompletion',
+            unique_together=set([('participant', 'hospital')]),
+        ),
+        migrations.RunPython(fill_completion, migrations.RunPython.noop),
+    ]
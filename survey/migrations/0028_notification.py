@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 12:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0027_completion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('kind', models.IntegerField(choices=[(0, 'Answers for hospital'), (1, 'Answers for participant'), (2, 'Answers for question')], verbose_name='Kind')),
+                ('recipients', models.TextField(help_text='One e-mail per line', verbose_name='Recipients')),
+                ('status', models.IntegerField(choices=[(0, 'Pending'), (1, 'Sent'), (2, 'Failed')], default=0, verbose_name='Status')),
+                ('attempts', models.IntegerField(default=0, verbose_name='Attempts')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Next attempt on')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Sent on')),
+                ('last_error', models.TextField(blank=True, verbose_name='Last error')),
+                ('hospital', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='survey.Hospital', verbose_name='Hospital')),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Participant', verbose_name='Participant')),
+                ('question', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='survey.Question', verbose_name='Question')),
+            ],
+            options={
+                'verbose_name': 'Notification',
+                'verbose_name_plural': 'Notifications',
+                'ordering': ['created'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='notification',
+            index_together=set([('status', 'next_attempt_at')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 12:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0028_notification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='changes',
+            field=models.TextField(blank=True, help_text='Hospital and subquestion of changed answer, one per line', verbose_name='Changed answers'),
+        ),
+        migrations.AlterField(
+            model_name='notification',
+            name='kind',
+            field=models.IntegerField(choices=[(0, 'Answers for hospital'), (1, 'Answers for participant'), (2, 'Answers for question'), (3, 'Digest of changed answers')], verbose_name='Kind'),
+        ),
+    ]
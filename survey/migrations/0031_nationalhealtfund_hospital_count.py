@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 13:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_hospital_count(apps, schema_editor):
+    NationalHealtFund = apps.get_model("survey", "NationalHealtFund")
+    Hospital = apps.get_model("survey", "Hospital")
+    counts = (Hospital.objects.order_by().
+              values('health_fund_id').
+              annotate(count=models.Count('pk')))
+    for row in counts:
+        NationalHealtFund.objects.filter(pk=row['health_fund_id']).update(hospital_count=row['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0030_answer_index_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nationalhealtfund',
+            name='hospital_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Hospital count'),
+        ),
+        migrations.RunPython(fill_hospital_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 16:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0031_nationalhealtfund_hospital_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participant',
+            name='quality_checked_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Quality checked on'),
+        ),
+        migrations.CreateModel(
+            name='QualityRule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('name', models.CharField(max_length=250, verbose_name='Name')),
+                ('operator', models.CharField(choices=[('lt', 'less than'), ('lte', 'less than or equal to'), ('eq', 'equal to'), ('gte', 'greater than or equal to'), ('gt', 'greater than')], max_length=3, verbose_name='Operator')),
+                ('factor', models.FloatField(default=1.0, help_text='Right subquestion is multiplied by factor', verbose_name='Factor')),
+                ('active', models.BooleanField(default=True, verbose_name='Active')),
+                ('left', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='survey.Subquestion', verbose_name='Left subquestion')),
+                ('right', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='survey.Subquestion', verbose_name='Right subquestion')),
+                ('survey', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Survey', verbose_name='Survey')),
+            ],
+            options={
+                'verbose_name': 'Quality rule',
+                'verbose_name_plural': 'Quality rules',
+                'ordering': ['survey', 'name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='QualityIssue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('kind', models.IntegerField(choices=[(0, 'Robust z-score outlier'), (1, 'Interquartile range outlier'), (2, 'Broken rule')], verbose_name='Kind')),
+                ('value', models.FloatField(verbose_name='Value')),
+                ('score', models.FloatField(help_text='Distance from the expected range, greater is worse', verbose_name='Score')),
+                ('message', models.CharField(max_length=250, verbose_name='Message')),
+                ('hospital', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Hospital', verbose_name='Hospital')),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Participant', verbose_name='Participant')),
+                ('rule', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='survey.QualityRule', verbose_name='Rule')),
+                ('subquestion', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Subquestion', verbose_name='Subquestion')),
+            ],
+            options={
+                'verbose_name': 'Quality issue',
+                'verbose_name_plural': 'Quality issues',
+                'ordering': ['-score'],
+            },
+        ),
+    ]
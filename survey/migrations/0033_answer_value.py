@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 17:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0032_quality'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='answer',
+            name='value',
+            field=models.BigIntegerField(blank=True, editable=False, help_text='Answer of a numeric subquestion as a number', null=True, verbose_name='Value'),
+        ),
+        migrations.AddField(
+            model_name='answer',
+            name='missing_data',
+            field=models.BooleanField(default=False, editable=False, verbose_name='Missing data'),
+        ),
+        migrations.AlterIndexTogether(
+            name='answer',
+            index_together=set([('participant', 'modified'), ('subquestion', 'value')]),
+        ),
+    ]
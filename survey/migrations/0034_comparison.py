@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 17:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0033_answer_value'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subquestion',
+            name='key',
+            field=models.CharField(blank=True, db_index=True, help_text='Stable key matching the subquestion in other editions of the survey, by default names of its category, question and itself are used', max_length=50, verbose_name='Key'),
+        ),
+        migrations.CreateModel(
+            name='Comparison',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('row_count', models.IntegerField(default=0, editable=False, verbose_name='Row count')),
+                ('built_at', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Built on')),
+                ('previous', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='survey.Survey', verbose_name='Previous survey')),
+                ('survey', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Survey', verbose_name='Survey')),
+            ],
+            options={
+                'verbose_name': 'Comparison',
+                'verbose_name_plural': 'Comparisons',
+                'ordering': ['created'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ComparisonRow',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('previous_value', models.BigIntegerField(verbose_name='Previous value')),
+                ('value', models.BigIntegerField(verbose_name='Value')),
+                ('delta', models.BigIntegerField(verbose_name='Delta')),
+                ('change', models.FloatField(help_text='Absolute delta relative to the previous value', verbose_name='Change')),
+                ('comparison', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Comparison', verbose_name='Comparison')),
+                ('hospital', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Hospital', verbose_name='Hospital')),
+                ('subquestion', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Subquestion', verbose_name='Subquestion')),
+            ],
+            options={
+                'verbose_name': 'Comparison row',
+                'verbose_name_plural': 'Comparison rows',
+                'ordering': ['-change'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='comparison',
+            unique_together=set([('survey', 'previous')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='comparisonrow',
+            index_together=set([('comparison', 'change'), ('comparison', 'hospital')]),
+        ),
+    ]
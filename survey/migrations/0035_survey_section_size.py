@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 19:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0034_comparison'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='survey',
+            name='section_size',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Splits answer forms into sections by category and chunks of this many hospitals, 0 shows whole forms', verbose_name='Hospitals per section'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 21:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0035_survey_section_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StashedUpload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('token', models.CharField(max_length=32, unique=True, verbose_name='Token')),
+                ('rows', models.TextField(help_text='JSON list of hospital, subquestion and answer of valid cells', verbose_name='Rows')),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='survey.Participant', verbose_name='Participant')),
+            ],
+            options={
+                'verbose_name': 'Stashed upload',
+                'verbose_name_plural': 'Stashed uploads',
+                'ordering': ['created'],
+            },
+        ),
+    ]
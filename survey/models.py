@@ -5,22 +5,46 @@ from autoslug.fields import AutoSlugField
 from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
 from django.db import models
-from django.db.models import F, Count
-from django.db.models.functions import Cast
-from django.db.models.signals import post_delete, post_save
+from django.db.models import Count, ExpressionWrapper, F
+from django.db.models.signals import post_delete, post_init, post_save
 from django.dispatch import receiver
-from django.utils.encoding import python_2_unicode_compatible
+from django.utils import timezone
+from django.utils.encoding import force_text, python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 from model_utils import Choices
 from model_utils.models import TimeStampedModel
 from tinymce.models import HTMLField
 
+from . import counters
+
 LogEntry = namedtuple('LogEntry', ['status', 'text'])
+Group = namedtuple('Group', ['obj', 'set'])
 LinkedHospital = namedtuple('LinkedHospital', ['obj', 'link', 'status'])
 LinkedCategory = namedtuple('LinkedCategory', ['obj', 'question_set'])
 LinkedQuestion = namedtuple('LinkedQuestion', ['obj', 'link', 'status'])
 
 
+class CompletionStatus(namedtuple('CompletionStatus', ['count', 'required'])):
+    """
+    Number of saved answers out of required ones, true if anything was saved.
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return self.count > 0
+    __nonzero__ = __bool__
+
+    @property
+    def complete(self):
+        return self.required is not None and self.count >= self.required
+
+    @property
+    def progress(self):
+        if not self.required:
+            return 0.0
+        return self.count / self.required * 100
+
+
 def get_secret():
     return random.randint(10**4, 10**5 - 1)
 
@@ -37,6 +61,9 @@ class NationalHealtFund(TimeStampedModel):
     identifier = models.CharField(verbose_name=_("Identifier"),
                                   max_length=15,
                                   help_text=_("ID data to an external computer system"))
+    hospital_count = models.IntegerField(verbose_name=_("Hospital count"),
+                                         default=0,
+                                         editable=False)
     objects = NationalHealtFundQuerySet.as_manager()
 
     class Meta:
@@ -50,22 +77,23 @@ class NationalHealtFund(TimeStampedModel):
 
 class HospitalQuerySet(models.QuerySet):
 
-    def answer_fetch(self, participant):
-        prefetch = models.Prefetch(lookup='answer_set',
-                                   to_attr='answer_participant',
-                                   queryset=Answer.objects.filter(participant=participant))
+    def with_completion(self, participant):
+        prefetch = models.Prefetch(lookup='hospitalcompletion_set',
+                                   to_attr='participant_completion',
+                                   queryset=HospitalCompletion.objects.filter(participant=participant))
         return self.prefetch_related(prefetch)
 
-    def linked(self, participant, password):
+    def linked(self, participant, password, required=None):
         linked_hospitals = []
         for hospital in self:
             link = reverse('survey:survey', kwargs={'password': password,
                                                     'participant': participant,
                                                     'hospital': hospital.pk})
             link = 'http://%s%s' % (Site.objects.get_current().domain, link)
+            count = sum(x.answer_count for x in hospital.participant_completion)
             linked = LinkedHospital(obj=hospital,
                                     link=link,
-                                    status=len(hospital.answer_participant) > 0)
+                                    status=CompletionStatus(count, required))
             linked_hospitals.append(linked)
         return linked_hospitals
 
@@ -116,11 +144,19 @@ class Survey(TimeStampedModel):
     submit_text = HTMLField(verbose_name=_("Submit text"), blank=True)
     subquestion_count = models.IntegerField(verbose_name=_("Total number of subquestion"),
                                             default=0)
+    structure_version = models.IntegerField(verbose_name=_("Structure version"),
+                                            default=0,
+                                            editable=False)
     participants = models.ManyToManyField(NationalHealtFund,
                                           verbose_name=_("Participants"),
                                           through="Participant")
     style = models.IntegerField(choices=STYLE, default=STYLE.question)
     print_style = models.IntegerField(choices=PRINT_STYLE, default=PRINT_STYLE.per_participant)
+    section_size = models.PositiveSmallIntegerField(
+        verbose_name=_("Hospitals per section"),
+        default=0,
+        help_text=_("Splits answer forms into sections by category and chunks of this many hospitals, "
+                    "0 shows whole forms"))
     objects = SurveyQuerySet.as_manager()
 
     def _count_msg(self, obj, attribute, found=None, missing=None):
@@ -150,9 +186,8 @@ class Survey(TimeStampedModel):
         return log
 
     def update_subquestion_counter(self):
-        obj = Survey.objects.with_db_subquestion_count().get(pk=self.pk)
-        obj.subquestion_count = obj.db_subquestion_count
-        obj.save(update_fields=["subquestion_count"])
+        counters.reconcile_subquestion_count([self.pk])
+        self.refresh_from_db(fields=['subquestion_count'])
 
     class Meta:
         verbose_name = _("Survey")
@@ -175,14 +210,10 @@ class ParticipantQuerySet(models.QuerySet):
         return self.annotate(db_answer_count=Count('answer', distinct=True))
 
     def with_progress_stats(self):
-        def fl(expr):
-            return Cast(expr, models.FloatField())
-        qs = self.annotate(hospital_count=Count('health_fund__hospital', distinct=True))
-        up = F('answer_count')
-        down = F('survey__subquestion_count') * F('hospital_count')
-        expr = (up / down) * 100
-        qs = qs.annotate(progress=expr)  # Due django casting bug available in Python as int only
-        return qs
+        qs = self.annotate(hospital_count=F('health_fund__hospital_count'))
+        up = F('answer_count') * 100.0
+        down = F('survey__subquestion_count') * F('health_fund__hospital_count')
+        return qs.annotate(progress=ExpressionWrapper(up / down, output_field=models.FloatField()))
 
 
 class Participant(TimeStampedModel):
@@ -193,6 +224,8 @@ class Participant(TimeStampedModel):
     password = models.CharField(verbose_name=_("Password"), default=get_secret, max_length=15)
     answer_count = models.IntegerField(verbose_name=_("Answer count"), default=0)
     accept_on = models.DateTimeField(null=True, blank=True, verbose_name=_("Accept on"))
+    quality_checked_at = models.DateTimeField(null=True, blank=True, editable=False,
+                                              verbose_name=_("Quality checked on"))
     objects = ParticipantQuerySet.as_manager()
 
     def get_answer_count(self):
@@ -200,7 +233,7 @@ class Participant(TimeStampedModel):
 
     def get_hospital_count(self):
         if not hasattr(self, 'hospital_count'):
-            self.hospital_count = Hospital.objects.filter(health_fund=self.health_fund_id).count()
+            self.hospital_count = self.health_fund.hospital_count
         return self.hospital_count
 
     def get_subquestion_count(self):
@@ -210,6 +243,8 @@ class Participant(TimeStampedModel):
         return self.get_hospital_count() * self.get_subquestion_count()
 
     def get_progress(self):
+        if not self.get_required_count():
+            return 0.0
         return self.get_answer_count() / self.get_required_count() * 100
 
     def get_progress_display(self):
@@ -245,9 +280,6 @@ class Category(TimeStampedModel):
     ordering = models.PositiveSmallIntegerField(verbose_name=_("Order"), default=1)
     objects = CategoryQuerySet.as_manager()
 
-    def update_subquestion_counter(self):
-        self.survey.update_subquestion_counter()
-
     class Meta:
         verbose_name = _("Category")
         verbose_name_plural = _("Categories")
@@ -279,9 +311,6 @@ class Question(TimeStampedModel):
     ordering = models.PositiveSmallIntegerField(verbose_name=_("Order"), default=1)
     objects = QuestionQuerySet.as_manager()
 
-    def update_subquestion_counter(self):
-        self.category.update_subquestion_counter()
-
     class Meta:
         verbose_name = _("Question")
         verbose_name_plural = _("Questions")
@@ -306,6 +335,9 @@ class Subquestion(TimeStampedModel):
             (KIND_LTEXT, 'Long text'),
             (KIND_VINT, 'Value or text'),
             )
+    # Values allowed in place of a number in KIND_VINT
+    MISSING_DATA = ['b/d', 'brak danych']
+    NUMERIC_KINDS = (KIND_INT, KIND_VINT)
     question = models.ForeignKey(to=Question, verbose_name=_("Question"))
     name = models.CharField(verbose_name=_("Name"), max_length=100)
     ordering = models.PositiveSmallIntegerField(verbose_name=_("Order"), default=1)
@@ -313,11 +345,11 @@ class Subquestion(TimeStampedModel):
                             choices=KIND,
                             max_length=5,
                             default=KIND_TEXT)
+    key = models.CharField(verbose_name=_("Key"), max_length=50, blank=True, db_index=True,
+                           help_text=_("Stable key matching the subquestion in other editions of the survey, "
+                                       "by default names of its category, question and itself are used"))
     objects = SubquestionQuerySet.as_manager()
 
-    def update_subquestion_counter(self):
-        self.question.update_subquestion_counter()
-
     class Meta:
         verbose_name = _("Subquestion")
         verbose_name_plural = _("Subquestions")
@@ -326,12 +358,41 @@ class Subquestion(TimeStampedModel):
     def __str__(self):
         return self.name
 
+    def is_numeric(self):
+        return self.kind in self.NUMERIC_KINDS
+
+
+def parse_number(answer):
+    """
+    Returns ``(value, missing_data)`` of an answer to a numeric subquestion.
+
+    Value is None if the answer is not an integer or does not fit the column.
+    """
+    answer = answer.strip()
+    if answer in Subquestion.MISSING_DATA:
+        return None, True
+    try:
+        value = int(answer)
+    except ValueError:
+        return None, False
+    return (value if -2 ** 63 <= value < 2 ** 63 else None), False
+
 
 class AnswerQuerySet(models.QuerySet):
 
     def as_question_dict(self):
         return {x.subquestion.question_id: x for x in self.select_related('subquestion')}
 
+    def as_existing(self):
+        """
+        Returns a mapping of ``(hospital_id, subquestion_id)`` to ``(pk, answer)``.
+        """
+        return {(hospital_id, subquestion_id): (pk, answer)
+                for pk, hospital_id, subquestion_id, answer in self.values_list('pk',
+                                                                                'hospital_id',
+                                                                                'subquestion_id',
+                                                                                'answer')}
+
 
 @python_2_unicode_compatible
 class Answer(TimeStampedModel):
@@ -339,23 +400,402 @@ class Answer(TimeStampedModel):
     subquestion = models.ForeignKey(Subquestion, verbose_name=_("Subquestions"))
     hospital = models.ForeignKey(Hospital, verbose_name=_("Hospital"))
     answer = models.TextField(verbose_name=_("Answer"))
+    value = models.BigIntegerField(verbose_name=_("Value"), null=True, blank=True, editable=False,
+                                   help_text=_("Answer of a numeric subquestion as a number"))
+    missing_data = models.BooleanField(verbose_name=_("Missing data"), default=False, editable=False)
     objects = AnswerQuerySet.as_manager()
 
     class Meta:
         verbose_name = _("Answer")
         verbose_name_plural = _("Answers")
         ordering = ['participant', 'hospital', 'subquestion']
+        unique_together = [
+            ["participant", "hospital", "subquestion"],
+        ]
+        index_together = [
+            ["participant", "modified"],
+            ["subquestion", "value"],
+        ]
 
     def __str__(self):
         return str(self.answer)
 
+    def get_subquestion_kind(self):
+        # A loaded subquestion is reused, otherwise only its kind is read with one small query
+        cache_name = self._meta.get_field('subquestion').get_cache_name()
+        if hasattr(self, cache_name):
+            return getattr(self, cache_name).kind
+        return Subquestion.objects.values_list('kind', flat=True).get(pk=self.subquestion_id)
+
+    def fill_value(self):
+        if self.get_subquestion_kind() in Subquestion.NUMERIC_KINDS:
+            self.value, self.missing_data = parse_number(force_text(self.answer))
+        else:
+            self.value, self.missing_data = None, False
+
+    def save(self, *args, **kwargs):
+        self.fill_value()
+        return super(Answer, self).save(*args, **kwargs)
+
+
+@python_2_unicode_compatible
+class HospitalCompletion(TimeStampedModel):
+    participant = models.ForeignKey(Participant, verbose_name=_("Participant"),
+                                    on_delete=models.CASCADE)
+    hospital = models.ForeignKey(Hospital, verbose_name=_("Hospital"), on_delete=models.CASCADE)
+    answer_count = models.IntegerField(verbose_name=_("Answer count"), default=0)
+
+    class Meta:
+        verbose_name = _("Hospital completion")
+        verbose_name_plural = _("Hospital completions")
+        unique_together = [
+            ["participant", "hospital"],
+        ]
+
+    def __str__(self):
+        return "{0} - {1}: {2}".format(self.participant_id, self.hospital_id, self.answer_count)
+
+
+@python_2_unicode_compatible
+class QuestionCompletion(TimeStampedModel):
+    participant = models.ForeignKey(Participant, verbose_name=_("Participant"),
+                                    on_delete=models.CASCADE)
+    question = models.ForeignKey(Question, verbose_name=_("Question"), on_delete=models.CASCADE)
+    answer_count = models.IntegerField(verbose_name=_("Answer count"), default=0)
+
+    class Meta:
+        verbose_name = _("Question completion")
+        verbose_name_plural = _("Question completions")
+        unique_together = [
+            ["participant", "question"],
+        ]
+
+    def __str__(self):
+        return "{0} - {1}: {2}".format(self.participant_id, self.question_id, self.answer_count)
+
+
+class NotificationQuerySet(models.QuerySet):
+
+    def pending(self):
+        return self.filter(status=Notification.STATUS.pending, next_attempt_at__lte=timezone.now())
+
+
+@python_2_unicode_compatible
+class Notification(TimeStampedModel):
+    KIND = Choices((0, 'hospital', _('Answers for hospital')),
+                   (1, 'participant', _('Answers for participant')),
+                   (2, 'question', _('Answers for question')),
+                   (3, 'digest', _('Digest of changed answers')))
+    STATUS = Choices((0, 'pending', _('Pending')),
+                     (1, 'sent', _('Sent')),
+                     (2, 'failed', _('Failed')))
+    participant = models.ForeignKey(Participant, verbose_name=_("Participant"),
+                                    on_delete=models.CASCADE)
+    kind = models.IntegerField(verbose_name=_("Kind"), choices=KIND)
+    hospital = models.ForeignKey(Hospital, verbose_name=_("Hospital"), null=True, blank=True,
+                                 on_delete=models.CASCADE)
+    question = models.ForeignKey(Question, verbose_name=_("Question"), null=True, blank=True,
+                                 on_delete=models.CASCADE)
+    recipients = models.TextField(verbose_name=_("Recipients"), help_text=_("One e-mail per line"))
+    status = models.IntegerField(verbose_name=_("Status"), choices=STATUS, default=STATUS.pending)
+    attempts = models.IntegerField(verbose_name=_("Attempts"), default=0)
+    next_attempt_at = models.DateTimeField(verbose_name=_("Next attempt on"), default=timezone.now)
+    sent_at = models.DateTimeField(verbose_name=_("Sent on"), null=True, blank=True)
+    last_error = models.TextField(verbose_name=_("Last error"), blank=True)
+    changes = models.TextField(verbose_name=_("Changed answers"), blank=True,
+                               help_text=_("Hospital and subquestion of changed answer, one per line"))
+    objects = NotificationQuerySet.as_manager()
+
+    def get_recipients(self):
+        return [x for x in self.recipients.splitlines() if x]
+
+    def get_changes(self):
+        return {tuple(int(x) for x in line.split()) for line in self.changes.splitlines() if line}
+
+    def set_changes(self, cells):
+        self.changes = "\n".join("{0} {1}".format(*cell) for cell in sorted(cells))
+
+    class Meta:
+        verbose_name = _("Notification")
+        verbose_name_plural = _("Notifications")
+        ordering = ['created', ]
+        index_together = [
+            ["status", "next_attempt_at"],
+        ]
+
+    def __str__(self):
+        return "{0} - {1}".format(self.participant_id, self.get_kind_display())
+
+
+@python_2_unicode_compatible
+class QualityRule(TimeStampedModel):
+    OPERATOR = Choices(('lt', _('less than')),
+                       ('lte', _('less than or equal to')),
+                       ('eq', _('equal to')),
+                       ('gte', _('greater than or equal to')),
+                       ('gt', _('greater than')))
+    survey = models.ForeignKey(Survey, verbose_name=_("Survey"), on_delete=models.CASCADE)
+    name = models.CharField(verbose_name=_("Name"), max_length=250)
+    left = models.ForeignKey(Subquestion, verbose_name=_("Left subquestion"), related_name='+',
+                             on_delete=models.CASCADE)
+    operator = models.CharField(verbose_name=_("Operator"), choices=OPERATOR, max_length=3)
+    factor = models.FloatField(verbose_name=_("Factor"), default=1.0,
+                               help_text=_("Right subquestion is multiplied by factor"))
+    right = models.ForeignKey(Subquestion, verbose_name=_("Right subquestion"), related_name='+',
+                              on_delete=models.CASCADE)
+    active = models.BooleanField(verbose_name=_("Active"), default=True)
+
+    class Meta:
+        verbose_name = _("Quality rule")
+        verbose_name_plural = _("Quality rules")
+        ordering = ['survey', 'name']
+
+    def __str__(self):
+        return self.name
+
+
+@python_2_unicode_compatible
+class QualityIssue(TimeStampedModel):
+    KIND = Choices((0, 'zscore', _('Robust z-score outlier')),
+                   (1, 'iqr', _('Interquartile range outlier')),
+                   (2, 'rule', _('Broken rule')))
+    participant = models.ForeignKey(Participant, verbose_name=_("Participant"), on_delete=models.CASCADE)
+    hospital = models.ForeignKey(Hospital, verbose_name=_("Hospital"), on_delete=models.CASCADE)
+    subquestion = models.ForeignKey(Subquestion, verbose_name=_("Subquestion"), on_delete=models.CASCADE)
+    rule = models.ForeignKey(QualityRule, verbose_name=_("Rule"), null=True, blank=True,
+                             on_delete=models.CASCADE)
+    kind = models.IntegerField(verbose_name=_("Kind"), choices=KIND)
+    value = models.FloatField(verbose_name=_("Value"))
+    score = models.FloatField(verbose_name=_("Score"),
+                              help_text=_("Distance from the expected range, greater is worse"))
+    message = models.CharField(verbose_name=_("Message"), max_length=250)
+
+    class Meta:
+        verbose_name = _("Quality issue")
+        verbose_name_plural = _("Quality issues")
+        ordering = ['-score', ]
+
+    def __str__(self):
+        return self.message
+
+
+@python_2_unicode_compatible
+class Comparison(TimeStampedModel):
+    survey = models.ForeignKey(Survey, verbose_name=_("Survey"), on_delete=models.CASCADE)
+    previous = models.ForeignKey(Survey, verbose_name=_("Previous survey"), related_name='+',
+                                 on_delete=models.CASCADE)
+    row_count = models.IntegerField(verbose_name=_("Row count"), default=0, editable=False)
+    built_at = models.DateTimeField(verbose_name=_("Built on"), null=True, blank=True, editable=False)
+
+    class Meta:
+        verbose_name = _("Comparison")
+        verbose_name_plural = _("Comparisons")
+        ordering = ['created', ]
+        unique_together = [
+            ["survey", "previous"],
+        ]
+
+    def __str__(self):
+        return "{0} / {1}".format(self.survey, self.previous)
+
+
+@python_2_unicode_compatible
+class ComparisonRow(TimeStampedModel):
+    comparison = models.ForeignKey(Comparison, verbose_name=_("Comparison"), on_delete=models.CASCADE)
+    hospital = models.ForeignKey(Hospital, verbose_name=_("Hospital"), on_delete=models.CASCADE)
+    subquestion = models.ForeignKey(Subquestion, verbose_name=_("Subquestion"), on_delete=models.CASCADE)
+    previous_value = models.BigIntegerField(verbose_name=_("Previous value"))
+    value = models.BigIntegerField(verbose_name=_("Value"))
+    delta = models.BigIntegerField(verbose_name=_("Delta"))
+    change = models.FloatField(verbose_name=_("Change"),
+                               help_text=_("Absolute delta relative to the previous value"))
+
+    class Meta:
+        verbose_name = _("Comparison row")
+        verbose_name_plural = _("Comparison rows")
+        ordering = ['-change', ]
+        index_together = [
+            ["comparison", "change"],
+            ["comparison", "hospital"],
+        ]
+
+    def __str__(self):
+        return "{0} - {1}".format(self.hospital_id, self.subquestion_id)
+
+
+@python_2_unicode_compatible
+class StashedUpload(TimeStampedModel):
+    participant = models.ForeignKey(Participant, verbose_name=_("Participant"), on_delete=models.CASCADE)
+    token = models.CharField(verbose_name=_("Token"), max_length=32, unique=True)
+    rows = models.TextField(verbose_name=_("Rows"),
+                            help_text=_("JSON list of hospital, subquestion and answer of valid cells"))
+
+    class Meta:
+        verbose_name = _("Stashed upload")
+        verbose_name_plural = _("Stashed uploads")
+        ordering = ['created', ]
+
+    def __str__(self):
+        return self.token
+
+
+def track_loaded_parent(instance, field):
+    # Remember the parent as loaded from the database to detect moves in post_save.
+    # Deferred fields are skipped to avoid a query per loaded instance.
+    instance._loaded_parent_id = instance.__dict__.get(field)
+
+
+@receiver(post_init, sender=Subquestion, dispatch_uid="subquestion_track_loaded_parent")
+def subquestion_track_loaded_parent(sender, instance, **kwargs):
+    track_loaded_parent(instance, 'question_id')
+    instance._loaded_question_id = instance.__dict__.get('question_id')
+    instance._loaded_kind = instance.__dict__.get('kind')
+
+
+@receiver(post_init, sender=Question, dispatch_uid="question_track_loaded_parent")
+def question_track_loaded_parent(sender, instance, **kwargs):
+    track_loaded_parent(instance, 'category_id')
+
+
+@receiver(post_init, sender=Category, dispatch_uid="category_track_loaded_parent")
+def category_track_loaded_parent(sender, instance, **kwargs):
+    track_loaded_parent(instance, 'survey_id')
+
+
+@receiver(post_init, sender=Hospital, dispatch_uid="hospital_track_loaded_parent")
+def hospital_track_loaded_parent(sender, instance, **kwargs):
+    track_loaded_parent(instance, 'health_fund_id')
+    instance._loaded_health_fund_id = instance.__dict__.get('health_fund_id')
+
+
+@receiver(post_save, sender=Hospital, dispatch_uid="hospital_move_hospitalcount")
+def hospital_move_hospitalcount(sender, instance, created, **kwargs):
+    old_health_fund_id = None if created else instance._loaded_parent_id
+    instance._loaded_parent_id = instance.health_fund_id
+    counters.move_hospital(old_health_fund_id, instance.health_fund_id)
+
+
+@receiver(post_delete, sender=Hospital, dispatch_uid="hospital_decrement_hospitalcount")
+def hospital_decrement_hospitalcount(sender, instance, **kwargs):
+    counters.move_hospital(instance.health_fund_id, None)
+
+
+@receiver(post_save, sender=Hospital, dispatch_uid="hospital_move_stats")
+def hospital_move_stats(sender, instance, created, **kwargs):
+    old_health_fund_id, instance._loaded_health_fund_id = instance._loaded_health_fund_id, instance.health_fund_id
+    if not created and old_health_fund_id == instance.health_fund_id:
+        return
+    from .stats import schedule_invalidate
+    schedule_invalidate(health_fund_ids=[x for x in (old_health_fund_id, instance.health_fund_id) if x])
+
+
+@receiver(post_delete, sender=Hospital, dispatch_uid="hospital_delete_stats")
+def hospital_delete_stats(sender, instance, **kwargs):
+    from .stats import schedule_invalidate
+    schedule_invalidate(health_fund_ids=[instance.health_fund_id])
+
 
 @receiver(post_save, sender=Subquestion, dispatch_uid="subquestion_increment_subquestioncount")
 def increment_subquestioncount(sender, instance, created, **kwargs):
+    old_question_id, instance._loaded_parent_id = instance._loaded_parent_id, instance.question_id
+    if not counters.is_tracking():
+        return
+    surveys = counters.resolve_question_surveys([old_question_id, instance.question_id])
     if created:
-        instance.update_subquestion_counter()
+        counters.apply_delta(surveys[instance.question_id], 1)
+    else:
+        counters.move(surveys[old_question_id], surveys[instance.question_id], 1)
+
+
+@receiver(post_save, sender=Subquestion, dispatch_uid="subquestion_fill_answer_values")
+def subquestion_fill_answer_values(sender, instance, created, **kwargs):
+    old_kind, instance._loaded_kind = instance._loaded_kind, instance.kind
+    if created or old_kind is None or old_kind == instance.kind:
+        return
+    from .answers import fill_values
+    fill_values(Answer.objects.filter(subquestion=instance))
+
+
+@receiver(post_save, sender=Subquestion, dispatch_uid="subquestion_move_completion")
+def subquestion_move_completion(sender, instance, created, **kwargs):
+    old_question_id, instance._loaded_question_id = instance._loaded_question_id, instance.question_id
+    if created or old_question_id in (None, instance.question_id):
+        return
+    from .completion import schedule_refresh
+    for participant_id in (Answer.objects.filter(subquestion=instance).
+                           order_by().
+                           values_list('participant_id', flat=True).
+                           distinct()):
+        schedule_refresh(participant_id)
 
 
 @receiver(post_delete, sender=Subquestion, dispatch_uid="subquestion_decrement_subquestioncount")
 def decrement_subquestioncount(sender, instance, **kwargs):
-    instance.update_subquestion_counter()
+    if not counters.is_tracking():
+        return
+    survey_id = counters.resolve_question_surveys([instance.question_id])[instance.question_id]
+    counters.apply_delta(survey_id, -1)
+
+
+@receiver(post_save, sender=Question, dispatch_uid="question_move_subquestioncount")
+def question_move_subquestioncount(sender, instance, created, **kwargs):
+    old_category_id, instance._loaded_parent_id = instance._loaded_parent_id, instance.category_id
+    if not counters.is_tracking():
+        return
+    surveys = counters.resolve_category_surveys([old_category_id, instance.category_id])
+    old_survey_id, survey_id = surveys.get(old_category_id), surveys.get(instance.category_id)
+    if created or old_survey_id == survey_id:
+        counters.apply_delta(survey_id)
+    else:
+        count = Subquestion.objects.filter(question=instance).count()
+        counters.move(old_survey_id, survey_id, count)
+
+
+@receiver(post_delete, sender=Question, dispatch_uid="question_delete_structure_version")
+def question_delete_structure_version(sender, instance, **kwargs):
+    if not counters.is_tracking():
+        return
+    counters.apply_delta(counters.resolve_category_surveys([instance.category_id]).get(instance.category_id))
+
+
+@receiver(post_save, sender=Category, dispatch_uid="category_move_subquestioncount")
+def category_move_subquestioncount(sender, instance, created, **kwargs):
+    old_survey_id, instance._loaded_parent_id = instance._loaded_parent_id, instance.survey_id
+    if not counters.is_tracking():
+        return
+    if created or old_survey_id == instance.survey_id:
+        counters.apply_delta(instance.survey_id)
+    else:
+        count = Subquestion.objects.filter(question__category=instance).count()
+        counters.move(old_survey_id, instance.survey_id, count)
+
+
+@receiver(post_delete, sender=Category, dispatch_uid="category_delete_structure_version")
+def category_delete_structure_version(sender, instance, **kwargs):
+    counters.apply_delta(instance.survey_id)
+
+
+@receiver(post_save, sender=Answer, dispatch_uid="answer_create_completion")
+def answer_create_completion(sender, instance, created, **kwargs):
+    if not created:
+        return
+    from .completion import schedule_refresh
+    schedule_refresh(instance.participant_id, [instance.hospital_id])
+
+
+@receiver(post_delete, sender=Answer, dispatch_uid="answer_delete_completion")
+def answer_delete_completion(sender, instance, **kwargs):
+    from .completion import schedule_refresh
+    schedule_refresh(instance.participant_id, [instance.hospital_id])
+
+
+@receiver(post_save, sender=Answer, dispatch_uid="answer_save_stats")
+def answer_save_stats(sender, instance, **kwargs):
+    from .stats import schedule_invalidate
+    schedule_invalidate(participant_ids=[instance.participant_id])
+
+
+@receiver(post_delete, sender=Answer, dispatch_uid="answer_delete_stats")
+def answer_delete_stats(sender, instance, **kwargs):
+    from .stats import schedule_invalidate
+    schedule_invalidate(participant_ids=[instance.participant_id])
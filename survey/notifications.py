@@ -0,0 +1,280 @@
+"""
+Outbox of answer confirmations.
+
+Forms only enqueue a ``Notification`` row. The ``deliver_notifications``
+management command renders and sends pending rows outside of the request with
+retries and exponential backoff.
+
+With ``SURVEY_NOTIFICATION_DIGEST_WINDOW`` set, saves of a participant within the
+window are coalesced into a single digest per set of recipients, which lists only
+the answers changed in the meantime.
+"""
+import logging
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.db import connection as db_connection
+from django.db import transaction
+from django.db.models import F
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+from .mail import close_mail_connection, send_message
+from .models import Answer, Group, Hospital, Notification, Participant
+from .structure import get_structure
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = getattr(settings, 'SURVEY_NOTIFICATION_MAX_ATTEMPTS', 5)
+RETRY_DELAY = getattr(settings, 'SURVEY_NOTIFICATION_RETRY_DELAY', 60)
+LEASE_TIME = getattr(settings, 'SURVEY_NOTIFICATION_LEASE_TIME', 300)
+
+
+def get_digest_window():
+    return getattr(settings, 'SURVEY_NOTIFICATION_DIGEST_WINDOW', 300)
+
+
+def enqueue(participant, kind, recipients, hospital=None, question=None, changes=None):
+    """
+    Queues a confirmation of saved answers.
+
+    ``changes`` is a list of ``Change`` of the save. When given and the digest
+    window is enabled the changed cells are merged into a digest instead.
+    """
+    if not recipients:
+        return None
+    window = get_digest_window()
+    if changes is not None and window:
+        return enqueue_digest(participant, recipients, changes, window)
+    return Notification.objects.create(participant=participant,
+                                       kind=kind,
+                                       hospital_id=getattr(hospital, 'pk', None),
+                                       question_id=getattr(question, 'pk', None),
+                                       recipients="\n".join(recipients))
+
+
+def enqueue_digest(participant, recipients, changes, window):
+    """
+    Merges changed cells into an open digest of the participant or opens a new one.
+
+    A digest is open until a worker claims it, the row lock taken here makes the
+    claim wait until the merged cells are committed.
+    """
+    cells = {(change.hospital_id, change.subquestion_id) for change in changes}
+    if not cells:
+        return None
+    recipients = "\n".join(sorted(set(recipients)))
+    now = timezone.now()
+    with transaction.atomic():
+        notification = (Notification.objects.select_for_update().
+                        filter(participant=participant,
+                               kind=Notification.KIND.digest,
+                               recipients=recipients,
+                               status=Notification.STATUS.pending,
+                               attempts=0,
+                               created__gte=now - timedelta(seconds=window)).
+                        first())
+        if notification is None:
+            notification = Notification(participant=participant,
+                                        kind=Notification.KIND.digest,
+                                        recipients=recipients,
+                                        next_attempt_at=now + timedelta(seconds=window))
+        else:
+            cells |= notification.get_changes()
+        notification.set_changes(cells)
+        notification.save()
+    return notification
+
+
+def get_answers(participant, **kwargs):
+    qs = Answer.objects.filter(participant=participant, **kwargs).order_by()
+    return {(hospital_id, subquestion_id): answer
+            for hospital_id, subquestion_id, answer in qs.values_list('hospital_id',
+                                                                      'subquestion_id',
+                                                                      'answer')}
+
+
+def render_hospital(notification, participant, structure):
+    hospital = notification.hospital
+    answers = get_answers(participant, hospital=hospital)
+    output = []
+    for category in structure.categories:
+        question_set = []
+        for question in category.questions:
+            subquestion_set = []
+            for subquestion in question.subquestions:
+                answer = answers.get((hospital.pk, subquestion.pk), '')
+                subquestion_set.append(Group(subquestion, answer))
+            question_set.append(Group(question, subquestion_set))
+        output.append(Group(category, question_set))
+    linked_list = (Hospital.objects.
+                   filter(health_fund=participant.health_fund_id).
+                   with_completion(participant).
+                   linked(participant=participant.pk,
+                          password=participant.password,
+                          required=participant.survey.subquestion_count))
+    linked_list_left = [x for x in linked_list if not x.status]
+    linked_done = len(linked_list_left)
+    linked_total = len(linked_list)
+    linked_left = linked_total - linked_done
+    context = {'object_list': output,
+               'linked_list': linked_list,
+               'linked_list_left': linked_list_left,
+               'linked_done': linked_done,
+               'linked_total': linked_total,
+               'linked_left': linked_left,
+               'hospital': hospital,
+               'participant': participant}
+    return render_to_string('survey/survey_email.html', context)
+
+
+def render_participant(notification, participant, structure):
+    hospitals = participant.health_fund.hospital_set.all()
+    answers = get_answers(participant)
+    output = []
+    for category in structure.categories:
+        question_set = []
+        for question in category.questions:
+            subquestion_set = []
+            for subquestion in question.subquestions:
+                answer_set = []
+                for hospital in hospitals:
+                    data = answers.get((hospital.pk, subquestion.pk), '')
+                    answer_set.append((hospital, data))
+                subquestion_set.append(Group(subquestion, answer_set))
+            question_set.append((question, subquestion_set))
+        output.append(Group(category, question_set))
+    context = {'object_list': output,
+               'participant': participant}
+    return render_to_string('survey/participant_email.html', context)
+
+
+def render_question(notification, participant, structure):
+    hospitals = participant.health_fund.hospital_set.all()
+    question = structure.questions[notification.question_id]
+    answers = get_answers(participant, subquestion__question=question.pk)
+    subquestion_set = []
+    for subquestion in question.subquestions:
+        answer_set = []
+        for hospital in hospitals:
+            data = answers.get((hospital.pk, subquestion.pk), '')
+            answer_set.append((hospital, data))
+        subquestion_set.append(Group(subquestion, answer_set))
+    context = {'participant': participant,
+               'category': structure.get_category(question),
+               'survey': participant.survey,
+               'question': question,
+               'subquestion_set': subquestion_set}
+    return render_to_string('survey/question_email.html', context)
+
+
+def render_digest(notification, participant, structure):
+    changes = notification.get_changes()
+    hospital_ids = {hospital_id for hospital_id, _ in changes}
+    hospitals = participant.health_fund.hospital_set.filter(pk__in=hospital_ids)
+    answers = get_answers(participant, hospital__in=hospital_ids)
+    output = []
+    for category in structure.categories:
+        question_set = []
+        for question in category.questions:
+            subquestion_set = []
+            for subquestion in question.subquestions:
+                answer_set = [(hospital, answers.get((hospital.pk, subquestion.pk), ''))
+                              for hospital in hospitals
+                              if (hospital.pk, subquestion.pk) in changes]
+                if answer_set:
+                    subquestion_set.append(Group(subquestion, answer_set))
+            if subquestion_set:
+                question_set.append((question, subquestion_set))
+        if question_set:
+            output.append(Group(category, question_set))
+    context = {'object_list': output,
+               'participant': participant}
+    return render_to_string('survey/participant_email.html', context)
+
+
+RENDERERS = {Notification.KIND.hospital: render_hospital,
+             Notification.KIND.participant: render_participant,
+             Notification.KIND.question: render_question,
+             Notification.KIND.digest: render_digest}
+
+
+def render(notification):
+    participant = (Participant.objects.select_related('survey', 'health_fund').
+                   get(pk=notification.participant_id))
+    structure = get_structure(participant.survey)
+    return RENDERERS[notification.kind](notification, participant, structure)
+
+
+def claim(notification):
+    """
+    Takes a lease on the notification, returns False if another worker was faster.
+    """
+    now = timezone.now()
+    claimed = (Notification.objects.
+               filter(pk=notification.pk,
+                      status=Notification.STATUS.pending,
+                      next_attempt_at=notification.next_attempt_at).
+               update(next_attempt_at=now + timedelta(seconds=LEASE_TIME),
+                      attempts=F('attempts') + 1))
+    return claimed == 1
+
+
+def deliver(notification, backend=None):
+    """
+    Renders and sends a claimed notification, returns the resulting status.
+    """
+    notification.refresh_from_db()
+    try:
+        message = EmailMessage(_('Answer confirmation'),
+                               render(notification),
+                               settings.DEFAULT_FROM_EMAIL,
+                               notification.get_recipients())
+        send_message(message, backend)
+    except Exception as e:
+        logger.warning("Delivery of notification %s failed: %s", notification.pk, e)
+        if notification.attempts >= MAX_ATTEMPTS:
+            notification.status = Notification.STATUS.failed
+        else:
+            delay = RETRY_DELAY * 2 ** (notification.attempts - 1)
+            notification.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+        notification.last_error = str(e)
+        notification.save(update_fields=['status', 'next_attempt_at', 'last_error', 'modified'])
+        return notification.status
+    notification.status = Notification.STATUS.sent
+    notification.sent_at = timezone.now()
+    notification.last_error = ''
+    notification.save(update_fields=['status', 'sent_at', 'last_error', 'modified'])
+    return notification.status
+
+
+def _deliver_in_thread(notifications, backend=None):
+    try:
+        return [deliver(x, backend) for x in notifications]
+    finally:
+        close_mail_connection()
+        db_connection.close()
+
+
+def deliver_pending(limit=100, workers=1, backend=None):
+    """
+    Delivers a batch of due notifications.
+
+    Notifications are sent over the persistent mail connection of the calling
+    thread. With more than one worker they are split between threads, each with
+    its own database and mail connection. Returns a ``Counter`` of resulting
+    statuses.
+    """
+    claimed = [x for x in Notification.objects.pending()[:limit] if claim(x)]
+    if workers > 1 and len(claimed) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_deliver_in_thread, claimed[i::workers], backend)
+                       for i in range(workers)]
+            statuses = [status for future in futures for status in future.result()]
+    else:
+        statuses = [deliver(x, backend) for x in claimed]
+    return Counter(statuses)
@@ -0,0 +1,186 @@
+"""
+Data quality checks of numeric answers.
+
+Answers are loaded into a matrix by ``analytics.load_numeric`` and checked
+column-wise for outliers (robust z-score and interquartile range) and row-wise
+against active ``QualityRule`` of the survey, both with NumPy. Outliers are
+scored against answers of the same health fund, or of all health funds in
+columns where the fund has fewer than ``MIN_COUNT`` values, see
+``score_outliers``. Problems are saved as ``QualityIssue``. A check may be
+limited to participants whose answers changed since their last check, see
+``get_changed_participant_ids``; outliers are still detected against answers
+of all participants.
+"""
+import operator
+import warnings
+from collections import namedtuple
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .analytics import load_numeric
+from .models import Participant, QualityIssue, QualityRule
+
+ZSCORE_THRESHOLD = getattr(settings, 'SURVEY_QUALITY_ZSCORE_THRESHOLD', 3.5)
+IQR_FACTOR = getattr(settings, 'SURVEY_QUALITY_IQR_FACTOR', 3.0)
+# Columns with fewer values are not checked for outliers
+MIN_COUNT = getattr(settings, 'SURVEY_QUALITY_MIN_COUNT', 5)
+
+OutlierScores = namedtuple('OutlierScores', ['zscores', 'iqr', 'medians', 'q1', 'q3', 'enough', 'local'])
+
+OPERATORS = {QualityRule.OPERATOR.lt: operator.lt,
+             QualityRule.OPERATOR.lte: operator.le,
+             QualityRule.OPERATOR.eq: operator.eq,
+             QualityRule.OPERATOR.gte: operator.ge,
+             QualityRule.OPERATOR.gt: operator.gt}
+
+
+def robust_zscores(values):
+    """
+    Returns robust z-scores of the matrix and medians of its columns.
+
+    The median absolute deviation is replaced by the mean absolute deviation
+    in columns where most values are equal. Scores are NaN in constant columns.
+    """
+    medians = np.nanmedian(values, axis=0)
+    deviations = np.abs(values - medians)
+    scale = np.nanmedian(deviations, axis=0) * 1.4826
+    scale = np.where(scale > 0, scale, np.nanmean(deviations, axis=0) * 1.2533)
+    scale[scale == 0] = np.nan
+    return (values - medians) / scale, medians
+
+
+def iqr_scores(values):
+    """
+    Returns distances of values outside of the interquartile range in IQR units and the quartiles.
+    """
+    q1, q3 = np.nanpercentile(values, [25, 75], axis=0)
+    iqr = q3 - q1
+    iqr[iqr == 0] = np.nan
+    return np.maximum(q1 - values, values - q3) / iqr, q1, q3
+
+
+def score_outliers(data):
+    """
+    Returns ``OutlierScores`` of the values, every field a matrix of their shape.
+
+    Cells of a health fund with at least ``MIN_COUNT`` values in the column are
+    scored against that fund and marked ``local``, the others against all funds.
+    ``enough`` marks cells of columns with enough values to be checked at all.
+    """
+    values = data.values
+    zscores, medians = robust_zscores(values)
+    iqr, q1, q3 = iqr_scores(values)
+    medians, q1, q3 = (np.broadcast_to(x, values.shape).copy() for x in (medians, q1, q3))
+    enough = np.broadcast_to(np.sum(~np.isnan(values), axis=0) >= MIN_COUNT, values.shape).copy()
+    local = np.zeros(values.shape, dtype=bool)
+    for pk in np.unique(data.row_health_funds):
+        rows = np.nonzero(data.row_health_funds == pk)[0]
+        columns = np.nonzero(np.sum(~np.isnan(values[rows]), axis=0) >= MIN_COUNT)[0]
+        if not len(columns):
+            continue
+        cells = np.ix_(rows, columns)
+        zscores[cells], medians[cells] = robust_zscores(values[cells])
+        iqr[cells], q1[cells], q3[cells] = iqr_scores(values[cells])
+        enough[cells] = local[cells] = True
+    return OutlierScores(np.abs(zscores), iqr, medians, q1, q3, enough, local)
+
+
+def rule_scores(data, rules):
+    """
+    Yields every rule with relative differences of rows breaking it, NaN for other rows.
+
+    Rules of subquestions which are not numeric are skipped.
+    """
+    index = {column.pk: i for i, column in enumerate(data.columns)}
+    for rule in rules:
+        if rule.left_id not in index or rule.right_id not in index:
+            continue
+        left = data.values[:, index[rule.left_id]]
+        right = data.values[:, index[rule.right_id]] * rule.factor
+        broken = ~OPERATORS[rule.operator](left, right) & ~np.isnan(left) & ~np.isnan(right)
+        scores = np.abs(left - right) / np.maximum(np.abs(right), 1)
+        yield rule, np.where(broken, scores, np.nan)
+
+
+def find_issues(data, rules, rows=None):
+    """
+    Returns unsaved ``QualityIssue`` of rows selected by a boolean mask, all rows by default.
+    """
+    rows = np.ones(len(data.values), dtype=bool) if rows is None else rows
+    health_funds = dict(data.health_funds)
+    issues = []
+
+    def add(row, column, kind, score, message, rule=None):
+        issues.append(QualityIssue(participant_id=int(data.row_participants[row]),
+                                   hospital_id=int(data.row_hospitals[row]),
+                                   subquestion_id=data.columns[column].pk,
+                                   rule=rule,
+                                   kind=kind,
+                                   value=float(data.values[row, column]),
+                                   score=float(score),
+                                   message=message[:250]))
+
+    def get_scope(row, column):
+        name = data.columns[column].name
+        if not scores.local[row, column]:
+            return name
+        return "{name} in {health_fund}".format(name=name,
+                                                health_fund=health_funds.get(data.row_health_funds[row]))
+
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        scores = score_outliers(data)
+        checked = scores.enough & rows[:, None]
+        for row, column in zip(*np.nonzero((scores.zscores > ZSCORE_THRESHOLD) & checked)):
+            add(row, column, QualityIssue.KIND.zscore, scores.zscores[row, column],
+                "{value:g} is far from the median {median:g} of {scope}".format(
+                    value=data.values[row, column], median=scores.medians[row, column],
+                    scope=get_scope(row, column)))
+        for row, column in zip(*np.nonzero((scores.iqr > IQR_FACTOR) & checked)):
+            add(row, column, QualityIssue.KIND.iqr, scores.iqr[row, column],
+                "{value:g} is outside of the quartiles {q1:g} - {q3:g} of {scope}".format(
+                    value=data.values[row, column], q1=scores.q1[row, column], q3=scores.q3[row, column],
+                    scope=get_scope(row, column)))
+        index = {column.pk: i for i, column in enumerate(data.columns)}
+        for rule, differences in rule_scores(data, rules):
+            for row in np.nonzero(~np.isnan(differences) & rows)[0]:
+                add(row, index[rule.left_id], QualityIssue.KIND.rule, differences[row], rule.name, rule=rule)
+    return issues
+
+
+def get_changed_participant_ids(survey):
+    """
+    Returns ids of participants of the survey never checked or with answers saved since the last check.
+    """
+    return list(Participant.objects.filter(survey=survey).
+                filter(Q(quality_checked_at=None) | Q(answer__modified__gt=F('quality_checked_at'))).
+                order_by().
+                values_list('pk', flat=True).
+                distinct())
+
+
+def check_quality(survey, participant_ids=None):
+    """
+    Replaces quality issues of given participants of the survey, all by default.
+
+    Returns the number of found issues.
+    """
+    started = timezone.now()
+    if participant_ids is None:
+        participant_ids = list(Participant.objects.filter(survey=survey).values_list('pk', flat=True))
+    if not participant_ids:
+        return 0
+    data = load_numeric(survey)
+    rules = list(QualityRule.objects.filter(survey=survey, active=True))
+    issues = []
+    if len(data.values):
+        issues = find_issues(data, rules, np.isin(data.row_participants, participant_ids))
+    with transaction.atomic():
+        QualityIssue.objects.filter(participant__in=participant_ids).delete()
+        QualityIssue.objects.bulk_create(issues, batch_size=500)
+        Participant.objects.filter(pk__in=participant_ids).update(quality_checked_at=started)
+    return len(issues)
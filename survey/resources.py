@@ -12,9 +12,11 @@ class NationalHealthFundResource(resources.ModelResource):
 
     class Meta:
         model = NationalHealtFund
+        exclude = ('hospital_count', )
 
 
 class ParticipantResource(resources.ModelResource):
 
     class Meta:
         model = Participant
+        exclude = ('quality_checked_at', )
@@ -0,0 +1,178 @@
+"""
+Progress statistics of a survey read with grouped queries and cached, so that
+the statistics pages stay cheap when refreshed by many users.
+
+The progress of participants is cached briefly. The completion matrix of health
+funds and questions is cached until answers or hospitals of the survey change,
+see ``invalidate`` and ``schedule_invalidate``. Caches are shared by processes
+only with a shared cache backend, as the one of production settings.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.db.models import Count, Q
+
+from .models import Answer, CompletionStatus, Participant
+from .structure import get_structure
+
+CACHE_TIMEOUT = getattr(settings, 'SURVEY_STATS_CACHE_TIMEOUT', 30)
+MATRIX_CACHE_TIMEOUT = getattr(settings, 'SURVEY_MATRIX_CACHE_TIMEOUT', 60 * 60)
+
+CompletionMatrix = namedtuple('CompletionMatrix', ['health_funds', 'rows'])
+MatrixRow = namedtuple('MatrixRow', ['obj', 'cells', 'children'])
+
+_state = threading.local()
+
+
+def get_progress(answer_count, required_count):
+    if not required_count:
+        return 0.0
+    return answer_count / required_count * 100
+
+
+class ParticipantProgress(namedtuple('ParticipantProgress', ['pk', 'password', 'health_fund',
+                                                             'answer_count', 'required_count'])):
+    __slots__ = ()
+
+    @property
+    def progress(self):
+        return get_progress(self.answer_count, self.required_count)
+
+    def get_progress_display(self):
+        return "{0:d} / {1:d} = {2:.2f} %".format(self.answer_count,
+                                                  self.required_count,
+                                                  self.progress)
+
+    def get_absolute_url(self):
+        return reverse('survey:list', kwargs={'participant': str(self.pk),
+                                              'password': self.password})
+
+
+class SurveyProgress(namedtuple('SurveyProgress', ['participants', 'answer_count', 'required_count'])):
+    __slots__ = ()
+
+    @property
+    def progress(self):
+        return get_progress(self.answer_count, self.required_count)
+
+
+def get_cache_key(survey_id):
+    return 'survey-progress-{0}'.format(survey_id)
+
+
+def get_matrix_cache_key(survey_id):
+    return 'survey-completion-matrix-{0}'.format(survey_id)
+
+
+def invalidate(survey_id):
+    cache.delete_many([get_cache_key(survey_id), get_matrix_cache_key(survey_id)])
+
+
+def _invalidate_pending():
+    participant_ids, health_fund_ids = getattr(_state, 'pending', None) or (set(), set())
+    _state.pending = None
+    survey_ids = set(Participant.objects.filter(Q(pk__in=participant_ids) | Q(health_fund__in=health_fund_ids)).
+                     values_list('survey_id', flat=True))
+    for survey_id in survey_ids:
+        invalidate(survey_id)
+
+
+def _is_scheduled():
+    return any(func is _invalidate_pending for _, func in connection.run_on_commit)
+
+
+def schedule_invalidate(participant_ids=(), health_fund_ids=()):
+    """
+    Invalidates statistics of surveys of the participants and of participants
+    of the health funds once the current transaction commits.
+
+    Surveys are looked up with one query however many answers or hospitals a
+    transaction changes.
+    """
+    if not connection.in_atomic_block:
+        _state.pending = (set(participant_ids), set(health_fund_ids))
+        _invalidate_pending()
+        return
+    if not _is_scheduled():
+        _state.pending = (set(), set())
+        transaction.on_commit(_invalidate_pending)
+    _state.pending[0].update(participant_ids)
+    _state.pending[1].update(health_fund_ids)
+
+
+def build_survey_progress(survey_id):
+    participants = [ParticipantProgress(pk, password, health_fund, answer_count,
+                                        subquestion_count * hospital_count)
+                    for pk, password, health_fund, answer_count, subquestion_count, hospital_count in
+                    (Participant.objects.filter(survey=survey_id).
+                     values_list('pk', 'password', 'health_fund__name', 'answer_count',
+                                 'survey__subquestion_count', 'health_fund__hospital_count'))]
+    return SurveyProgress(participants,
+                          sum(x.answer_count for x in participants),
+                          sum(x.required_count for x in participants))
+
+
+def get_survey_progress(survey):
+    """
+    Returns ``SurveyProgress`` of the survey, cached for ``SURVEY_STATS_CACHE_TIMEOUT`` seconds.
+    """
+    key = get_cache_key(survey.pk)
+    progress = cache.get(key)
+    if progress is None:
+        progress = build_survey_progress(survey.pk)
+        cache.set(key, progress, CACHE_TIMEOUT)
+    return progress
+
+
+def sum_cells(rows, count):
+    return [CompletionStatus(sum(row.cells[i].count for row in rows),
+                             sum(row.cells[i].required for row in rows))
+            for i in range(count)]
+
+
+def build_completion_matrix(survey):
+    """
+    Returns completion of categories and their questions per health fund.
+
+    Answers are counted with one query grouped by health fund and question.
+    """
+    structure = get_structure(survey)
+    health_funds = OrderedDict()
+    for pk, name, hospital_count in (Participant.objects.filter(survey=survey).
+                                     order_by('health_fund__name').
+                                     values_list('health_fund_id', 'health_fund__name',
+                                                 'health_fund__hospital_count')):
+        name, total = health_funds.get(pk, (name, 0))
+        health_funds[pk] = (name, total + hospital_count)
+    counts = {(row['participant__health_fund_id'], row['subquestion__question_id']): row['count']
+              for row in (Answer.objects.filter(participant__survey=survey).
+                          order_by().
+                          values('participant__health_fund_id', 'subquestion__question_id').
+                          annotate(count=Count('pk')))}
+    rows = []
+    for category in structure.categories:
+        children = [MatrixRow(question,
+                              [CompletionStatus(counts.get((pk, question.pk), 0),
+                                                len(question.subquestions) * hospital_count)
+                               for pk, (_, hospital_count) in health_funds.items()],
+                              ())
+                    for question in category.questions]
+        rows.append(MatrixRow(category, sum_cells(children, len(health_funds)), children))
+    return CompletionMatrix([name for name, _ in health_funds.values()], rows)
+
+
+def get_completion_matrix(survey):
+    """
+    Returns ``CompletionMatrix`` of the survey, cached until answers or structure change.
+    """
+    key = get_matrix_cache_key(survey.pk)
+    cached = cache.get(key)
+    if cached is not None and cached[0] == survey.structure_version:
+        return cached[1]
+    matrix = build_completion_matrix(survey)
+    cache.set(key, (survey.structure_version, matrix), MATRIX_CACHE_TIMEOUT)
+    return matrix
@@ -0,0 +1,151 @@
+"""
+Immutable snapshot of the Category -> Question -> Subquestion tree of a survey.
+
+The snapshot is built with three flat queries and cached in the process and in
+the Django cache under a key containing ``Survey.structure_version``, which is
+bumped by the signal handlers whenever the structure changes.
+"""
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.utils.encoding import python_2_unicode_compatible
+
+from .models import (Category, CompletionStatus, LinkedCategory,
+                     LinkedQuestion, Question, Subquestion)
+
+CACHE_TIMEOUT = getattr(settings, 'SURVEY_STRUCTURE_CACHE_TIMEOUT', 60 * 60 * 24)
+# Snapshots kept in the process, see survey.fieldspecs
+CACHE_SIZE = getattr(settings, 'SURVEY_STRUCTURE_CACHE_SIZE', 64)
+
+_local_cache = {}
+
+
+@python_2_unicode_compatible
+class CategoryNode(namedtuple('CategoryNode', ['pk', 'name', 'description', 'questions'])):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+
+@python_2_unicode_compatible
+class QuestionNode(namedtuple('QuestionNode', ['pk', 'name', 'category_id', 'subquestions'])):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+
+@python_2_unicode_compatible
+class SubquestionNode(namedtuple('SubquestionNode', ['pk', 'name', 'kind', 'question_id'])):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+
+class SurveyStructure(object):
+
+    def __init__(self, survey_id, version, categories):
+        self.survey_id = survey_id
+        self.version = version
+        self.categories = categories
+        self.questions = {question.pk: question
+                          for category in categories
+                          for question in category.questions}
+        self.subquestions = {subquestion.pk: subquestion
+                             for question in self.questions.values()
+                             for subquestion in question.subquestions}
+
+    def __getstate__(self):
+        return (self.survey_id, self.version, self.categories)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def iter_questions(self):
+        for category in self.categories:
+            for question in category.questions:
+                yield question
+
+    def iter_subquestions(self):
+        for question in self.iter_questions():
+            for subquestion in question.subquestions:
+                yield subquestion
+
+    def question_ids(self):
+        return [question.pk for question in self.iter_questions()]
+
+    def get_category(self, question):
+        return next(x for x in self.categories if x.pk == question.category_id)
+
+    def __len__(self):
+        return len(self.subquestions)
+
+
+def build_structure(survey_id, version):
+    subquestions = {}
+    for pk, name, kind, question_id in (Subquestion.objects.
+                                        filter(question__category__survey=survey_id).
+                                        values_list('pk', 'name', 'kind', 'question_id')):
+        subquestions.setdefault(question_id, []).append(SubquestionNode(pk, name, kind, question_id))
+    questions = {}
+    for pk, name, category_id in (Question.objects.
+                                  filter(category__survey=survey_id).
+                                  values_list('pk', 'name', 'category_id')):
+        node = QuestionNode(pk, name, category_id, tuple(subquestions.get(pk, ())))
+        questions.setdefault(category_id, []).append(node)
+    categories = tuple(CategoryNode(pk, name, description, tuple(questions.get(pk, ())))
+                       for pk, name, description in (Category.objects.
+                                                     filter(survey=survey_id).
+                                                     values_list('pk', 'name', 'description')))
+    return SurveyStructure(survey_id, version, categories)
+
+
+def get_version(survey):
+    # The creation time guards against reused primary keys, eg. after restoring a database
+    return '{created:%Y%m%d%H%M%S%f}-{version}'.format(created=survey.created,
+                                                       version=survey.structure_version)
+
+
+def get_cache_key(survey_id, version):
+    return 'survey-structure-{survey}-{version}'.format(survey=survey_id, version=version)
+
+
+def get_structure(survey):
+    """
+    Returns the structure of the survey for its current ``structure_version``.
+    """
+    version = get_version(survey)
+    structure = _local_cache.get(survey.pk)
+    if structure is not None and structure.version == version:
+        return structure
+    key = get_cache_key(survey.pk, version)
+    structure = cache.get(key)
+    if structure is None:
+        structure = build_structure(survey.pk, version)
+        cache.set(key, structure, CACHE_TIMEOUT)
+    if survey.pk not in _local_cache and len(_local_cache) >= CACHE_SIZE:
+        _local_cache.clear()
+    _local_cache[survey.pk] = structure
+    return structure
+
+
+def linked_categories(structure, password, participant, completion=None):
+    completion = completion or {}
+    domain = Site.objects.get_current().domain
+    output = []
+    for category in structure.categories:
+        question_set = []
+        for question in category.questions:
+            link = reverse('survey:survey', kwargs={'password': password,
+                                                    'participant': participant,
+                                                    'question': question.pk})
+            link = 'http://%s%s' % (domain, link)
+            status = completion.get(question.pk, CompletionStatus(0, None))
+            question_set.append(LinkedQuestion(question, link, status))
+        output.append(LinkedCategory(obj=category, question_set=question_set))
+    return output
@@ -1,14 +1,65 @@
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import timedelta
+from importlib.util import find_spec
+from io import BytesIO, StringIO
+from smtplib import SMTPException
+from unittest import mock, skipUnless
+
+import reversion
 from ankieta_nfz.users.factories import UserFactory
+from django import forms
+from django.contrib import admin
+from django.contrib.messages.storage.cookie import CookieStorage
 from django.core import mail
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.test import TestCase
-
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.http import Http404
+from django.test import (Client, RequestFactory, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import numpy as np
+from reversion.models import Version
+
+from .analytics import get_summaries, iter_summary_csv, to_numbers
+from .answers import fill_values, update_answers, upsert_answers
+from .artifacts import build_artifact, get_artifact
+from .comparisons import build_comparison, get_hospital_changes
+from .completion import (get_answer_count, get_cell_completion,
+                         get_question_completion, get_section_completion,
+                         is_complete)
+from .counters import counter_batch, reconcile_hospital_count, suspend_counters
+from .admin import SurveyAdmin
+from .exports import (ENGINES, HEADER, get_changes, get_key, iter_csv,
+                      iter_jsonl, write_parquet)
+from .fieldspecs import compile_fields
 from .factories import (AnswerFactory, CategoryFactory, HospitalFactory,
                         NationalHealtFundFactory, ParticipantFactory,
                         QuestionFactory, SubquestionFactory, SurveyFactory)
-from .forms import (ParticipantForm, QuestionForm, SurveyForm,
-                    values_or_integer_validator)
-from .models import Subquestion
+from .forms import (AutosaveForm, ParticipantForm, QuestionForm, SurveyForm,
+                    UploadForm, values_or_integer_validator)
+from .mail import get_staff_recipients, send_message, stats as mail_stats
+from .models import (Answer, Comparison, Hospital, HospitalCompletion,
+                     NationalHealtFund, Notification, Participant,
+                     QualityIssue, QualityRule, QuestionCompletion,
+                     StashedUpload, Subquestion, Survey)
+from .notifications import MAX_ATTEMPTS, deliver_pending
+from .quality import check_quality, get_changed_participant_ids
+from .stats import get_completion_matrix, get_survey_progress
+from . import structure as structure_module
+from .structure import get_structure
+from .uploads import read_upload
+from .views import Section
 
 
 class NationalHealtFundFactoryTestCase(TestCase):
@@ -67,6 +118,7 @@ class AnswerFactoryTestCase(TestCase):
                          answer.participant.survey)
 
 
+@override_settings(SURVEY_NOTIFICATION_DIGEST_WINDOW=0)
 class SurveyFormTestCase(TestCase):
 
     def setUp(self):
@@ -107,6 +159,7 @@ class SurveyFormTestCase(TestCase):
                           user=UserFactory())
         self.assertEqual(form.is_valid(), True)
         form.save()
+        deliver_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn(TEXT, mail.outbox[0].body)
 
@@ -119,6 +172,7 @@ class SurveyFormTestCase(TestCase):
                           user=UserFactory())
         self.assertEqual(form.is_valid(), True)
         form.save()
+        deliver_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn(u.email, mail.outbox[0].to)
 
@@ -130,6 +184,7 @@ class SurveyFormTestCase(TestCase):
                           user=UserFactory(is_staff=False))
         self.assertEqual(form.is_valid(), True)
         form.save()
+        deliver_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].to[0], self.participant.health_fund.email)
 
@@ -141,6 +196,7 @@ class SurveyFormTestCase(TestCase):
                           user=UserFactory(is_staff=False))
         self.assertEqual(form.is_valid(), True)
         form.save()
+        deliver_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].to[0], self.participant.health_fund.email)
 
@@ -166,6 +222,7 @@ class SurveyFormTestCase(TestCase):
         self.assertIn(answer.answer, form.as_p())
 
 
+@override_settings(SURVEY_NOTIFICATION_DIGEST_WINDOW=0)
 class ParticipantFormTestCase(TestCase):
 
     def setUp(self):
@@ -195,6 +252,7 @@ class ParticipantFormTestCase(TestCase):
                                user=UserFactory())
         self.assertEqual(form.is_valid(), True)
         form.save()
+        deliver_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn(TEXT, mail.outbox[0].body)
 
@@ -206,6 +264,7 @@ class ParticipantFormTestCase(TestCase):
                                user=UserFactory())
         self.assertEqual(form.is_valid(), True)
         form.save()
+        deliver_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn(u.email, mail.outbox[0].to)
 
@@ -216,6 +275,7 @@ class ParticipantFormTestCase(TestCase):
                                user=UserFactory(is_staff=False))
         self.assertEqual(form.is_valid(), True)
         form.save()
+        deliver_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].to[0], self.participant.health_fund.email)
 
@@ -226,6 +286,7 @@ class ParticipantFormTestCase(TestCase):
                                user=UserFactory(is_staff=False))
         self.assertEqual(form.is_valid(), True)
         form.save()
+        deliver_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].to[0], self.participant.health_fund.email)
 
@@ -249,6 +310,7 @@ class ParticipantFormTestCase(TestCase):
         self.assertIn(answer.answer, form.as_p())
 
 
+@override_settings(SURVEY_NOTIFICATION_DIGEST_WINDOW=0)
 class QuestionFormTestCase(TestCase):
 
     def setUp(self):
@@ -286,6 +348,7 @@ class QuestionFormTestCase(TestCase):
                             user=UserFactory())
         self.assertEqual(form.is_valid(), True)
         form.save()
+        deliver_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn(TEXT, mail.outbox[0].body)
 
@@ -298,6 +361,7 @@ class QuestionFormTestCase(TestCase):
                             user=UserFactory())
         self.assertEqual(form.is_valid(), True)
         form.save()
+        deliver_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn(u.email, mail.outbox[0].to)
 
@@ -309,6 +373,7 @@ class QuestionFormTestCase(TestCase):
                             user=UserFactory(is_staff=False))
         self.assertEqual(form.is_valid(), True)
         form.save()
+        deliver_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].to[0], self.participant.health_fund.email)
 
@@ -320,6 +385,7 @@ class QuestionFormTestCase(TestCase):
                             user=UserFactory(is_staff=False))
         self.assertEqual(form.is_valid(), True)
         form.save()
+        deliver_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].to[0], self.participant.health_fund.email)
 
@@ -375,3 +441,1351 @@ class ValidatorsTestCase(TestCase):
         for value in invalid:
             with self.assertRaises(expected_exception=ValidationError):
                 validator(value)
+
+
+class SubquestionCounterTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.survey = self.question.category.survey
+
+    def get_count(self, survey=None):
+        return Survey.objects.get(pk=(survey or self.survey).pk).subquestion_count
+
+    def test_increment_on_create(self):
+        SubquestionFactory.create_batch(size=3, question=self.question)
+        self.assertEqual(self.get_count(), 3)
+
+    def test_decrement_on_delete(self):
+        subquestions = SubquestionFactory.create_batch(size=3, question=self.question)
+        subquestions[0].delete()
+        self.assertEqual(self.get_count(), 2)
+
+    def test_move_subquestion_between_surveys(self):
+        subquestion = SubquestionFactory(question=self.question)
+        other = QuestionFactory()
+        subquestion.question = other
+        subquestion.save()
+        self.assertEqual(self.get_count(), 0)
+        self.assertEqual(self.get_count(other.category.survey), 1)
+
+    def test_move_question_between_surveys(self):
+        SubquestionFactory.create_batch(size=2, question=self.question)
+        other = CategoryFactory()
+        self.question.category = other
+        self.question.save()
+        self.assertEqual(self.get_count(), 0)
+        self.assertEqual(self.get_count(other.survey), 2)
+
+    def test_batch_applies_on_exit(self):
+        with counter_batch():
+            SubquestionFactory.create_batch(size=3, question=self.question)
+            self.assertEqual(self.get_count(), 0)
+        self.assertEqual(self.get_count(), 3)
+
+    def test_suspend_reconciles_on_exit(self):
+        with suspend_counters(survey_ids=[self.survey.pk]):
+            SubquestionFactory.create_batch(size=3, question=self.question)
+            self.assertEqual(self.get_count(), 0)
+        self.assertEqual(self.get_count(), 3)
+
+    def test_reconcile_command(self):
+        SubquestionFactory.create_batch(size=3, question=self.question)
+        answer = AnswerFactory(subquestion=SubquestionFactory(question=self.question))
+        Survey.objects.update(subquestion_count=0)
+        call_command('reconcile_counters', stdout=StringIO())
+        self.assertEqual(self.get_count(), 4)
+        self.assertEqual(Participant.objects.get(pk=answer.participant_id).answer_count, 1)
+
+
+class SurveyStructureTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.subquestions = SubquestionFactory.create_batch(size=3, question=self.question)
+
+    def get_survey(self):
+        return Survey.objects.get(pk=self.question.category.survey_id)
+
+    def test_tree(self):
+        structure = get_structure(self.get_survey())
+        self.assertEqual(len(structure.categories), 1)
+        self.assertEqual(structure.categories[0].questions[0].pk, self.question.pk)
+        self.assertEqual([x.pk for x in structure.iter_subquestions()],
+                         [x.pk for x in self.subquestions])
+
+    def test_cached_for_same_version(self):
+        survey = self.get_survey()
+        get_structure(survey)
+        with self.assertNumQueries(0):
+            get_structure(survey)
+
+    def test_version_bumped_on_change(self):
+        version = self.get_survey().structure_version
+        self.subquestions[0].name = "Changed"
+        self.subquestions[0].save()
+        survey = self.get_survey()
+        self.assertGreater(survey.structure_version, version)
+        self.assertEqual(get_structure(survey).subquestions[self.subquestions[0].pk].name, "Changed")
+
+    def test_local_cache_is_bounded(self):
+        surveys = [self.get_survey()] + [SurveyFactory() for _ in range(2)]
+        with mock.patch.object(structure_module, 'CACHE_SIZE', 2):
+            for survey in surveys:
+                get_structure(survey)
+            self.assertLessEqual(len(structure_module._local_cache), 2)
+            self.assertIn(surveys[-1].pk, structure_module._local_cache)
+
+
+class UpsertAnswersTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.subquestions = SubquestionFactory.create_batch(size=10, question=self.question)
+        self.participant = ParticipantFactory(survey=self.question.category.survey)
+        self.hospital = HospitalFactory(health_fund=self.participant.health_fund)
+
+    def get_rows(self, subquestions, value='1'):
+        return [(self.hospital.pk, x.pk, value) for x in subquestions]
+
+    def test_report_created_changed_unchanged(self):
+        upsert_answers(self.participant, self.get_rows(self.subquestions[:4]))
+        rows = self.get_rows(self.subquestions[:2]) + self.get_rows(self.subquestions[2:6], '2')
+        result = upsert_answers(self.participant, rows)
+        self.assertEqual(len(result.unchanged), 2)
+        self.assertEqual(len(result.changed), 2)
+        self.assertEqual(len(result.created), 2)
+        self.assertEqual(Answer.objects.filter(participant=self.participant).count(), 6)
+        self.assertEqual(Participant.objects.get(pk=self.participant.pk).answer_count, 6)
+
+    def test_constant_number_of_queries(self):
+        with CaptureQueriesContext(connection) as small:
+            upsert_answers(self.participant, self.get_rows(self.subquestions[:2]))
+        with CaptureQueriesContext(connection) as large:
+            upsert_answers(self.participant, self.get_rows(self.subquestions[2:]))
+        self.assertEqual(len(small), len(large))
+
+    def test_modified_answers_added_to_revision(self):
+        upsert_answers(self.participant, self.get_rows(self.subquestions[:2]))
+        with reversion.create_revision():
+            upsert_answers(self.participant,
+                           self.get_rows(self.subquestions[:1]) + self.get_rows(self.subquestions[1:3], '2'))
+        versions = Version.objects.get_for_model(Answer)
+        self.assertEqual(sorted(versions.values_list('object_id', flat=True)),
+                         sorted(str(x.pk) for x in Answer.objects.exclude(subquestion=self.subquestions[0])))
+
+    def test_survey_form_saved_twice_keeps_single_answer(self):
+        data = {("sq-%d" % (x.pk)): x.pk for x in self.subquestions}
+        for _ in range(2):
+            form = SurveyForm(data,
+                              participant=self.participant,
+                              hospital=self.hospital,
+                              user=UserFactory())
+            self.assertEqual(form.is_valid(), True)
+            form.save()
+        self.assertEqual(Answer.objects.filter(participant=self.participant).count(), 10)
+
+
+class UpdateAnswersTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.subquestions = SubquestionFactory.create_batch(size=5, question=self.question)
+        self.participant = ParticipantFactory(survey=self.question.category.survey)
+        self.hospitals = HospitalFactory.create_batch(size=3,
+                                                      health_fund=self.participant.health_fund)
+
+    def get_data(self, value):
+        return {("h-%d-sq-%d" % (h.pk, sq.pk)): value for sq in self.subquestions
+                for h in self.hospitals}
+
+    def save_form(self, data):
+        form = QuestionForm(data,
+                            question=self.question,
+                            participant=self.participant,
+                            user=UserFactory())
+        self.assertEqual(form.is_valid(), True)
+        return form.save()
+
+    def test_update_changed_cells(self):
+        self.save_form(self.get_data('1'))
+        data = self.get_data('1')
+        data["h-%d-sq-%d" % (self.hospitals[0].pk, self.subquestions[0].pk)] = '2'
+        result = self.save_form(data)
+        self.assertEqual(len(result.created), 0)
+        self.assertEqual([(x.old, x.new) for x in result.changed], [('1', '2')])
+        answer = Answer.objects.get(hospital=self.hospitals[0], subquestion=self.subquestions[0])
+        self.assertEqual(answer.answer, '2')
+        self.assertGreater(answer.modified, answer.created)
+
+    def test_skip_unchanged_cells(self):
+        self.save_form(self.get_data('1'))
+        key = "h-%d-sq-%d" % (self.hospitals[1].pk, self.subquestions[2].pk)
+        data = self.get_data('1')
+        data[key] = '2'
+        form = QuestionForm(data,
+                            question=self.question,
+                            participant=self.participant,
+                            user=UserFactory())
+        self.assertEqual(form.is_valid(), True)
+        self.assertEqual(form.changed_data, [key])
+        self.assertEqual(list(form.cleaned_data), [key])
+        result = form.save()
+        self.assertEqual(len(result.changed), 1)
+        self.assertEqual(len(result.unchanged), 0)
+
+    def test_change_manifest(self):
+        self.save_form(self.get_data('1'))
+        keys = ["h-%d-sq-%d" % (h.pk, self.subquestions[0].pk) for h in self.hospitals[:2]]
+        data = self.get_data('1')
+        data.update({key: '2' for key in keys})
+        # Edits missing from the manifest are still found
+        data['changed'] = ','.join(keys[:1] + ['sq-0'])
+        result = self.save_form(data)
+        self.assertEqual(sorted((x.hospital_id, x.subquestion_id) for x in result.changed),
+                         [(h.pk, self.subquestions[0].pk) for h in self.hospitals[:2]])
+
+    def test_untouched_empty_cell_is_required(self):
+        data = self.get_data('1')
+        key = "h-%d-sq-%d" % (self.hospitals[0].pk, self.subquestions[0].pk)
+        data[key] = ''
+        form = QuestionForm(data,
+                            question=self.question,
+                            participant=self.participant,
+                            user=UserFactory())
+        self.assertEqual(form.is_valid(), False)
+        self.assertEqual(list(form.errors), [key])
+
+    def test_cleared_answer_is_invalid(self):
+        self.save_form(self.get_data('1'))
+        data = self.get_data('1')
+        data["h-%d-sq-%d" % (self.hospitals[0].pk, self.subquestions[0].pk)] = ''
+        form = QuestionForm(data,
+                            question=self.question,
+                            participant=self.participant,
+                            user=UserFactory())
+        self.assertEqual(form.is_valid(), False)
+
+    def test_update_in_chunks(self):
+        upsert_answers(self.participant, [(h.pk, sq.pk, 'a') for h in self.hospitals
+                                          for sq in self.subquestions])
+        result = upsert_answers(self.participant, [(h.pk, sq.pk, 'b') for h in self.hospitals
+                                                   for sq in self.subquestions])
+        # Kinds of subquestions are passed, so only the UPDATE is counted
+        with self.settings(DEBUG=True), CaptureQueriesContext(connection) as queries:
+            update_answers([x._replace(new='c') for x in result.changed], numeric_ids=set())
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(set(Answer.objects.values_list('answer', flat=True)), {'c'})
+
+    def test_update_reads_numeric_ids(self):
+        rows = [(self.hospitals[0].pk, self.subquestions[0].pk, 'a')]
+        upsert_answers(self.participant, rows)
+        result = upsert_answers(self.participant, [rows[0][:2] + ('b', )])
+        with self.assertNumQueries(2):
+            update_answers(result.changed)
+        self.assertEqual(list(Answer.objects.values_list('answer', flat=True)), ['b'])
+
+    def test_update_rejects_new_answers(self):
+        result = upsert_answers(self.participant, [(self.hospitals[0].pk, self.subquestions[0].pk, 'a')])
+        with self.assertRaises(ValueError):
+            update_answers([x._replace(new='b') for x in result.created])
+        self.assertEqual(list(Answer.objects.values_list('answer', flat=True)), ['a'])
+
+
+class CompletionTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.subquestions = SubquestionFactory.create_batch(size=4, question=self.question)
+        self.participant = ParticipantFactory(survey=self.question.category.survey)
+        self.hospitals = HospitalFactory.create_batch(size=2,
+                                                      health_fund=self.participant.health_fund)
+        self.participant = Participant.objects.select_related('survey').get(pk=self.participant.pk)
+        self.survey = self.participant.survey
+
+    def save(self, hospitals, subquestions):
+        upsert_answers(self.participant, [(h.pk, sq.pk, '1') for h in hospitals for sq in subquestions])
+
+    def test_hospital_completion(self):
+        self.save(self.hospitals[:1], self.subquestions[:3])
+        linked = (Hospital.objects.filter(health_fund=self.participant.health_fund).
+                  with_completion(self.participant).
+                  linked(participant=self.participant.pk,
+                         password=self.participant.password,
+                         required=4))
+        self.assertEqual([(x.status.count, bool(x.status), x.status.complete) for x in linked],
+                         [(3, True, False), (0, False, False)])
+
+    def test_question_completion(self):
+        self.save(self.hospitals, self.subquestions[:2])
+        completion = get_question_completion(self.participant, get_structure(self.survey))
+        self.assertEqual(completion[self.question.pk], (4, 8))
+
+    def test_is_complete(self):
+        self.save(self.hospitals, self.subquestions[:3])
+        self.assertFalse(is_complete(self.participant))
+        self.save(self.hospitals, self.subquestions[3:])
+        self.assertTrue(is_complete(self.participant))
+
+    def test_is_complete_counts_current_hospitals(self):
+        self.save(self.hospitals, self.subquestions)
+        self.hospitals[1].health_fund = NationalHealtFundFactory()
+        self.hospitals[1].save()
+        HospitalFactory(health_fund=self.participant.health_fund)
+        participant = Participant.objects.get(pk=self.participant.pk)
+        self.assertEqual(get_answer_count(participant), 4)
+        self.assertFalse(is_complete(participant))
+
+    def test_unchanged_save_keeps_completion(self):
+        self.save(self.hospitals, self.subquestions)
+        self.save(self.hospitals, self.subquestions)
+        self.assertEqual(sorted(HospitalCompletion.objects.values_list('answer_count', flat=True)),
+                         [4, 4])
+
+
+class CompletionRefreshTestCase(TransactionTestCase):
+
+    def setUp(self):
+        question = QuestionFactory()
+        self.questions = [question, QuestionFactory(category=question.category)]
+        self.subquestions = SubquestionFactory.create_batch(size=2, question=question)
+        self.participant = ParticipantFactory(survey=self.questions[0].category.survey)
+        self.hospital = HospitalFactory(health_fund=self.participant.health_fund)
+        upsert_answers(self.participant, [(self.hospital.pk, sq.pk, '1') for sq in self.subquestions])
+
+    def get_counts(self):
+        return (HospitalCompletion.objects.get(participant=self.participant).answer_count,
+                dict(QuestionCompletion.objects.filter(participant=self.participant).
+                     values_list('question_id', 'answer_count')),
+                Participant.objects.get(pk=self.participant.pk).answer_count)
+
+    def test_created_answer(self):
+        subquestion = SubquestionFactory(question=self.questions[1])
+        Answer.objects.create(participant=self.participant, hospital=self.hospital,
+                              subquestion=subquestion, answer='1')
+        self.assertEqual(self.get_counts(), (3, {self.questions[0].pk: 2, self.questions[1].pk: 1}, 3))
+
+    def test_deleted_answer(self):
+        Answer.objects.filter(subquestion=self.subquestions[0]).delete()
+        self.assertEqual(self.get_counts(), (1, {self.questions[0].pk: 1}, 1))
+
+    def test_deleted_subquestion(self):
+        self.subquestions[0].delete()
+        self.assertEqual(self.get_counts(), (1, {self.questions[0].pk: 1}, 1))
+
+    def test_moved_subquestion(self):
+        subquestion = Subquestion.objects.get(pk=self.subquestions[0].pk)
+        subquestion.question = self.questions[1]
+        subquestion.save()
+        self.assertEqual(self.get_counts(), (2, {self.questions[0].pk: 1, self.questions[1].pk: 1}, 2))
+
+
+@override_settings(SURVEY_NOTIFICATION_DIGEST_WINDOW=0)
+class NotificationTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.subquestion = SubquestionFactory(question=self.question)
+        self.participant = ParticipantFactory(survey=self.question.category.survey)
+        self.hospital = HospitalFactory(health_fund=self.participant.health_fund)
+        self.user = UserFactory(is_staff=True, notification=True)
+
+    def save_form(self):
+        data = {"sq-%d" % (self.subquestion.pk): '1'}
+        form = SurveyForm(data, participant=self.participant, hospital=self.hospital, user=self.user)
+        self.assertEqual(form.is_valid(), True)
+        form.save()
+
+    def test_save_enqueues_without_sending(self):
+        self.save_form()
+        self.assertEqual(len(mail.outbox), 0)
+        notification = Notification.objects.get()
+        self.assertEqual(notification.get_recipients(), [self.user.email])
+        self.assertEqual(notification.status, Notification.STATUS.pending)
+
+    def test_deliver_marks_sent(self):
+        self.save_form()
+        stats = deliver_pending()
+        self.assertEqual(stats[Notification.STATUS.sent], 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(deliver_pending(), {})
+        notification = Notification.objects.get()
+        self.assertEqual(notification.status, Notification.STATUS.sent)
+        self.assertEqual(notification.attempts, 1)
+
+    def test_failed_delivery_is_retried_with_backoff(self):
+        self.save_form()
+        with mock.patch('survey.notifications.send_message', side_effect=SMTPException('down')):
+            stats = deliver_pending()
+        self.assertEqual(stats[Notification.STATUS.pending], 1)
+        notification = Notification.objects.get()
+        self.assertEqual(notification.last_error, 'down')
+        self.assertGreater(notification.next_attempt_at, timezone.now())
+        self.assertEqual(deliver_pending(), {})
+
+    def test_delivery_gives_up_after_max_attempts(self):
+        self.save_form()
+        Notification.objects.update(attempts=MAX_ATTEMPTS - 1)
+        with mock.patch('survey.notifications.send_message', side_effect=SMTPException('down')):
+            deliver_pending()
+        self.assertEqual(Notification.objects.get().status, Notification.STATUS.failed)
+
+
+@override_settings(SURVEY_NOTIFICATION_DIGEST_WINDOW=300)
+class NotificationDigestTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.subquestions = SubquestionFactory.create_batch(size=2, question=self.question)
+        self.participant = ParticipantFactory(survey=self.question.category.survey)
+        self.hospitals = HospitalFactory.create_batch(size=2, health_fund=self.participant.health_fund)
+        self.user = UserFactory(is_staff=True, notification=True)
+
+    def save_form(self, hospital, answers):
+        data = {"sq-%d" % (sq.pk): answer for sq, answer in zip(self.subquestions, answers)}
+        form = SurveyForm(data, participant=self.participant, hospital=hospital, user=self.user)
+        self.assertEqual(form.is_valid(), True)
+        form.save()
+
+    def deliver_now(self):
+        Notification.objects.update(next_attempt_at=timezone.now())
+        return deliver_pending()
+
+    def test_saves_are_coalesced(self):
+        self.save_form(self.hospitals[0], ['1', '2'])
+        self.save_form(self.hospitals[1], ['3', '4'])
+        self.assertEqual(deliver_pending(), {})
+        notification = Notification.objects.get()
+        self.assertEqual(len(notification.get_changes()), 4)
+        self.deliver_now()
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_digest_lists_changed_cells_only(self):
+        self.save_form(self.hospitals[0], ['1', '2'])
+        self.deliver_now()
+        self.save_form(self.hospitals[0], ['1', 'CHANGED'])
+        self.save_form(self.hospitals[0], ['1', 'CHANGED'])
+        self.assertEqual(Notification.objects.filter(status=Notification.STATUS.pending).count(), 1)
+        self.deliver_now()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIn('CHANGED', mail.outbox[1].body)
+        self.assertNotIn(self.subquestions[0].name, mail.outbox[1].body)
+
+    def test_claimed_digest_is_not_extended(self):
+        self.save_form(self.hospitals[0], ['1', '2'])
+        Notification.objects.update(attempts=1)
+        self.save_form(self.hospitals[1], ['1', '2'])
+        self.assertEqual(Notification.objects.count(), 2)
+
+
+class MailTestCase(TestCase):
+
+    def test_staff_recipients_are_cached(self):
+        user = UserFactory(is_staff=True, notification=True)
+        self.assertEqual(get_staff_recipients(), [user.email])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_staff_recipients(), [user.email])
+
+    def test_staff_recipients_are_invalidated(self):
+        user = UserFactory(is_staff=True, notification=True)
+        get_staff_recipients()
+        user.notification = False
+        user.save()
+        self.assertEqual(get_staff_recipients(), [])
+
+    def test_connection_is_reused(self):
+        mail_stats.reset()
+        for i in range(3):
+            send_message(mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com']))
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail_stats.as_dict()['sent'], 3)
+        self.assertLessEqual(mail_stats.as_dict()['connections'], 1)
+
+
+class ExportTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.survey = self.question.category.survey
+        self.subquestions = SubquestionFactory.create_batch(size=2, question=self.question)
+        self.participant = ParticipantFactory(survey=self.survey)
+        self.hospitals = HospitalFactory.create_batch(size=2, health_fund=self.participant.health_fund)
+        upsert_answers(self.participant, [(self.hospitals[0].pk, self.subquestions[0].pk, 'a'),
+                                          (self.hospitals[0].pk, self.subquestions[1].pk, 'b'),
+                                          (self.hospitals[1].pk, self.subquestions[1].pk, 'c')])
+
+    def read(self):
+        return list(csv.reader(StringIO(''.join(iter_csv(self.survey)))))
+
+    def test_header(self):
+        header = self.read()[0]
+        self.assertEqual(header[:6], HEADER)
+        self.assertEqual(header[6:], ["{0}:{1}".format(x.name, x.pk) for x in self.subquestions])
+
+    def test_rows(self):
+        rows = self.read()[1:]
+        fund = self.participant.health_fund.name
+        self.assertEqual(rows, [[fund, self.hospitals[0].name, self.hospitals[0].identifier, '', '', 'None', 'a', 'b'],
+                                [fund, self.hospitals[1].name, self.hospitals[1].identifier, '', '', 'None', '', 'c']])
+
+    def test_rows_in_hospital_batches(self):
+        with mock.patch('survey.exports.HOSPITAL_BATCH_SIZE', 1):
+            self.assertEqual(len(self.read()), 3)
+
+    def test_engines_are_identical(self):
+        ParticipantFactory(survey=self.survey, health_fund=self.participant.health_fund)
+        with mock.patch('survey.exports.COLUMN_BATCH_SIZE', 1):
+            outputs = {engine: ''.join(iter_csv(self.survey, engine=engine)) for engine in ENGINES}
+        self.assertEqual(outputs['python'], outputs['sql'])
+
+    def test_health_fund_shard(self):
+        other = ParticipantFactory(survey=self.survey)
+        hospital = HospitalFactory(health_fund=other.health_fund)
+        upsert_answers(other, [(hospital.pk, self.subquestions[0].pk, 'x')])
+        for engine in ENGINES:
+            rows = list(csv.reader(StringIO(''.join(iter_csv(self.survey, engine=engine,
+                                                             health_fund=other.health_fund)))))
+            self.assertEqual([row[1] for row in rows[1:]], [hospital.name])
+
+
+class ChangesTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.survey = self.question.category.survey
+        self.subquestions = SubquestionFactory.create_batch(size=2, question=self.question)
+        self.participant = ParticipantFactory(survey=self.survey)
+        self.hospitals = HospitalFactory.create_batch(size=2, health_fund=self.participant.health_fund)
+        upsert_answers(self.participant, [(self.hospitals[0].pk, self.subquestions[0].pk, 'a'),
+                                          (self.hospitals[0].pk, self.subquestions[1].pk, 'b'),
+                                          (self.hospitals[1].pk, self.subquestions[1].pk, 'c')])
+        self.since = timezone.now() - timedelta(hours=1)
+        Answer.objects.update(modified=self.since - timedelta(hours=1))
+
+    def test_changes_since(self):
+        upsert_answers(self.participant, [(self.hospitals[1].pk, self.subquestions[0].pk, 'd')])
+        groups, cursor = get_changes(self.survey, self.since)
+        self.assertEqual(groups, {(self.hospitals[1].pk, self.participant.pk)})
+        self.assertEqual(cursor, Answer.objects.latest('modified').modified)
+        for engine in ENGINES:
+            rows = list(csv.reader(StringIO(''.join(iter_csv(self.survey, engine=engine, groups=groups)))))
+            self.assertEqual([row[1] for row in rows[1:]], [self.hospitals[1].name])
+            self.assertEqual(rows[1][6:], ['d', 'c'])
+
+    def test_no_changes(self):
+        self.assertEqual(get_changes(self.survey, self.since), (set(), self.since))
+
+    def test_late_commit_in_overlap(self):
+        # Saved before the cursor of the previous call, but committed after it
+        Answer.objects.filter(hospital=self.hospitals[0]).update(modified=self.since - timedelta(seconds=1))
+        groups, cursor = get_changes(self.survey, self.since)
+        self.assertEqual(groups, {(self.hospitals[0].pk, self.participant.pk)})
+        self.assertEqual(cursor, self.since - timedelta(seconds=1))
+        with mock.patch('survey.exports.CHANGES_OVERLAP', 0):
+            self.assertEqual(get_changes(self.survey, self.since), (set(), self.since))
+
+
+class ArtifactTestCase(TestCase):
+
+    def setUp(self):
+        self.subquestion = SubquestionFactory()
+        self.survey = self.subquestion.question.category.survey
+        self.participant = ParticipantFactory(survey=self.survey)
+        self.hospital = HospitalFactory(health_fund=self.participant.health_fund)
+        upsert_answers(self.participant, [(self.hospital.pk, self.subquestion.pk, 'a')])
+        # Timestamps of the fixtures are set back, so that any change is later than the artifact
+        past = timezone.now() - timedelta(hours=1)
+        Answer.objects.update(modified=past)
+        Hospital.objects.update(modified=past)
+        NationalHealtFund.objects.update(modified=past)
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        patcher = mock.patch('survey.artifacts.EXPORT_ROOT', self.root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_build_and_serve(self):
+        self.assertIsNone(get_artifact(self.survey))
+        path, built = build_artifact(self.survey)
+        self.assertTrue(built)
+        self.assertEqual(get_artifact(self.survey), path)
+        with gzip.open(path, 'rt', encoding='utf-8', newline='') as fp:
+            self.assertEqual(fp.read(), ''.join(iter_csv(self.survey)))
+        self.assertEqual(build_artifact(self.survey), (path, False))
+
+    def test_answer_change_invalidates(self):
+        path, _ = build_artifact(self.survey)
+        upsert_answers(self.participant, [(self.hospital.pk, self.subquestion.pk, 'b')])
+        self.assertIsNone(get_artifact(self.survey))
+        new_path, built = build_artifact(self.survey)
+        self.assertTrue(built)
+        self.assertEqual(os.listdir(self.root), [os.path.basename(new_path)])
+
+    def test_hospital_change_invalidates(self):
+        build_artifact(self.survey)
+        self.hospital.name = 'Renamed'
+        self.hospital.save()
+        self.assertIsNone(get_artifact(self.survey))
+
+    def test_health_fund_change_invalidates(self):
+        build_artifact(self.survey)
+        health_fund = self.participant.health_fund
+        health_fund.name = 'Renamed'
+        health_fund.save()
+        self.assertIsNone(get_artifact(self.survey))
+
+
+class TypedExportTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.survey = self.question.category.survey
+        self.vint = SubquestionFactory(question=self.question, kind=Subquestion.KIND_VINT)
+        self.int = SubquestionFactory(question=self.question, kind=Subquestion.KIND_INT)
+        self.text = SubquestionFactory(question=self.question, kind=Subquestion.KIND_TEXT)
+        self.participant = ParticipantFactory(survey=self.survey)
+        self.hospital = HospitalFactory(health_fund=self.participant.health_fund)
+        upsert_answers(self.participant, [(self.hospital.pk, self.vint.pk, 'b/d'),
+                                          (self.hospital.pk, self.int.pk, '12')])
+
+    def test_jsonl_types(self):
+        lines = list(iter_jsonl(self.survey))
+        self.assertEqual(len(lines), 1)
+        record = json.loads(lines[0])
+        self.assertEqual(record['Hospital'], self.hospital.name)
+        self.assertIsNone(record['Accept on'])
+        self.assertIsNone(record["{0}:{1}".format(self.vint.name, self.vint.pk)])
+        self.assertTrue(record["{0}:{1}:missing".format(self.vint.name, self.vint.pk)])
+        self.assertEqual(record["{0}:{1}".format(self.int.name, self.int.pk)], 12)
+        self.assertIsNone(record["{0}:{1}".format(self.text.name, self.text.pk)])
+
+    def test_projection(self):
+        record = json.loads(next(iter_jsonl(self.survey, subquestions=[self.int.pk])))
+        self.assertEqual(list(record.keys())[6:], ["{0}:{1}".format(self.int.name, self.int.pk)])
+        header = next(iter_csv(self.survey, categories=[self.question.category.pk]))
+        self.assertEqual(header.count(':'), 3)
+
+    def test_accept_on(self):
+        Participant.objects.filter(pk=self.participant.pk).update(accept_on=timezone.now())
+        accept_on = str(Participant.objects.get(pk=self.participant.pk).accept_on)
+        self.assertEqual(json.loads(next(iter_jsonl(self.survey)))['Accept on'], accept_on)
+        row = list(csv.reader(StringIO(''.join(iter_csv(self.survey)))))[1]
+        self.assertEqual(row[HEADER.index('Accept on')], accept_on)
+
+    @skipUnless(find_spec('pyarrow'), "pyarrow is not installed")
+    def test_parquet(self):
+        import pyarrow.parquet
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'export.parquet')
+        other = ParticipantFactory(survey=self.survey, health_fund=self.participant.health_fund)
+        upsert_answers(other, [(self.hospital.pk, self.int.pk, '7')])
+        write_parquet(self.survey, path, batch_size=1)
+        records = [json.loads(line) for line in iter_jsonl(self.survey)]
+        table = pyarrow.parquet.read_table(path).to_pydict()
+        self.assertEqual(list(table.keys()), list(records[0].keys()))
+        for name, values in table.items():
+            self.assertEqual(values, [record[name] for record in records])
+
+    def test_admin_rejects_non_integer_projection(self):
+        request = RequestFactory().get('/', {'format': 'jsonl', 'subquestion': 'abc'})
+        response = SurveyAdmin(Survey, admin.site).export(request, self.survey)
+        self.assertEqual(response.status_code, 400)
+
+
+class InlinePool(object):
+
+    def __init__(self, processes=None, initializer=None):
+        pass
+
+    def imap_unordered(self, func, iterable):
+        return map(func, iterable)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class ExportCommandTestCase(TestCase):
+
+    def setUp(self):
+        self.subquestion = SubquestionFactory()
+        self.survey = self.subquestion.question.category.survey
+        self.participants = ParticipantFactory.create_batch(size=2, survey=self.survey)
+        for participant in self.participants:
+            hospital = HospitalFactory(health_fund=participant.health_fund)
+            upsert_answers(participant, [(hospital.pk, self.subquestion.pk, 'a')])
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.output = os.path.join(self.root, 'export.zip')
+        # Workers would not see data of the test transaction, shards are exported in the test process
+        for patcher in (mock.patch('survey.management.commands.export_surveys.multiprocessing.Pool', InlinePool),
+                        mock.patch('survey.management.commands.export_surveys.connections')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def read(self):
+        with zipfile.ZipFile(self.output) as archive:
+            return {name: archive.read(name).decode('utf-8') for name in archive.namelist()}
+
+    def test_export(self):
+        stdout = StringIO()
+        call_command('export_surveys', self.output, '--survey', str(self.survey.pk), stdout=stdout)
+        name = '{0}.csv'.format(self.survey.slug)
+        self.assertEqual(self.read(), {name: ''.join(iter_csv(self.survey))})
+        self.assertIn("Exported 1 files", stdout.getvalue())
+
+    def test_split_funds(self):
+        call_command('export_surveys', self.output, '--survey', str(self.survey.pk), '--split-funds',
+                     '--format', 'jsonl', '--processes', '1', stdout=StringIO())
+        files = self.read()
+        self.assertEqual(len(files), 2)
+        for participant in self.participants:
+            name = '{0}-{1}.jsonl'.format(self.survey.slug, participant.health_fund_id)
+            self.assertEqual(files[name], ''.join(iter_jsonl(self.survey, health_fund=participant.health_fund)))
+
+    def test_no_survey(self):
+        with self.assertRaises(CommandError):
+            call_command('export_surveys', self.output, '--survey', '0', stdout=StringIO())
+
+
+class HospitalCountTestCase(TestCase):
+
+    def setUp(self):
+        self.health_fund = NationalHealtFundFactory()
+
+    def get_count(self, health_fund):
+        return NationalHealtFund.objects.get(pk=health_fund.pk).hospital_count
+
+    def test_create_move_delete(self):
+        hospital = HospitalFactory(health_fund=self.health_fund)
+        HospitalFactory(health_fund=self.health_fund)
+        self.assertEqual(self.get_count(self.health_fund), 2)
+        other = NationalHealtFundFactory()
+        hospital = Hospital.objects.get(pk=hospital.pk)
+        hospital.health_fund = other
+        hospital.save()
+        self.assertEqual(self.get_count(self.health_fund), 1)
+        self.assertEqual(self.get_count(other), 1)
+        hospital.delete()
+        self.assertEqual(self.get_count(other), 0)
+
+    def test_reconcile(self):
+        HospitalFactory(health_fund=self.health_fund)
+        NationalHealtFund.objects.update(hospital_count=5)
+        reconcile_hospital_count([self.health_fund.pk])
+        self.assertEqual(self.get_count(self.health_fund), 1)
+
+
+class SurveyProgressTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.subquestions = SubquestionFactory.create_batch(size=3)
+        self.survey = self.subquestions[0].question.category.survey
+        for subquestion in self.subquestions[1:]:
+            subquestion.question = self.subquestions[0].question
+            subquestion.save()
+        self.participant = ParticipantFactory(survey=self.survey)
+        self.hospital = HospitalFactory(health_fund=self.participant.health_fund)
+        upsert_answers(self.participant, [(self.hospital.pk, self.subquestions[0].pk, '1')])
+
+    def test_progress_is_float(self):
+        with self.assertNumQueries(1):
+            progress = get_survey_progress(self.survey)
+        self.assertEqual((progress.answer_count, progress.required_count), (1, 3))
+        self.assertAlmostEqual(progress.progress, 100 / 3.0)
+        self.assertAlmostEqual(progress.participants[0].progress, 100 / 3.0)
+        with self.assertNumQueries(0):
+            get_survey_progress(self.survey)
+
+    def test_with_progress_stats(self):
+        participant = Participant.objects.with_progress_stats().get(pk=self.participant.pk)
+        self.assertEqual(participant.hospital_count, 1)
+        self.assertAlmostEqual(float(participant.progress), 100 / 3.0)
+
+
+class CompletionMatrixTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.question = QuestionFactory()
+        self.survey = self.question.category.survey
+        self.subquestions = SubquestionFactory.create_batch(size=2, question=self.question)
+        self.participant = ParticipantFactory(survey=self.survey)
+        self.hospitals = HospitalFactory.create_batch(size=2, health_fund=self.participant.health_fund)
+        self.survey = Survey.objects.get(pk=self.survey.pk)
+
+    def test_matrix(self):
+        upsert_answers(self.participant, [(self.hospitals[0].pk, self.subquestions[0].pk, '1')])
+        matrix = get_completion_matrix(self.survey)
+        self.assertEqual(matrix.health_funds, [self.participant.health_fund.name])
+        self.assertEqual(matrix.rows[0].cells, [(1, 4)])
+        self.assertEqual(matrix.rows[0].children[0].cells, [(1, 4)])
+        self.assertEqual(matrix.rows[0].cells[0].progress, 25.0)
+
+    def test_saved_answers_invalidate_cache(self):
+        get_completion_matrix(self.survey)
+        with self.assertNumQueries(0):
+            get_completion_matrix(self.survey)
+        upsert_answers(self.participant, [(self.hospitals[0].pk, self.subquestions[0].pk, '1')])
+        self.assertEqual(get_completion_matrix(self.survey).rows[0].cells, [(1, 4)])
+
+
+class CompletionMatrixInvalidationTestCase(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        question = QuestionFactory()
+        self.subquestions = SubquestionFactory.create_batch(size=2, question=question)
+        self.participant = ParticipantFactory(survey=question.category.survey)
+        self.hospitals = HospitalFactory.create_batch(size=2, health_fund=self.participant.health_fund)
+        self.survey = Survey.objects.get(pk=question.category.survey_id)
+        get_completion_matrix(self.survey)
+
+    def get_cells(self):
+        return get_completion_matrix(self.survey).rows[0].cells
+
+    def test_saved_answer(self):
+        AnswerFactory(participant=self.participant, hospital=self.hospitals[0], subquestion=self.subquestions[0])
+        self.assertEqual(self.get_cells(), [(1, 4)])
+
+    def test_deleted_answer(self):
+        upsert_answers(self.participant, [(self.hospitals[0].pk, self.subquestions[0].pk, '1')])
+        self.assertEqual(self.get_cells(), [(1, 4)])
+        Answer.objects.all().delete()
+        self.assertEqual(self.get_cells(), [(0, 4)])
+
+    def test_moved_hospital(self):
+        hospital = Hospital.objects.get(pk=self.hospitals[1].pk)
+        hospital.health_fund = NationalHealtFundFactory()
+        hospital.save()
+        self.assertEqual(self.get_cells(), [(0, 2)])
+
+    def test_deleted_hospital(self):
+        self.hospitals[1].delete()
+        self.assertEqual(self.get_cells(), [(0, 2)])
+
+
+class AnalyticsTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.survey = self.question.category.survey
+        self.vint = SubquestionFactory(question=self.question, kind=Subquestion.KIND_VINT)
+        self.int = SubquestionFactory(question=self.question, kind=Subquestion.KIND_INT)
+        SubquestionFactory(question=self.question, kind=Subquestion.KIND_TEXT)
+        self.participant = ParticipantFactory(survey=self.survey)
+        hospitals = [HospitalFactory(health_fund=self.participant.health_fund) for _ in range(3)]
+        upsert_answers(self.participant, [(hospitals[0].pk, self.vint.pk, '10'),
+                                          (hospitals[1].pk, self.vint.pk, '20'),
+                                          (hospitals[2].pk, self.vint.pk, 'b/d'),
+                                          (hospitals[0].pk, self.int.pk, '-4')])
+
+    def test_to_numbers(self):
+        numbers, missing = to_numbers(np.array([' 7', '-3', 'b/d', 'x', '--1', ''], dtype=object))
+        self.assertEqual(numbers[:2].tolist(), [7, -3])
+        self.assertTrue(np.isnan(numbers[2:]).all())
+        self.assertEqual(missing.tolist(), [False, False, True, False, False, False])
+
+    def test_to_numbers_outside_int64(self):
+        numbers, _ = to_numbers(np.array(['99999999999999999999', '5', '-9223372036854775808'], dtype=object))
+        self.assertTrue(np.isnan(numbers[0]))
+        self.assertEqual(numbers[1:].tolist(), [5, -2 ** 63])
+
+    def test_summaries(self):
+        summaries = get_summaries(self.survey)
+        self.assertEqual([x.scope for x in summaries], [self.participant.health_fund.name, ''])
+        national = summaries[-1]
+        self.assertEqual([x.pk for x in national.columns], [self.vint.pk, self.int.pk])
+        self.assertEqual(national.stats['count'].tolist(), [2, 1])
+        self.assertEqual(national.stats['sum'].tolist(), [30, -4])
+        self.assertEqual(national.stats['median'].tolist(), [15, -4])
+        self.assertAlmostEqual(national.stats['missing_ratio'][0], 1 / 3)
+        self.assertEqual(national.stats['missing_ratio'][1], 0)
+
+    def test_csv(self):
+        rows = list(csv.reader(iter_summary_csv(self.survey)))
+        self.assertEqual(rows[0][:3], ['Health fund', 'Subquestion', 'count'])
+        self.assertEqual(len(rows), 1 + 2 * 2)
+
+
+def get_admin_request(method='get', data=None):
+    request = getattr(RequestFactory(), method)('/', data or {})
+    request.user = UserFactory(is_staff=True, is_superuser=True)
+    request._messages = CookieStorage(request)
+    return request
+
+
+class QualityTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.survey = self.question.category.survey
+        self.births = SubquestionFactory(question=self.question, kind=Subquestion.KIND_INT)
+        self.caesarean = SubquestionFactory(question=self.question, kind=Subquestion.KIND_INT)
+        self.participant = ParticipantFactory(survey=self.survey)
+        self.hospitals = HospitalFactory.create_batch(size=6, health_fund=self.participant.health_fund)
+        answers = []
+        for hospital, births in zip(self.hospitals, [100, 110, 90, 105, 95, 5000]):
+            answers += [(hospital.pk, self.births.pk, str(births)), (hospital.pk, self.caesarean.pk, '30')]
+        answers[1] = (self.hospitals[0].pk, self.caesarean.pk, '120')
+        upsert_answers(self.participant, answers)
+        QualityRule.objects.create(survey=self.survey, name="Births lower than caesarean sections",
+                                   left=self.births, operator=QualityRule.OPERATOR.gte, right=self.caesarean)
+
+    def test_outliers_and_rules(self):
+        check_quality(self.survey)
+        issues = QualityIssue.objects.filter(subquestion=self.births)
+        self.assertEqual({x.hospital_id for x in issues.exclude(kind=QualityIssue.KIND.rule)},
+                         {self.hospitals[5].pk})
+        rule_issue = issues.get(kind=QualityIssue.KIND.rule)
+        self.assertEqual(rule_issue.hospital_id, self.hospitals[0].pk)
+        self.assertEqual(rule_issue.value, 100)
+
+    def test_incremental(self):
+        self.assertEqual(get_changed_participant_ids(self.survey), [self.participant.pk])
+        check_quality(self.survey, get_changed_participant_ids(self.survey))
+        self.assertEqual(get_changed_participant_ids(self.survey), [])
+        other = ParticipantFactory(survey=self.survey)
+        self.assertEqual(get_changed_participant_ids(self.survey), [other.pk])
+        upsert_answers(self.participant, [(self.hospitals[0].pk, self.caesarean.pk, '30')])
+        self.assertTrue(QualityIssue.objects.filter(kind=QualityIssue.KIND.rule).exists())
+        check_quality(self.survey, [self.participant.pk])
+        self.assertFalse(QualityIssue.objects.filter(kind=QualityIssue.KIND.rule).exists())
+
+    def test_outliers_per_health_fund(self):
+        other = ParticipantFactory(survey=self.survey)
+        hospitals = HospitalFactory.create_batch(size=6, health_fund=other.health_fund)
+        upsert_answers(other, [(hospital.pk, self.births.pk, str(births))
+                               for hospital, births in zip(hospitals, [4900, 5000, 5100, 4950, 5050, 100])])
+        few = ParticipantFactory(survey=self.survey)
+        hospital = HospitalFactory(health_fund=few.health_fund)
+        upsert_answers(few, [(hospital.pk, self.births.pk, '100000')])
+        check_quality(self.survey)
+        issues = QualityIssue.objects.filter(subquestion=self.births, kind=QualityIssue.KIND.zscore)
+        self.assertEqual({x.hospital_id for x in issues},
+                         {self.hospitals[5].pk, hospitals[5].pk, hospital.pk})
+        self.assertIn(other.health_fund.name, issues.get(hospital=hospitals[5]).message)
+        self.assertNotIn(few.health_fund.name, issues.get(hospital=hospital).message)
+
+    def test_admin_checks_on_post(self):
+        model_admin = SurveyAdmin(Survey, admin.site)
+        with mock.patch('survey.admin.render') as render:
+            model_admin.quality(get_admin_request(), self.survey)
+        self.assertEqual(render.call_args[1]['context']['participant_count'], 1)
+        self.assertFalse(QualityIssue.objects.exists())
+        self.assertIsNone(Participant.objects.get(pk=self.participant.pk).quality_checked_at)
+        response = model_admin.quality(get_admin_request('post'), self.survey)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(QualityIssue.objects.exists())
+
+
+class AnswerValueTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.vint = SubquestionFactory(question=self.question, kind=Subquestion.KIND_VINT)
+        self.text = SubquestionFactory(question=self.question, kind=Subquestion.KIND_TEXT)
+        self.participant = ParticipantFactory(survey=self.question.category.survey)
+        self.hospital = HospitalFactory(health_fund=self.participant.health_fund)
+
+    def get_typed(self, subquestion):
+        return Answer.objects.filter(subquestion=subquestion).values_list('value', 'missing_data').get()
+
+    def test_upsert(self):
+        upsert_answers(self.participant, [(self.hospital.pk, self.vint.pk, ' 12'),
+                                          (self.hospital.pk, self.text.pk, '7')])
+        self.assertEqual(self.get_typed(self.vint), (12, False))
+        self.assertEqual(self.get_typed(self.text), (None, False))
+        upsert_answers(self.participant, [(self.hospital.pk, self.vint.pk, 'b/d')])
+        self.assertEqual(self.get_typed(self.vint), (None, True))
+
+    def test_save(self):
+        AnswerFactory(participant=self.participant, hospital=self.hospital, subquestion=self.vint, answer='-5')
+        self.assertEqual(self.get_typed(self.vint), (-5, False))
+
+    def test_save_reads_kind_once(self):
+        pk = AnswerFactory(participant=self.participant, hospital=self.hospital, subquestion=self.vint).pk
+        answer = Answer.objects.select_related('subquestion').get(pk=pk)
+        answer.answer = '3'
+        with self.assertNumQueries(1):
+            answer.save()
+        answer = Answer.objects.get(pk=pk)
+        answer.answer = '4'
+        with self.assertNumQueries(2):
+            answer.save()
+        self.assertEqual(self.get_typed(self.vint), (4, False))
+
+    def test_kind_change(self):
+        upsert_answers(self.participant, [(self.hospital.pk, self.text.pk, '7')])
+        subquestion = Subquestion.objects.get(pk=self.text.pk)
+        subquestion.kind = Subquestion.KIND_INT
+        subquestion.save()
+        self.assertEqual(self.get_typed(self.text), (7, False))
+
+    def test_fill_values(self):
+        upsert_answers(self.participant, [(self.hospital.pk, self.vint.pk, '12'),
+                                          (self.hospital.pk, self.text.pk, 'abc')])
+        modified = Answer.objects.get(subquestion=self.vint).modified
+        Answer.objects.update(value=None, missing_data=True)
+        self.assertEqual(fill_values(Answer.objects.all(), batch_size=1), 2)
+        self.assertEqual(self.get_typed(self.vint), (12, False))
+        self.assertEqual(self.get_typed(self.text), (None, False))
+        self.assertEqual(Answer.objects.get(subquestion=self.vint).modified, modified)
+        self.assertEqual(fill_values(Answer.objects.all()), 0)
+
+
+class ComparisonTestCase(TestCase):
+
+    def create_survey(self):
+        question = QuestionFactory(category=CategoryFactory(name='Obstetrics'), name='Births')
+        subquestions = [SubquestionFactory(question=question, name='Total', kind=Subquestion.KIND_INT),
+                        SubquestionFactory(question=question, name='Caesarean {0}'.format(Survey.objects.count()),
+                                           key='caesarean', kind=Subquestion.KIND_VINT)]
+        return question.category.survey, subquestions
+
+    def setUp(self):
+        self.previous, previous_subquestions = self.create_survey()
+        self.survey, self.subquestions = self.create_survey()
+        previous_participant = ParticipantFactory(survey=self.previous)
+        participant = ParticipantFactory(survey=self.survey)
+        self.moved = HospitalFactory(identifier='H-1')
+        self.same = HospitalFactory(identifier='H-2')
+        upsert_answers(previous_participant, [
+            (HospitalFactory(identifier='H-1').pk, previous_subquestions[0].pk, '100'),
+            (self.same.pk, previous_subquestions[0].pk, '50'),
+            (self.same.pk, previous_subquestions[1].pk, '10'),
+        ])
+        upsert_answers(participant, [
+            (self.moved.pk, self.subquestions[0].pk, '300'),
+            (self.same.pk, self.subquestions[0].pk, '50'),
+            (self.same.pk, self.subquestions[1].pk, 'b/d'),
+            (HospitalFactory(identifier='H-3').pk, self.subquestions[0].pk, '7'),
+        ])
+
+    def test_build(self):
+        comparison = build_comparison(self.survey, self.previous)
+        self.assertEqual(comparison.row_count, 2)
+        row = comparison.comparisonrow_set.get(hospital=self.moved)
+        self.assertEqual((row.subquestion_id, row.previous_value, row.value, row.delta, row.change),
+                         (self.subquestions[0].pk, 100, 300, 200, 2.0))
+        comparison = build_comparison(self.survey, self.previous)
+        self.assertEqual(comparison.comparisonrow_set.count(), 2)
+
+    def test_hospital_changes(self):
+        comparison = build_comparison(self.survey, self.previous)
+        with self.assertNumQueries(1):
+            changes = get_hospital_changes(comparison)
+        self.assertEqual([x['hospital_id'] for x in changes], [self.moved.pk, self.same.pk])
+        self.assertEqual([x['changed_count'] for x in changes], [1, 0])
+
+    def post_admin(self, data):
+        request = get_admin_request('post', data)
+        return SurveyAdmin(Survey, admin.site).comparison(request, self.survey)
+
+    def test_admin_builds_on_post(self):
+        request = get_admin_request('get', {'previous': self.previous.pk})
+        with mock.patch('survey.admin.render') as render:
+            SurveyAdmin(Survey, admin.site).comparison(request, self.survey)
+        self.assertIsNone(render.call_args[1]['context']['comparison'])
+        self.assertEqual(self.post_admin({'previous': self.previous.pk}).status_code, 302)
+        self.assertEqual(Comparison.objects.get().previous_id, self.previous.pk)
+
+    def test_admin_rejects_invalid_previous(self):
+        self.assertEqual(self.post_admin({'previous': 'abc'}).status_code, 400)
+        with self.assertRaises(Http404):
+            self.post_admin({'previous': self.survey.pk})
+        self.assertFalse(Comparison.objects.exists())
+
+
+class FieldSpecTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.survey = self.question.category.survey
+        self.int = SubquestionFactory(question=self.question, kind=Subquestion.KIND_INT)
+        self.text = SubquestionFactory(question=self.question, kind=Subquestion.KIND_LTEXT)
+        self.participant = ParticipantFactory(survey=self.survey)
+        self.hospitals = HospitalFactory.create_batch(size=2, health_fund=self.participant.health_fund)
+
+    def get_structure(self):
+        return get_structure(Survey.objects.get(pk=self.survey.pk))
+
+    def test_cached_per_roster(self):
+        hospital_ids = [x.pk for x in self.hospitals]
+        specs = compile_fields(self.get_structure(), hospital_ids)
+        self.assertEqual(len(specs), 4)
+        self.assertEqual(specs[0].key, 'h-{0}-sq-{1}'.format(hospital_ids[0], self.int.pk))
+        self.assertIs(compile_fields(self.get_structure(), hospital_ids), specs)
+        self.assertEqual(len(compile_fields(self.get_structure(), hospital_ids[:1])), 2)
+        SubquestionFactory(question=self.question)
+        self.assertEqual(len(compile_fields(self.get_structure(), hospital_ids)), 6)
+
+    def test_form_fields(self):
+        upsert_answers(self.participant, [(self.hospitals[1].pk, self.int.pk, '5')])
+        form = ParticipantForm(participant=self.participant)
+        field = form.fields['h-{0}-sq-{1}'.format(self.hospitals[1].pk, self.int.pk)]
+        self.assertIsInstance(field, forms.IntegerField)
+        self.assertEqual((field.label, field.initial), (self.int.name, '5'))
+        other = form.fields['h-{0}-sq-{1}'.format(self.hospitals[0].pk, self.text.pk)]
+        self.assertEqual(other.initial, '')
+        self.assertIsInstance(other.widget, forms.widgets.Textarea)
+
+
+class SectionTestCase(TestCase):
+
+    def setUp(self):
+        self.questions = QuestionFactory.create_batch(size=2)
+        self.categories = [x.category for x in self.questions]
+        self.survey = self.categories[0].survey
+        self.categories[1].survey = self.survey
+        self.categories[1].save()
+        self.subquestions = [SubquestionFactory(question=question) for question in self.questions]
+        self.participant = ParticipantFactory(survey=self.survey)
+        self.hospitals = HospitalFactory.create_batch(size=3, health_fund=self.participant.health_fund)
+        self.structure = get_structure(Survey.objects.get(pk=self.survey.pk))
+
+    def get_form(self, data=None):
+        return ParticipantForm(data,
+                               participant=self.participant,
+                               user=UserFactory(),
+                               category=self.structure.categories[1],
+                               hospitals=self.hospitals[:2])
+
+    def test_fields_of_section(self):
+        form = self.get_form()
+        self.assertEqual(sorted(form.fields),
+                         sorted('h-{0}-sq-{1}'.format(h.pk, self.subquestions[1].pk) for h in self.hospitals[:2]))
+        self.assertEqual(len(form.grouped_fields()), 1)
+
+    def test_save_section(self):
+        upsert_answers(self.participant, [(self.hospitals[2].pk, self.subquestions[1].pk, 'kept'),
+                                          (self.hospitals[0].pk, self.subquestions[0].pk, 'kept')])
+        form = self.get_form({'h-{0}-sq-{1}'.format(h.pk, self.subquestions[1].pk): 'new'
+                              for h in self.hospitals[:2]})
+        self.assertTrue(form.is_valid())
+        form.save_model()
+        self.assertEqual(len(form.result.created), 2)
+        self.assertEqual(Answer.objects.filter(answer='kept').count(), 2)
+
+    def test_completion(self):
+        upsert_answers(self.participant, [(self.hospitals[0].pk, self.subquestions[0].pk, '1'),
+                                          (self.hospitals[2].pk, self.subquestions[1].pk, '1')])
+        sections = [Section(category, category.questions, hospitals)
+                    for category in self.structure.categories
+                    for hospitals in (self.hospitals[:2], self.hospitals[2:])]
+        with self.assertNumQueries(1):
+            completion = get_section_completion(self.participant, sections)
+        self.assertEqual(completion, [(1, 2), (0, 1), (0, 2), (1, 1)])
+
+
+class AutosaveTestCase(TestCase):
+
+    def setUp(self):
+        self.subquestion = SubquestionFactory(kind=Subquestion.KIND_VINT)
+        self.survey = self.subquestion.question.category.survey
+        self.participant = ParticipantFactory(survey=self.survey)
+        self.hospital = HospitalFactory(health_fund=self.participant.health_fund)
+        self.participant = Participant.objects.get(pk=self.participant.pk)
+
+    def get_form(self, *cells):
+        return AutosaveForm([{'hospital': hospital.pk, 'subquestion': subquestion.pk, 'value': value}
+                             for hospital, subquestion, value in cells],
+                            participant=self.participant,
+                            user=UserFactory())
+
+    def test_save(self):
+        form = self.get_form((self.hospital, self.subquestion, '5'),
+                             (self.hospital, self.subquestion, Subquestion.MISSING_DATA[0]))
+        self.assertTrue(form.is_valid())
+        result = form.save()
+        self.assertEqual(len(result.created), 1)
+        self.assertEqual(Answer.objects.get().answer, Subquestion.MISSING_DATA[0])
+        self.assertEqual(Notification.objects.count(), 1)
+
+    def test_invalid_cells(self):
+        other = HospitalFactory()
+        form = self.get_form((self.hospital, self.subquestion, 'abc'),
+                             (other, self.subquestion, '5'))
+        self.assertFalse(form.is_valid())
+        self.assertEqual([(hospital_id, subquestion_id) for hospital_id, subquestion_id, _ in form.errors],
+                         [(self.hospital.pk, self.subquestion.pk), (other.pk, self.subquestion.pk)])
+        self.assertEqual(len(form.save().created), 0)
+        self.assertFalse(Answer.objects.exists())
+
+    def test_malformed_batch(self):
+        for cells in ({'cells': []}, [{'hospital': self.hospital.pk}], ['abc']):
+            form = AutosaveForm(cells, participant=self.participant)
+            self.assertRaises(ValidationError, form.is_valid)
+
+    def test_completion(self):
+        form = self.get_form((self.hospital, self.subquestion, '5'))
+        form.is_valid()
+        form.save()
+        structure = get_structure(self.survey)
+        hospitals, questions = get_cell_completion(self.participant, structure,
+                                                   {self.hospital.pk}, {self.subquestion.question_id})
+        self.assertEqual(hospitals, {self.hospital.pk: (1, 1)})
+        self.assertEqual(questions, {self.subquestion.question_id: (1, 1)})
+
+    def get_url(self):
+        return reverse('survey:autosave', kwargs={'participant': str(self.participant.pk),
+                                                  'password': self.participant.password})
+
+    def post(self, body, client=None):
+        return (client or self.client).post(self.get_url(), body, content_type='application/json')
+
+    def test_view(self):
+        response = self.post(json.dumps({'cells': [{'hospital': self.hospital.pk,
+                                                    'subquestion': self.subquestion.pk,
+                                                    'value': '5'}]}))
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['saved'], 1)
+        self.assertEqual(data['errors'], [])
+        self.assertEqual(data['hospitals'], {str(self.hospital.pk): [1, 1]})
+        self.assertEqual(data['questions'], {str(self.subquestion.question_id): [1, 1]})
+        self.assertEqual(data['total'], [1, 1])
+        self.assertEqual(Answer.objects.get().answer, '5')
+
+    def test_view_malformed_json(self):
+        self.assertEqual(self.post('{"cells": ').status_code, 400)
+
+    def test_view_wrong_shape(self):
+        for body in ({'rows': []}, {'cells': {'hospital': self.hospital.pk}}, [], {'cells': [[1, 2, 3]]}):
+            self.assertEqual(self.post(json.dumps(body)).status_code, 400)
+        self.assertFalse(Answer.objects.exists())
+
+    def test_view_requires_csrf_token(self):
+        response = self.post(json.dumps({'cells': []}), client=Client(enforce_csrf_checks=True))
+        self.assertEqual(response.status_code, 403)
+
+    def test_view_requires_post(self):
+        self.assertEqual(self.client.get(self.get_url()).status_code, 405)
+
+
+@override_settings(SURVEY_NOTIFICATION_DIGEST_WINDOW=0)
+class UploadTestCase(TestCase):
+
+    def setUp(self):
+        self.question = QuestionFactory()
+        self.survey = self.question.category.survey
+        self.subquestions = [SubquestionFactory(question=self.question, kind=kind)
+                             for kind in (Subquestion.KIND_INT, Subquestion.KIND_VINT, Subquestion.KIND_TEXT)]
+        self.participant = ParticipantFactory(survey=self.survey)
+        self.hospitals = HospitalFactory.create_batch(size=2, health_fund=self.participant.health_fund)
+        self.header = HEADER + [get_key(x.pk, x.name) for x in self.subquestions]
+
+    def get_file(self, rows, header=None, name='answers.csv'):
+        output = StringIO()
+        writer = csv.writer(output)
+        writer.writerow(self.header if header is None else header)
+        for hospital, answers in rows:
+            writer.writerow(['', hospital.name, hospital.identifier, '', '', ''] + answers)
+        return SimpleUploadedFile(name, output.getvalue().encode('utf-8'))
+
+    def get_form(self, data=None, files=None):
+        participant = Participant.objects.select_related('survey').get(pk=self.participant.pk)
+        return UploadForm(data, files, participant=participant, user=UserFactory())
+
+    def get_token(self):
+        form = self.get_form(files={'file': self.get_file([(self.hospitals[0], ['2', '3', 'a'])])})
+        self.assertTrue(form.is_valid())
+        return form.cleaned_data['token']
+
+    def test_read_upload(self):
+        other = HospitalFactory()
+        f = self.get_file([(self.hospitals[0], ['007', 'b/d', 'text']),
+                           (self.hospitals[1], ['x', '12x', '']),
+                           (other, ['1', '1', '1'])])
+        upload = read_upload(f, f.name, self.participant, get_structure(self.survey))
+        self.assertEqual(sorted(upload.rows), sorted([(self.hospitals[0].pk, self.subquestions[0].pk, '7'),
+                                                      (self.hospitals[0].pk, self.subquestions[1].pk, 'b/d'),
+                                                      (self.hospitals[0].pk, self.subquestions[2].pk, 'text')]))
+        self.assertEqual(sorted((x.row, x.value) for x in upload.errors),
+                         [(3, '12x'), (3, 'x'), (4, other.name)])
+
+    def test_read_upload_outside_int64(self):
+        f = self.get_file([(self.hospitals[0], ['99999999999999999999', '99999999999999999999', 'text'])])
+        upload = read_upload(f, f.name, self.participant, get_structure(self.survey))
+        self.assertEqual(upload.rows, [(self.hospitals[0].pk, self.subquestions[2].pk, 'text')])
+        self.assertEqual(sorted((x.row, x.column) for x in upload.errors),
+                         sorted([(2, self.subquestions[0].name), (2, self.subquestions[1].name)]))
+
+    def test_dry_run_and_confirm(self):
+        upsert_answers(self.participant, [(self.hospitals[0].pk, self.subquestions[0].pk, '1')])
+        form = self.get_form(files={'file': self.get_file([(self.hospitals[0], ['2', '3', 'a']),
+                                                           (self.hospitals[1], ['4', '', ''])])})
+        self.assertTrue(form.is_valid())
+        self.assertTrue(form.is_dry_run())
+        self.assertEqual((len(form.diff.created), len(form.diff.changed)), (3, 1))
+        self.assertEqual(Answer.objects.count(), 1)
+        form = self.get_form({'token': form.cleaned_data['token']})
+        self.assertTrue(form.is_valid())
+        self.assertFalse(form.is_dry_run())
+        result = form.save()
+        self.assertEqual((len(result.created), len(result.changed)), (3, 1))
+        self.assertEqual(Answer.objects.count(), 4)
+        self.assertEqual(Notification.objects.count(), 1)
+        self.assertFalse(self.get_form({'token': form.cleaned_data['token']}).is_valid())
+
+    def test_invalid_header(self):
+        form = self.get_form(files={'file': self.get_file([], header=HEADER + ['Unknown:0'])})
+        self.assertFalse(form.is_valid())
+        form = self.get_form(files={'file': self.get_file([], name='answers.txt')})
+        self.assertFalse(form.is_valid())
+
+    def test_export_round_trip(self):
+        upsert_answers(self.participant, [(hospital.pk, subquestion.pk, answer)
+                                          for hospital in self.hospitals
+                                          for subquestion, answer in zip(self.subquestions, ['1', 'b/d', 'a'])])
+        f = SimpleUploadedFile('export.csv', ''.join(iter_csv(self.survey)).encode('utf-8'))
+        form = self.get_form(files={'file': f})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(len(form.diff.unchanged), 6)
+        self.assertEqual(form.diff.modified, [])
+
+    def test_confirm_checks_subquestions(self):
+        token = self.get_token()
+        self.subquestions[1].delete()
+        self.assertFalse(self.get_form({'token': token}).is_valid())
+        self.assertFalse(Answer.objects.exists())
+
+    def test_confirm_checks_kinds(self):
+        token = self.get_token()
+        subquestion = Subquestion.objects.get(pk=self.subquestions[2].pk)
+        subquestion.kind = Subquestion.KIND_INT
+        subquestion.save()
+        self.assertFalse(self.get_form({'token': token}).is_valid())
+
+    def test_confirm_checks_hospitals(self):
+        token = self.get_token()
+        Hospital.objects.filter(pk=self.hospitals[0].pk).update(health_fund=NationalHealtFundFactory())
+        self.assertFalse(self.get_form({'token': token}).is_valid())
+
+    def test_stash_expires(self):
+        token = self.get_token()
+        StashedUpload.objects.update(created=timezone.now() - timedelta(hours=2))
+        self.assertFalse(self.get_form({'token': token}).is_valid())
+        self.get_token()
+        self.assertEqual(StashedUpload.objects.count(), 1)
+
+    @skipUnless(find_spec('openpyxl'), "openpyxl is not installed")
+    def test_xlsx(self):
+        import openpyxl
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(self.header)
+        sheet.append(['', self.hospitals[0].name, self.hospitals[0].identifier, '', '', '', 7, 'b/d', 'text'])
+        sheet.append(['', self.hospitals[1].name, self.hospitals[1].identifier, '', '', '', 'x', None, None])
+        output = BytesIO()
+        workbook.save(output)
+        f = SimpleUploadedFile('answers.xlsx', output.getvalue())
+        upload = read_upload(f, f.name, self.participant, get_structure(self.survey))
+        self.assertEqual(sorted(upload.rows), sorted([(self.hospitals[0].pk, self.subquestions[0].pk, '7'),
+                                                      (self.hospitals[0].pk, self.subquestions[1].pk, 'b/d'),
+                                                      (self.hospitals[0].pk, self.subquestions[2].pk, 'text')]))
+        self.assertEqual([(x.row, x.value) for x in upload.errors], [(3, 'x')])
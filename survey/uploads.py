@@ -0,0 +1,248 @@
+"""
+Bulk upload of answers of a participant in the wide layout of the export.
+
+A file starts with the ``exports.HEADER`` columns followed by a column per
+subquestion named by ``exports.get_key``. Rows of CSV or XLSX files are read as
+a stream and matched to hospitals of the participant by identifier or name.
+Cells are validated with NumPy a column at a time according to the kind of its
+subquestion, blank cells are skipped. A dry run shows ``get_diff`` of the valid
+rows, which are stashed as ``StashedUpload`` until the upload is confirmed.
+Confirmed rows are checked against the current hospitals and subquestions, see
+``check_rows``, and saved with one ``upsert_answers``.
+"""
+import codecs
+import csv
+import json
+import os
+import zipfile
+from collections import namedtuple
+from datetime import timedelta
+from uuid import uuid4
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.utils import timezone
+from django.utils.encoding import force_text
+from django.utils.translation import ugettext as _
+
+from .analytics import to_numbers
+from .answers import classify, get_existing
+from .exports import HEADER
+from .models import StashedUpload, Subquestion
+
+MAX_ROWS = getattr(settings, 'SURVEY_UPLOAD_MAX_ROWS', 5000)
+STASH_TIMEOUT = getattr(settings, 'SURVEY_UPLOAD_STASH_TIMEOUT', 60 * 60)
+
+HOSPITAL = HEADER.index('Hospital')
+IDENTIFIER = HEADER.index('Identifier')
+
+Upload = namedtuple('Upload', ['rows', 'errors', 'hospitals'])
+CellError = namedtuple('CellError', ['row', 'column', 'value', 'message'])
+ChangedCell = namedtuple('ChangedCell', ['hospital', 'subquestion', 'old', 'new'])
+
+
+def to_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return force_text(value).strip()
+
+
+def iter_csv_rows(f):
+    return csv.reader(codecs.iterdecode(f, 'utf-8-sig'))
+
+
+def iter_xlsx_rows(f):
+    try:
+        import openpyxl
+    except ImportError:
+        raise ImproperlyConfigured("Upload of XLSX files requires openpyxl to be installed.")
+    workbook = openpyxl.load_workbook(f, read_only=True, data_only=True)
+    for row in workbook.active.iter_rows():
+        yield [cell.value for cell in row]
+
+
+def iter_rows(f, name):
+    """
+    Yields rows of the file as lists of stripped strings, the format is chosen by the extension of the name.
+    """
+    extension = os.path.splitext(name)[1].lower()
+    if extension == '.csv':
+        rows = iter_csv_rows(f)
+    elif extension == '.xlsx':
+        rows = iter_xlsx_rows(f)
+    else:
+        raise ValidationError(_("Only CSV and XLSX files are supported."))
+    for row in rows:
+        yield [to_text(value) for value in row]
+
+
+def get_subquestions(header, structure):
+    """
+    Returns subquestions of the columns following ``HEADER``, ``None`` for columns without a name.
+    """
+    if header[:len(HEADER)] != HEADER:
+        raise ValidationError(_("The file must start with the columns of the export: {columns}.").format(
+            columns=", ".join(HEADER)))
+    subquestions = []
+    for name in header[len(HEADER):]:
+        pk = name.rpartition(':')[2]
+        if not name:
+            subquestions.append(None)
+        elif pk.isdigit() and int(pk) in structure.subquestions:
+            subquestions.append(structure.subquestions[int(pk)])
+        else:
+            raise ValidationError(_("The column {name} is not a subquestion of the survey.").format(name=name))
+    return subquestions
+
+
+def clean_column(values, kind):
+    """
+    Returns answers of a column of cells and a mask of its invalid cells.
+
+    Answers of ``KIND_INT`` are normalized as integers, the others are kept as given.
+    Numbers outside of int64 are invalid, like in ``survey.analytics.to_numbers``.
+    """
+    if kind not in Subquestion.NUMERIC_KINDS:
+        return values, np.zeros(len(values), dtype=bool)
+    numbers, missing = to_numbers(values)
+    valid = ~np.isnan(numbers)
+    if kind == Subquestion.KIND_VINT:
+        return values, ~(valid | missing)
+    answers = values.copy()
+    answers[valid] = [str(int(x)) for x in values[valid]]
+    return answers, ~valid
+
+
+def get_message(kind):
+    if kind == Subquestion.KIND_VINT:
+        return _("Enter a whole number or one of: {values}.").format(values=", ".join(Subquestion.MISSING_DATA))
+    return _("Enter a whole number.")
+
+
+def read_rows(rows, hospitals, subquestions):
+    """
+    Returns row numbers, hospital pks and a matrix of answer cells of the rows.
+
+    Rows of unknown or repeated hospitals are reported as ``CellError``.
+    """
+    by_identifier = {identifier: pk for pk, identifier, _ in hospitals if identifier}
+    by_name = {name: pk for pk, _, name in hospitals}
+    width = len(HEADER) + len(subquestions)
+    numbers, hospital_ids, cells, errors = [], [], [], []
+    seen = set()
+    for number, row in enumerate(rows, start=2):
+        if not any(row):
+            continue
+        if len(numbers) + len(errors) >= MAX_ROWS:
+            raise ValidationError(_("The file has more than {count} rows.").format(count=MAX_ROWS))
+        row = (row + [''] * width)[:width]
+        hospital_id = by_identifier.get(row[IDENTIFIER]) or by_name.get(row[HOSPITAL])
+        if hospital_id is None:
+            errors.append(CellError(number, HEADER[HOSPITAL], row[HOSPITAL],
+                                    _("The hospital is not one of the participant.")))
+        elif hospital_id in seen:
+            errors.append(CellError(number, HEADER[HOSPITAL], row[HOSPITAL],
+                                    _("The hospital is given in more than one row.")))
+        else:
+            seen.add(hospital_id)
+            numbers.append(number)
+            hospital_ids.append(hospital_id)
+            cells.append(row[len(HEADER):])
+    matrix = np.empty((len(cells), len(subquestions)), dtype=object)
+    if cells:
+        matrix[:] = cells
+    return np.array(numbers, dtype=np.int64), np.array(hospital_ids, dtype=np.int64), matrix, errors
+
+
+def read_upload(f, name, participant, structure):
+    """
+    Returns ``Upload`` of rows ``(hospital_id, subquestion_id, answer)`` of valid
+    non-blank cells of the file and ``CellError`` of the invalid ones.
+
+    Raises ``ValidationError`` if the file can not be read or its header is not
+    the one of the export.
+    """
+    hospitals = list(participant.health_fund.hospital_set.values_list('pk', 'identifier', 'name'))
+    try:
+        rows = iter_rows(f, name)
+        subquestions = get_subquestions(next(rows, []), structure)
+        numbers, hospital_ids, matrix, errors = read_rows(rows, hospitals, subquestions)
+    except (UnicodeDecodeError, csv.Error, zipfile.BadZipfile, KeyError):
+        raise ValidationError(_("The file can not be read, save it as CSV in UTF-8 or as XLSX."))
+    result = []
+    for column, subquestion in enumerate(subquestions):
+        if subquestion is None:
+            continue
+        values = matrix[:, column]
+        given = values != ''
+        answers, invalid = clean_column(values, subquestion.kind)
+        for row in np.nonzero(invalid & given)[0]:
+            errors.append(CellError(int(numbers[row]), subquestion.name, values[row],
+                                    get_message(subquestion.kind)))
+        selected = given & ~invalid
+        result += [(hospital_id, subquestion.pk, answer)
+                   for hospital_id, answer in zip(hospital_ids[selected].tolist(), answers[selected].tolist())]
+    errors.sort(key=lambda error: error.row)
+    return Upload(result, errors, {pk: hospital for pk, _, hospital in hospitals})
+
+
+def get_diff(participant, rows):
+    """
+    Returns ``UpsertResult`` which saving the rows would give, without saving them.
+    """
+    return classify(rows, get_existing(participant, rows))
+
+
+def describe_changes(changes, hospitals, structure):
+    return [ChangedCell(hospitals.get(change.hospital_id), structure.subquestions[change.subquestion_id],
+                        change.old, change.new)
+            for change in changes]
+
+
+def check_rows(participant, structure, rows):
+    """
+    Raises ``ValidationError`` unless stashed rows still belong to hospitals of
+    the participant and subquestions of the survey and are valid for their kinds.
+    """
+    message = _("Hospitals or questions of the survey changed since the file was checked, send the file again.")
+    hospital_ids = set(participant.health_fund.hospital_set.values_list('pk', flat=True))
+    columns = {}
+    for hospital_id, subquestion_id, answer in rows:
+        if hospital_id not in hospital_ids or subquestion_id not in structure.subquestions:
+            raise ValidationError(message)
+        columns.setdefault(subquestion_id, []).append(answer)
+    for subquestion_id, answers in columns.items():
+        values = np.array(answers, dtype=object)
+        if clean_column(values, structure.subquestions[subquestion_id].kind)[1].any():
+            raise ValidationError(message)
+
+
+def get_stash_start():
+    return timezone.now() - timedelta(seconds=STASH_TIMEOUT)
+
+
+def stash_rows(participant, rows):
+    """
+    Keeps rows of a dry run until the upload is confirmed and returns the token to confirm it.
+
+    Stashes older than ``SURVEY_UPLOAD_STASH_TIMEOUT`` seconds are removed.
+    """
+    StashedUpload.objects.filter(created__lt=get_stash_start()).delete()
+    token = uuid4().hex
+    StashedUpload.objects.create(participant=participant, token=token,
+                                 rows=json.dumps(rows, separators=(',', ':')))
+    return token
+
+
+def get_stashed_rows(participant, token):
+    rows = (StashedUpload.objects.filter(participant=participant, token=token, created__gte=get_stash_start()).
+            values_list('rows', flat=True).
+            first())
+    return None if rows is None else [tuple(row) for row in json.loads(rows)]
+
+
+def drop_stashed_rows(participant, token):
+    StashedUpload.objects.filter(participant=participant, token=token).delete()
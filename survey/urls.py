@@ -14,6 +14,12 @@ urlpatterns = [
     url(r'^(?P<participant>[\d-]+)/(?P<password>[\d-]+)/~accept$',
         views.SurveyAcceptView.as_view(),
         name="accept"),
+    url(r'^(?P<participant>[\d-]+)/(?P<password>[\d-]+)/~autosave$',
+        views.AutosaveView.as_view(),
+        name="autosave"),
+    url(r'^(?P<participant>[\d-]+)/(?P<password>[\d-]+)/~upload$',
+        views.UploadView.as_view(),
+        name="upload"),
     url(r'^(?P<participant>[\d-]+)/(?P<password>[\d-]+)/hospital-(?P<hospital>[\d-]+)/$',
         views.HospitalSurveyView.as_view(),
         name="survey"),
@@ -1,9 +1,12 @@
+import json
 from collections import namedtuple
 
 from braces.views import FormValidMessageMixin
 from django.contrib import messages
+from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.shortcuts import get_object_or_404
+from django.http import Http404, JsonResponse
+from django.shortcuts import get_object_or_404, redirect
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext as _
@@ -11,10 +14,18 @@ from django.views.generic import (FormView, ListView, RedirectView,
                                   TemplateView, View)
 from reversion.views import RevisionMixin
 
-from .forms import ParticipantForm, QuestionForm, SurveyForm
-from .models import Category, Hospital, Participant, Question, Survey
+from .completion import (get_answer_count, get_cell_completion,
+                         get_question_completion, get_section_completion,
+                         is_complete)
+from .forms import (AutosaveForm, ParticipantForm, QuestionForm, SurveyForm,
+                    UploadForm)
+from .models import Hospital, Participant, Survey
+from .structure import get_structure, linked_categories
+from .uploads import describe_changes
 
 SurveyHospitalForm = namedtuple('SurveyHospitalForm', ['hospital', 'form'])
+Section = namedtuple('Section', ['category', 'questions', 'hospitals'])
+LinkedSection = namedtuple('LinkedSection', ['obj', 'link', 'status', 'current'])
 
 
 class ParticipantMixin(object):
@@ -23,10 +34,15 @@ class ParticipantMixin(object):
     @cached_property
     def participant(self):
         return getattr(self, 'cached_participant') or \
-            get_object_or_404(Participant.objects.with_survey().with_hospital(),
+            get_object_or_404(Participant.objects.select_related('survey', 'health_fund').
+                              with_hospital(),
                               password=self.kwargs['password'],
                               pk=self.kwargs['participant'])
 
+    @cached_property
+    def structure(self):
+        return get_structure(self.participant.survey)
+
     def get_survey_list_url(self):
         return reverse('survey:list', kwargs={'password': self.kwargs['password'],
                                               'participant': self.kwargs['participant']})
@@ -39,21 +55,100 @@ class ParticipantMixin(object):
         return reverse('survey:accept', kwargs={'password': self.kwargs['password'],
                                                 'participant': self.kwargs['participant']})
 
+    def get_survey_autosave_url(self):
+        return reverse('survey:autosave', kwargs={'password': self.kwargs['password'],
+                                                  'participant': self.kwargs['participant']})
+
+    def get_survey_upload_url(self):
+        return reverse('survey:upload', kwargs={'password': self.kwargs['password'],
+                                                'participant': self.kwargs['participant']})
+
     def get_context_data(self, **kwargs):
         context = super(ParticipantMixin, self).get_context_data(**kwargs)
+        context['autosave_url'] = self.get_survey_autosave_url()
+        context['upload_url'] = self.get_survey_upload_url()
         context['list_url'] = self.get_survey_list_url()
         context['print_url'] = self.get_survey_print_url()
         context['accept_url'] = self.get_survey_accept_url()
         return context
 
 
+class SectionMixin(object):
+    """
+    Splits an answer form into sections when ``Survey.section_size`` is set.
+
+    Sections are categories and chunks of hospitals, the current one is
+    selected by ``?section=<index>`` and only its fields are built, validated
+    and saved.
+    """
+    split_categories = True
+    split_hospitals = True
+
+    def get_section_groups(self):
+        if self.split_categories:
+            return [(category, category.questions) for category in self.structure.categories]
+        return [(None, list(self.structure.iter_questions()))]
+
+    def get_section_hospitals(self):
+        return list(self.participant.health_fund.hospital_set.all())
+
+    @cached_property
+    def sections(self):
+        size = self.participant.survey.section_size
+        if not size:
+            return []
+        hospitals = self.get_section_hospitals()
+        if self.split_hospitals:
+            chunks = [hospitals[start:start + size] for start in range(0, len(hospitals), size)]
+        else:
+            chunks = [hospitals]
+        return [Section(category, questions, chunk)
+                for category, questions in self.get_section_groups()
+                for chunk in chunks]
+
+    @cached_property
+    def section_index(self):
+        try:
+            index = int(self.request.GET.get('section', 0))
+        except ValueError:
+            raise Http404(_("No section found matching the query"))
+        if self.sections and not 0 <= index < len(self.sections):
+            raise Http404(_("No section found matching the query"))
+        return index
+
+    @cached_property
+    def section(self):
+        return self.sections[self.section_index] if self.sections else None
+
+    def get_section_url(self, index):
+        return '{path}?section={index}'.format(path=self.request.path, index=index)
+
+    def get_next_section_url(self):
+        if self.section and self.section_index + 1 < len(self.sections):
+            return self.get_section_url(self.section_index + 1)
+        return None
+
+    def get_context_data(self, **kwargs):
+        context = super(SectionMixin, self).get_context_data(**kwargs)
+        if self.section:
+            completion = get_section_completion(self.participant, self.sections)
+            context['section'] = self.section
+            context['section_list'] = [LinkedSection(section, self.get_section_url(index), status,
+                                                     index == self.section_index)
+                                       for index, (section, status) in enumerate(zip(self.sections,
+                                                                                     completion))]
+            context['split_categories'] = self.split_categories
+            context['split_hospitals'] = self.split_hospitals
+        return context
+
+
 class HospitalMixin(ParticipantMixin):
     model = Hospital
 
     def get_queryset(self, *args, **kwargs):
         qs = super(HospitalMixin, self).get_queryset(*args, **kwargs)
         qs = qs.filter(health_fund__participant=self.participant).all()
-        qs = qs.answer_fetch(self.participant)
+        qs = qs.with_completion(self.participant)
         return qs
 
 
@@ -67,41 +162,38 @@ class HospitalListView(HospitalMixin, ListView):
 
     def get_context_data(self, **kwargs):
         context = super(HospitalListView, self).get_context_data(**kwargs)
-        context['linked_hospitals'] = self.object_list.linked(**self.kwargs)
+        context['linked_hospitals'] = self.object_list.linked(
+            required=self.participant.survey.subquestion_count,
+            **self.kwargs)
         context['print_url'] = self.get_print_url()
         context['participant'] = self.participant
         context['survey'] = self.participant.survey
         return context
 
 
-class QuestionListView(ParticipantMixin, ListView):
-    model = Category
+class QuestionListView(ParticipantMixin, TemplateView):
     template_name = 'survey/question_list.html'
 
-    def get_queryset(self, *args, **kwargs):
-        qs = super(QuestionListView, self).get_queryset(*args, **kwargs)
-        return (qs.select_related('survey').
-                prefetch_related('question_set__subquestion_set').
-                filter(survey=self.participant.survey_id))
-
     def get_print_url(self):
         return reverse('survey:print', kwargs={'password': self.kwargs['password'],
                                                'participant': self.kwargs['participant']})
 
     def get_context_data(self, **kwargs):
         context = super(QuestionListView, self).get_context_data(**kwargs)
-        question_dict = self.participant.answer_set.as_question_dict()
-        context['linked_categories'] = self.object_list.linked(question_dict=question_dict,
-                                                               **self.kwargs)
+        completion = get_question_completion(self.participant, self.structure)
+        context['linked_categories'] = linked_categories(self.structure,
+                                                         completion=completion,
+                                                         **self.kwargs)
         context['print_url'] = self.get_print_url()
         context['participant'] = self.participant
         context['survey'] = self.participant.survey
         return context
 
 
-class HospitalSurveyView(ParticipantMixin, RevisionMixin, FormValidMessageMixin, FormView):
+class HospitalSurveyView(SectionMixin, ParticipantMixin, RevisionMixin, FormValidMessageMixin, FormView):
     form_class = SurveyForm
     template_name = 'survey/hospital_form.html'
+    split_hospitals = False
 
     @cached_property
     def survey(self):
@@ -118,8 +210,13 @@ class HospitalSurveyView(ParticipantMixin, RevisionMixin, FormValidMessageMixin,
         kw['participant'] = self.participant
         kw['hospital'] = self.hospital
         kw['user'] = self.request.user
+        if self.section:
+            kw['category'] = self.section.category
         return kw
 
+    def get_section_hospitals(self):
+        return [self.hospital]
+
     def get_survey_list_url(self):
         return reverse('survey:list', kwargs={'password': self.kwargs['password'],
                                               'participant': self.kwargs['participant']})
@@ -132,7 +229,7 @@ class HospitalSurveyView(ParticipantMixin, RevisionMixin, FormValidMessageMixin,
         return context
 
     def get_success_url(self):
-        return self.get_survey_list_url()
+        return self.get_next_section_url() or self.get_survey_list_url()
 
     def get_form_valid_message(self):
         return _("Answer for {hospital} was saved!").format(hospital=self.hospital)
@@ -142,9 +239,10 @@ class HospitalSurveyView(ParticipantMixin, RevisionMixin, FormValidMessageMixin,
         return super(HospitalSurveyView, self).form_valid(form, *args, **kwargs)
 
 
-class QuestionSurveyView(ParticipantMixin, RevisionMixin, FormValidMessageMixin, FormView):
+class QuestionSurveyView(SectionMixin, ParticipantMixin, RevisionMixin, FormValidMessageMixin, FormView):
     form_class = QuestionForm
     template_name = 'survey/question_form.html'
+    split_categories = False
 
     @cached_property
     def survey(self):
@@ -152,17 +250,23 @@ class QuestionSurveyView(ParticipantMixin, RevisionMixin, FormValidMessageMixin,
 
     @cached_property
     def question(self):
-        return get_object_or_404(Question.objects.select_related('category__survey').
-                                 prefetch_related('subquestion_set'),
-                                 pk=self.kwargs['question'])
+        try:
+            return self.structure.questions[int(self.kwargs['question'])]
+        except (KeyError, ValueError):
+            raise Http404(_("No question found matching the query"))
 
     def get_form_kwargs(self, *args, **kwargs):
         kw = super(QuestionSurveyView, self).get_form_kwargs(*args, **kwargs)
         kw['participant'] = self.participant
         kw['question'] = self.question
         kw['user'] = self.request.user
+        if self.section:
+            kw['hospitals'] = self.section.hospitals
         return kw
 
+    def get_section_groups(self):
+        return [(None, [self.question])]
+
     def get_survey_list_url(self):
         return reverse('survey:list', kwargs={'password': self.kwargs['password'],
                                               'participant': self.kwargs['participant']})
@@ -175,13 +279,15 @@ class QuestionSurveyView(ParticipantMixin, RevisionMixin, FormValidMessageMixin,
         context = super(QuestionSurveyView, self).get_context_data(**kwargs)
         context['survey'] = self.survey
         context['question'] = self.question
-        context['subquestion_set'] = self.question.subquestion_set.all()
+        context['subquestion_set'] = self.question.subquestions
         context['survey_list_url'] = self.get_survey_list_url()
         context['survey_print_url'] = self.get_survey_print_url()
 
         return context
 
     def get_success_url(self):
+        if self.get_next_section_url():
+            return self.get_next_section_url()
         if self.request.POST.get('next', 'yes') == 'yes':
             return self.get_next_question_url() or self.get_survey_list_url()
         return self.get_survey_list_url()
@@ -190,13 +296,10 @@ class QuestionSurveyView(ParticipantMixin, RevisionMixin, FormValidMessageMixin,
         return _("Answer for {question} was saved!").format(question=self.question)
 
     def get_question_list(self):
-        for category in self.survey.category_set.all():
-            for question in category.question_set.all():
-                yield question.pk
+        return self.structure.question_ids()
 
     def get_next_question_url(self):
-        question_list = list(self.get_question_list())
-        print(question_list)
+        question_list = self.get_question_list()
         index = question_list.index(self.question.pk)
         if index + 1 >= len(question_list):
             return None
@@ -210,7 +313,7 @@ class QuestionSurveyView(ParticipantMixin, RevisionMixin, FormValidMessageMixin,
         return super(QuestionSurveyView, self).form_valid(form, *args, **kwargs)
 
 
-class ParticipantFormView(ParticipantMixin, RevisionMixin, FormValidMessageMixin, FormView):
+class ParticipantFormView(SectionMixin, ParticipantMixin, RevisionMixin, FormValidMessageMixin, FormView):
     form_class = ParticipantForm
     template_name = 'survey/participant_form.html'
 
@@ -218,13 +321,16 @@ class ParticipantFormView(ParticipantMixin, RevisionMixin, FormValidMessageMixin
         kw = super(ParticipantFormView, self).get_form_kwargs(*args, **kwargs)
         kw['participant'] = self.participant
         kw['user'] = self.request.user
+        if self.section:
+            kw['category'] = self.section.category
+            kw['hospitals'] = self.section.hospitals
         return kw
 
     def get_form_valid_message(self):
         return _("Answer was saved!")
 
     def get_success_url(self):
-        return self.get_survey_list_url()
+        return self.get_next_section_url() or self.get_survey_list_url()
 
     def get_context_data(self, **kwargs):
         context = super(ParticipantFormView, self).get_context_data(**kwargs)
@@ -292,11 +398,77 @@ class SurveyPrintDispatchView(View):
 class SurveyAcceptView(ParticipantMixin, RedirectView):
 
     def get_redirect_url(self, *args, **kwargs):
-        answer_count = self.participant.answer_set.count()
-        if answer_count == self.participant.survey.subquestion_count:
+        if is_complete(self.participant):
             self.participant.accept_on = timezone.now()
             self.participant.save()
             messages.success(self.request, _("Survey was accepted!"))
         else:
             messages.warning(self.request, _("The answers to all the questions is required!"))
         return self.get_survey_list_url()
+
+
+class AutosaveView(ParticipantMixin, RevisionMixin, View):
+    """
+    Saves a JSON batch ``{"cells": [{"hospital": pk, "subquestion": pk, "value": answer}]}``
+    of answers and returns errors of rejected cells and completion of touched
+    hospitals and questions as ``[count, required]``.
+    """
+    http_method_names = ['post']
+
+    def post(self, request, *args, **kwargs):
+        try:
+            data = json.loads(request.body.decode('utf-8'))
+            form = AutosaveForm(data['cells'], participant=self.participant, user=request.user)
+            form.is_valid()
+        except (ValueError, TypeError, KeyError):
+            return JsonResponse({'error': _("Invalid request.")}, status=400)
+        except ValidationError as e:
+            return JsonResponse({'error': ' '.join(e.messages)}, status=400)
+        result = form.save()
+        hospital_ids = {hospital_id for hospital_id, subquestion_id in form.rows}
+        question_ids = {self.structure.subquestions[subquestion_id].question_id
+                        for hospital_id, subquestion_id in form.rows}
+        hospitals, questions = get_cell_completion(self.participant, self.structure,
+                                                   hospital_ids, question_ids)
+        return JsonResponse({
+            'saved': len(result.modified),
+            'errors': [{'hospital': hospital_id, 'subquestion': subquestion_id, 'messages': errors}
+                       for hospital_id, subquestion_id, errors in form.errors],
+            'hospitals': hospitals,
+            'questions': questions,
+            'total': [get_answer_count(self.participant), self.participant.get_required_count()],
+        })
+
+
+class UploadView(ParticipantMixin, RevisionMixin, FormView):
+    """
+    Shows a dry run of an uploaded file of answers, saves its rows once confirmed.
+    """
+    form_class = UploadForm
+    template_name = 'survey/upload_form.html'
+    diff_limit = 500
+
+    def get_form_kwargs(self, *args, **kwargs):
+        kw = super(UploadView, self).get_form_kwargs(*args, **kwargs)
+        kw['participant'] = self.participant
+        kw['user'] = self.request.user
+        return kw
+
+    def get_context_data(self, **kwargs):
+        context = super(UploadView, self).get_context_data(**kwargs)
+        context['survey'] = self.participant.survey
+        return context
+
+    def form_valid(self, form):
+        if form.is_dry_run():
+            changes = form.diff.modified
+            return self.render_to_response(self.get_context_data(
+                form=form,
+                token=form.cleaned_data['token'],
+                diff=form.diff,
+                change_list=describe_changes(changes[:self.diff_limit], form.upload.hospitals, self.structure),
+                error_list=form.upload.errors))
+        result = form.save()
+        messages.success(self.request, _("{created} answers were created and {changed} were changed.").format(
+            created=len(result.created), changed=len(result.changed)))
+        return redirect(self.get_survey_list_url())